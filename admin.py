@@ -0,0 +1,137 @@
+"""Admin page: stage timings, queue depth, cache hit rates and profiles of this app process.
+
+Shown in the sidebar when `MANGODB_ADMIN=1`. Jobs handed to a separate job
+server (`MANGODB_JOB_SERVER`) are measured there; see its `/metrics`.
+"""
+import time
+
+import pandas as pd
+import streamlit as st
+
+import metrics
+
+PROFILED_PAGES = ["BLAST", "MSA"]
+
+
+def _rows(rows, name):
+    return [(labels, values) for row_name, labels, *values in rows if row_name == name]
+
+
+def _trace_lines(trace, depth=0):
+    usage = trace["usage"]
+    extra = ""
+    if usage:
+        extra = f"  [child CPU {usage['cpu_seconds']:.2f} s, peak RSS {usage['max_rss_bytes'] / 2**20:.0f} MB]"
+    labels = " ".join(f"{k}={v}" for k, v in trace["labels"].items())
+    lines = [f"{'  ' * depth}{trace['name']} {labels} {trace['duration'] * 1000:.1f} ms{extra}"]
+    for child in trace["children"]:
+        lines.extend(_trace_lines(child, depth + 1))
+    return lines
+
+
+def render_queue(collected):
+    gauges = {(name, labels.get("state")): value for name, _, labels, value in collected}
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Queued jobs", gauges.get(("mangodb_queue_depth", "queued"), 0))
+    col2.metric("Running jobs", gauges.get(("mangodb_queue_depth", "running"), 0))
+    col3.metric("Free threads", f"{gauges.get(('mangodb_queue_free_threads', None), '-')}"
+                                f" / {gauges.get(('mangodb_queue_cpu_budget', None), '-')}")
+
+
+def render_caches(collected):
+    caches = {}
+    for name, _, labels, value in collected:
+        if name.startswith("mangodb_cache_"):
+            caches.setdefault(labels["cache"], {})[name] = value
+    if not caches:
+        return
+    table = pd.DataFrame([{
+        "Cache": cache,
+        "Hits": values.get("mangodb_cache_hits_total", 0),
+        "Misses": values.get("mangodb_cache_misses_total", 0),
+        "Hit Rate %": (values.get("mangodb_cache_hits_total", 0) * 100
+                       / max(1, values.get("mangodb_cache_hits_total", 0)
+                             + values.get("mangodb_cache_misses_total", 0))),
+        "Memory MB": values.get("mangodb_cache_memory_bytes", 0) / 2**20,
+        "Entries": values.get("mangodb_cache_memory_entries", 0),
+    } for cache, values in sorted(caches.items())])
+    st.dataframe(table, hide_index=True)
+
+
+def render_stages(summaries):
+    stages = _rows(summaries, "mangodb_stage_seconds")
+    if not stages:
+        st.caption("No stages recorded yet.")
+        return
+    table = pd.DataFrame([{"Stage": labels["stage"], "Count": count, "Mean ms": total / count * 1000,
+                           "Max ms": largest * 1000, "Total s": total}
+                          for labels, (count, total, largest) in stages])
+    st.dataframe(table.sort_values("Total s", ascending=False), hide_index=True)
+
+
+def render_page_runs(summaries):
+    runs = _rows(summaries, "mangodb_page_run_seconds")
+    if not runs:
+        return
+    table = pd.DataFrame([{"Page": labels["page"], "Start": labels["start"], "Runs": count,
+                           "Mean ms": total / count * 1000, "Max ms": largest * 1000}
+                          for labels, (count, total, largest) in runs])
+    st.dataframe(table.sort_values(["Page", "Start"]), hide_index=True)
+
+
+def render_processes(counters, summaries):
+    cpu = {labels["tool"]: value for labels, (value,) in _rows(counters, "mangodb_child_cpu_seconds_total")}
+    rss = {labels["tool"]: largest for labels, (_, _, largest) in _rows(summaries, "mangodb_child_max_rss_bytes")}
+    wall = _rows(summaries, "mangodb_child_wall_seconds")
+    if not wall:
+        return
+    table = pd.DataFrame([{"Tool": labels["tool"], "Runs": count, "Wall s": total,
+                           "CPU s": cpu.get(labels["tool"], float("nan")),
+                           "Peak RSS MB": rss.get(labels["tool"], float("nan")) / 2**20}
+                          for labels, (count, total, _) in wall])
+    st.dataframe(table, hide_index=True)
+
+
+def render_profiling():
+    page = st.selectbox("Page", PROFILED_PAGES, key="admin_profile_page")
+    if st.button("Profile its next run"):
+        st.session_state["profile_next"] = page
+    if st.session_state.get("profile_next"):
+        st.caption(f"The next {st.session_state['profile_next']} page run in this session will be profiled.")
+    for report in metrics.profiles():
+        started = time.strftime("%H:%M:%S", time.localtime(report["started"]))
+        with st.expander(f"{report['label']} at {started}"):
+            st.code(report["stats"], language="text")
+
+
+def admin_ui():
+    st.title("Admin: Metrics")
+    st.caption("Figures for this app process since it started. Jobs sent to a separate job server "
+               "are measured there; see its /metrics.")
+    counters, summaries, collected = metrics.snapshot()
+
+    st.markdown("### Job Queue")
+    render_queue(collected)
+    st.markdown("### Result Caches")
+    render_caches(collected)
+    st.markdown("### Page Runs")
+    st.caption("Whole script runs, including imports; a page's first run in this process is its cold start.")
+    render_page_runs(summaries)
+    st.markdown("### Stage Timings")
+    render_stages(summaries)
+    st.markdown("### External Tools")
+    render_processes(counters, summaries)
+
+    st.markdown("### Recent Traces")
+    for trace in metrics.traces()[:20]:
+        started = time.strftime("%H:%M:%S", time.localtime(trace["start"]))
+        with st.expander(f"{started} {trace['name']} ({trace['duration'] * 1000:.0f} ms)"):
+            st.code("\n".join(_trace_lines(trace)), language="text")
+
+    st.markdown("### Profiling")
+    render_profiling()
+
+    with st.expander("All metrics (Prometheus text)"):
+        text = metrics.render_prometheus()
+        st.code(text, language="text")
+        st.download_button("Download metrics", text, file_name="metrics.txt", mime="text/plain")
@@ -0,0 +1,241 @@
+"""Multiple sequence alignment engines: Clustal Omega, MAFFT and MUSCLE.
+
+Every engine reads FASTA, writes aligned FASTA and runs as a job on the
+shared worker pool with an explicit thread count. `choose_aligner` picks
+an engine by input size: Clustal Omega for ordinary inputs, MAFFT FFT-NS-2
+once progressive alignment of many or long sequences dominates, and MAFFT
+PartTree for thousands of sequences, where building the full guide tree is
+itself the bottleneck. Engines that are not installed are skipped.
+
+Sequences can also be added to an existing alignment without realigning
+it (`run_addition`): MAFFT `--add` or Clustal Omega's profile alignment
+(`--profile1`) place the new sequences and keep the existing rows as they
+were, apart from gap columns opened for the newcomers.
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+
+import metrics
+from jobs import CPU_BUDGET
+from result_cache import ResultCache, make_key
+
+# Threads handed to the aligner; also the share of the worker pool's CPU
+# budget the alignment job reserves.
+MSA_THREADS = int(os.environ.get("MANGODB_MSA_THREADS", max(1, CPU_BUDGET // 2)))
+
+# Input sizes at which automatic selection switches engine.
+FFTNS_MIN_SEQUENCES = 200
+FFTNS_MIN_LENGTH = 10000  # mean residues per sequence
+PARTTREE_MIN_SEQUENCES = 5000
+
+MAX_SEQUENCES = int(os.environ.get("MANGODB_MSA_MAX_SEQUENCES", 50000))
+
+# Alignments with their stats and rendered figures, and dot plot PNGs,
+# shared by every session.
+MSA_CACHE = ResultCache("msa")
+
+
+class Aligner:
+    name = None
+    label = None
+    program = None
+    options = {}
+    can_add = False
+
+    def available(self):
+        return shutil.which(self.program) is not None
+
+    def command(self, input_path, output_path, threads):
+        """`(argv, to_stdout)`; when `to_stdout` the alignment is printed."""
+        raise NotImplementedError
+
+    def add_command(self, alignment_path, input_path, output_path, threads):
+        """Like `command`, adding the sequences in `input_path` to an alignment (if `can_add`)."""
+        raise NotImplementedError
+
+    def run(self, job, input_path, output_path, alignment_path=None):
+        """Align `input_path`, or add its sequences to the alignment in `alignment_path`."""
+        if alignment_path is None:
+            argv, to_stdout = self.command(input_path, output_path, job.threads)
+        else:
+            argv, to_stdout = self.add_command(alignment_path, input_path, output_path, job.threads)
+        if to_stdout:
+            with open(output_path, "w") as out:
+                for line in job.stream_command(argv):
+                    out.write(line)
+            return
+        result = job.run_command(argv)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip() or f"{self.program} exited with {result.returncode}")
+
+
+class ClustalOmega(Aligner):
+    name = "clustalo"
+    label = "Clustal Omega"
+    program = "clustalo"
+    options = {"auto": True}
+    can_add = True
+
+    def command(self, input_path, output_path, threads):
+        return [self.program, "-i", input_path, "-o", output_path, "--outfmt=fasta",
+                "--auto", "--force", f"--threads={threads}"], False
+
+    def add_command(self, alignment_path, input_path, output_path, threads):
+        return [self.program, "--profile1", alignment_path, "-i", input_path, "-o", output_path,
+                "--outfmt=fasta", "--force", f"--threads={threads}"], False
+
+
+class Mafft(Aligner):
+    program = "mafft"
+    STRATEGIES = {
+        "auto": ("MAFFT (auto)", ["--auto"]),
+        "fftns2": ("MAFFT (FFT-NS-2)", ["--retree", "2", "--maxiterate", "0"]),
+        "parttree": ("MAFFT (PartTree)", ["--retree", "1", "--maxiterate", "0", "--parttree"]),
+    }
+
+    def __init__(self, strategy):
+        self.name = f"mafft-{strategy}"
+        self.label, self.arguments = self.STRATEGIES[strategy]
+        self.options = {"strategy": strategy}
+        # MAFFT's --add does not work with --parttree.
+        self.can_add = strategy != "parttree"
+
+    def command(self, input_path, output_path, threads):
+        return [self.program, "--thread", str(threads), "--quiet", *self.arguments, input_path], True
+
+    def add_command(self, alignment_path, input_path, output_path, threads):
+        # The strategy applies to placing the new sequences.
+        return [self.program, "--thread", str(threads), "--quiet", *self.arguments,
+                "--add", input_path, alignment_path], True
+
+
+class Muscle(Aligner):
+    name = "muscle"
+    label = "MUSCLE"
+    program = "muscle"
+
+    def __init__(self):
+        self._major_version = None
+
+    def major_version(self):
+        """MUSCLE 5 changed the command line; 3.x takes `-in`/`-out` and one thread."""
+        if self._major_version is None:
+            try:
+                out = subprocess.run([self.program, "-version"], capture_output=True, text=True).stdout
+            except OSError:
+                out = ""
+            words = out.split()
+            version = words[1] if len(words) > 1 and words[0].lower() == "muscle" else "5"
+            self._major_version = int(version.lstrip("v").split(".")[0] or 5)
+        return self._major_version
+
+    def command(self, input_path, output_path, threads):
+        if self.major_version() >= 5:
+            return [self.program, "-align", input_path, "-output", output_path,
+                    "-threads", str(threads)], False
+        return [self.program, "-in", input_path, "-out", output_path, "-quiet"], False
+
+
+ALIGNERS = {aligner.name: aligner for aligner in
+            (ClustalOmega(), Mafft("auto"), Mafft("fftns2"), Mafft("parttree"), Muscle())}
+
+
+def available_aligners():
+    return [aligner for aligner in ALIGNERS.values() if aligner.available()]
+
+
+def choose_aligner(num_sequences, mean_length):
+    """The fastest suitable installed engine for an input of this size."""
+    if num_sequences >= PARTTREE_MIN_SEQUENCES:
+        preferred = ["mafft-parttree", "mafft-fftns2", "clustalo", "muscle"]
+    elif num_sequences >= FFTNS_MIN_SEQUENCES or mean_length >= FFTNS_MIN_LENGTH:
+        preferred = ["mafft-fftns2", "clustalo", "muscle"]
+    else:
+        preferred = ["clustalo", "mafft-auto", "muscle"]
+    for name in preferred:
+        if ALIGNERS[name].available():
+            return ALIGNERS[name]
+    raise RuntimeError("No alignment program found. Install clustalo, mafft or muscle.")
+
+
+def choose_add_aligner(num_sequences):
+    """The installed engine for adding sequences to an alignment of `num_sequences`."""
+    preferred = ["mafft-auto", "clustalo"] if num_sequences < FFTNS_MIN_SEQUENCES else ["mafft-fftns2", "clustalo"]
+    for name in preferred:
+        if ALIGNERS[name].available():
+            return ALIGNERS[name]
+    raise RuntimeError("Adding to an alignment needs mafft or clustalo.")
+
+
+def alignment_cache_key(input_digest, aligner):
+    """Cache key of an alignment; `input_digest` is the ingested input's `FastaSummary.digest`."""
+    return make_key(input_digest, aligner.name, aligner.options)
+
+
+def addition_cache_key(input_digest, added, aligner):
+    """Cache key of adding the last `added` sequences of an ingested input to the alignment before them."""
+    return make_key(input_digest, "add", added, aligner.name, aligner.options)
+
+
+def clustered_cache_key(input_digest, identity, aligner):
+    """Cache key of aligning the representatives of an ingested input clustered at `identity`."""
+    return make_key(input_digest, "cluster", identity, aligner.name, aligner.options)
+
+
+def run_alignment(job, aligner, input_path):
+    """Job target: align the FASTA file `input_path` and return the aligned FASTA.
+
+    The input file belongs to the job and is removed once the aligner has run.
+    """
+    out_fd, output_path = tempfile.mkstemp(suffix=".fasta")
+    os.close(out_fd)
+    try:
+        with metrics.span("msa.align", aligner=aligner.name):
+            aligner.run(job, input_path, output_path)
+        with open(output_path) as f:
+            return f.read()
+    finally:
+        for path in (input_path, output_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def split_fasta(path, first_records, first_path, rest_path):
+    """Write the first `first_records` records of `path` to `first_path`, the rest to `rest_path`."""
+    seen = 0
+    with open(path) as f, open(first_path, "w") as first, open(rest_path, "w") as rest:
+        out = first
+        for line in f:
+            if line.startswith(">"):
+                seen += 1
+                if seen > first_records:
+                    out = rest
+            out.write(line)
+
+
+def run_addition(job, aligner, input_path, added):
+    """Job target: add the last `added` sequences of `input_path` to the alignment before them.
+
+    Returns the aligned FASTA of all sequences. The input file belongs to the
+    job and is removed once the aligner has run.
+    """
+    paths = []
+    for suffix in (".aligned.fasta", ".new.fasta", ".fasta"):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        paths.append(path)
+    alignment_path, new_path, output_path = paths
+    try:
+        with open(input_path) as f:
+            total = sum(1 for line in f if line.startswith(">"))
+        split_fasta(input_path, total - added, alignment_path, new_path)
+        with metrics.span("msa.add", aligner=aligner.name, added=added):
+            aligner.run(job, new_path, output_path, alignment_path=alignment_path)
+        with open(output_path) as f:
+            return f.read()
+    finally:
+        for path in [input_path] + paths:
+            if os.path.exists(path):
+                os.remove(path)
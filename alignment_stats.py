@@ -0,0 +1,175 @@
+"""Vectorised statistics for a multiple sequence alignment.
+
+The alignment is encoded once into an `n x L` uint8 matrix. Pairwise counts
+are computed per residue as `X @ X.T` on 0/1 indicator matrices, processed in
+column blocks so the float32 temporaries stay within `BLOCK_BYTES` however
+long the alignment is. One `AlignmentStats` feeds the stats panel, the
+identity heatmap, the text report and the tree's distances (`phylogeny.py`).
+When sequences are added to an alignment, `extend_alignment_stats` only
+counts the pairs involving them.
+"""
+import numpy as np
+import pandas as pd
+
+GAP = ord("-")
+PURINES = np.frombuffer(b"AG", dtype=np.uint8)
+PYRIMIDINES = np.frombuffer(b"CT", dtype=np.uint8)
+# Lookup tables by residue code; faster than `np.isin` on large blocks.
+_IS_PURINE = np.isin(np.arange(256), PURINES)
+_IS_PYRIMIDINE = np.isin(np.arange(256), PYRIMIDINES)
+
+BLOCK_BYTES = 64 * 1024 * 1024
+
+
+def encode_alignment(alignment):
+    """`n x L` uint8 matrix of the aligned residues (as ASCII codes)."""
+    length = alignment.get_alignment_length()
+    if len(alignment) == 0:
+        return np.empty((0, length), dtype=np.uint8)
+    raw = "".join(str(record.seq) for record in alignment).encode("ascii", "replace")
+    return np.frombuffer(raw, dtype=np.uint8).reshape(len(alignment), length)
+
+
+def _column_blocks(n, length, bytes_per_cell=4):
+    step = max(1, BLOCK_BYTES // max(1, n * bytes_per_cell))
+    for start in range(0, length, step):
+        yield start, min(start + step, length)
+
+
+def _pair_counts(left, right):
+    """`(matches, both_residues)` between every row of `left` and of `right`.
+
+    Both are `n x L` matrices over the same columns; returns two
+    `len(left) x len(right)` arrays of column counts.
+    """
+    matches = np.zeros((len(left), len(right)))
+    both_residues = np.zeros((len(left), len(right)))
+    for start, end in _column_blocks(max(len(left), len(right)), left.shape[1]):
+        a = left[:, start:end]
+        b = right[:, start:end]
+        both_residues += (a != GAP).astype(np.float32) @ (b != GAP).astype(np.float32).T
+        for code in np.unique(a):
+            if code == GAP:
+                continue
+            matches += (a == code).astype(np.float32) @ (b == code).astype(np.float32).T
+    return matches, both_residues
+
+
+def transition_counts(matrix):
+    """Columns where two rows carry different purines or different pyrimidines, for every pair of rows."""
+    n = len(matrix)
+    counts = np.zeros((n, n))
+    for start, end in _column_blocks(n, matrix.shape[1]):
+        block = matrix[:, start:end]
+        for is_member, codes in ((_IS_PURINE, PURINES), (_IS_PYRIMIDINE, PYRIMIDINES)):
+            member = is_member[block].astype(np.float32)
+            counts += member @ member.T
+            for code in codes:
+                same = (block == code).astype(np.float32)
+                counts -= same @ same.T
+    return counts
+
+
+class AlignmentStats:
+    """Pairwise and per-column statistics of one alignment.
+
+    - `identity_matrix`: % of alignment columns where both sequences carry
+      the same non-gap residue (diagonal: a sequence's non-gap fraction);
+    - `gap_matrix`: columns where either sequence has a gap;
+    - `conservation`: per column, the fraction of sequences sharing the most
+      common non-gap residue;
+    - `match_symbols`: per column, `|` identical, `:` all purines or all
+      pyrimidines, space otherwise or when any sequence has a gap.
+    """
+
+    def __init__(self, alignment, pair_counts=None):
+        self.ids = [record.id for record in alignment]
+        self.matrix = encode_alignment(alignment)
+        n, length = self.matrix.shape
+        self.alignment_length = length
+        self.num_sequences = n
+
+        conservation = np.zeros(length)
+        symbols = np.full(length, ord(" "), dtype=np.uint8)
+        for start, end in _column_blocks(n, length, bytes_per_cell=1):
+            block = self.matrix[:, start:end]
+            residues = block != GAP
+            best = np.zeros(end - start)
+            for code in np.unique(block):
+                if code != GAP:
+                    np.maximum(best, (block == code).sum(axis=0), out=best)
+            conservation[start:end] = best / max(n, 1)
+            symbols[start:end] = self._symbols(block, residues)
+        self.conservation = conservation
+        self.match_symbols = symbols.tobytes().decode("ascii")
+
+        matches, both_residues = pair_counts if pair_counts is not None else _pair_counts(self.matrix, self.matrix)
+        self.identity_matrix = matches / length * 100 if length else matches
+        self.gap_matrix = (length - both_residues).astype(np.int64)
+
+        upper = np.triu_indices(n, k=1)  # same order as itertools.combinations
+        self.pairwise_identities = self.identity_matrix[upper]
+        self.pairwise_gaps = self.gap_matrix[upper]
+        pairs = len(self.pairwise_identities)
+        self.average_identity = float(self.pairwise_identities.mean()) if pairs else 0.0
+        self.average_gaps = float(self.pairwise_gaps.mean()) if pairs else 0.0
+
+    @staticmethod
+    def _symbols(block, residues):
+        out = np.full(block.shape[1], ord(" "), dtype=np.uint8)
+        if block.shape[0] == 0:
+            return out
+        no_gap = residues.all(axis=0)
+        identical = (block == block[0]).all(axis=0)
+        similar = _IS_PURINE[block].all(axis=0) | _IS_PYRIMIDINE[block].all(axis=0)
+        out[no_gap & similar] = ord(":")
+        out[no_gap & identical] = ord("|")
+        return out
+
+    def identity_frame(self):
+        return pd.DataFrame(self.identity_matrix, index=self.ids, columns=self.ids)
+
+
+def compute_alignment_stats(alignment):
+    return AlignmentStats(alignment)
+
+
+def extend_alignment_stats(base, alignment):
+    """Stats of `alignment`, made by adding sequences to the alignment `base` describes.
+
+    Profile alignment keeps the base rows as they were apart from inserted
+    all-gap columns, which leave their residue pair counts unchanged; only
+    the pairs involving a new sequence are counted. Falls back to
+    `compute_alignment_stats` when the base rows cannot be matched by ID or
+    were realigned.
+    """
+    ids = [record.id for record in alignment]
+    rows = {seq_id: row for row, seq_id in enumerate(ids)}
+    if len(rows) != len(ids) or len(set(base.ids)) != len(base.ids) or not set(base.ids) <= rows.keys():
+        return compute_alignment_stats(alignment)
+    matrix = encode_alignment(alignment)
+    old = np.array([rows[seq_id] for seq_id in base.ids], dtype=np.int64)
+    new = np.setdiff1d(np.arange(len(ids)), old)
+    if not _same_residues(matrix[old], base.matrix):
+        return compute_alignment_stats(alignment)
+
+    n = len(ids)
+    base_length = base.alignment_length
+    matches = np.zeros((n, n))
+    both_residues = np.zeros((n, n))
+    matches[np.ix_(old, old)] = base.identity_matrix * base_length / 100
+    both_residues[np.ix_(old, old)] = base_length - base.gap_matrix
+    if len(new):
+        new_matches, new_both = _pair_counts(matrix[new], matrix)
+        matches[new] = new_matches
+        matches[:, new] = new_matches.T
+        both_residues[new] = new_both
+        both_residues[:, new] = new_both.T
+    return AlignmentStats(alignment, pair_counts=(np.rint(matches), both_residues))
+
+
+def _same_residues(rows, base_matrix):
+    """Whether `rows` are `base_matrix` with (at most) all-gap columns inserted."""
+    def squeeze(matrix):
+        return matrix[:, ~(matrix == GAP).all(axis=0)]
+    return rows.shape[0] == base_matrix.shape[0] and np.array_equal(squeeze(rows), squeeze(base_matrix))
@@ -0,0 +1,151 @@
+"""Windowed display of a multiple sequence alignment, and its text report.
+
+The page never sends the whole alignment to the browser. `window_html`
+renders one window of rows and columns of the encoded alignment matrix
+(`AlignmentStats.matrix`), each column shaded by its conservation, and
+`overview` reduces conservation and gap occupancy to a fixed number of bins
+for a zoomed-out track of the whole alignment. The symbolic text view is
+produced block by block by `iter_report`, only when it is downloaded.
+"""
+import html
+import io
+
+import numpy as np
+import pandas as pd
+from Bio import AlignIO
+
+from alignment_stats import GAP, compute_alignment_stats
+
+VIEW_WIDTHS = [60, 120, 240]
+VIEW_ROWS = 40
+OVERVIEW_BINS = 400
+REPORT_LINE_WIDTH = 60
+
+# Conservation (fraction of sequences sharing the column's commonest
+# residue) at which a column gets the next shade; gaps are drawn grey.
+CONSERVATION_LEVELS = [0.5, 0.7, 0.9, 1.0]
+_SHADES = ["", "background:#e0f3db", "background:#a8ddb5", "background:#43a2ca;color:#fff",
+           "background:#0868ac;color:#fff"]
+_GAP_CLASS = len(_SHADES)
+_STYLE = ("<style>.mangodb-aln{font-family:monospace;white-space:pre;overflow-x:auto;line-height:1.25;"
+          "font-size:13px}"
+          + "".join(f".mangodb-aln .c{i}{{{shade}}}" for i, shade in enumerate(_SHADES) if shade)
+          + f".mangodb-aln .c{_GAP_CLASS}{{color:#999}}.mangodb-aln .at{{text-decoration:underline}}</style>")
+
+
+def column_for_position(stats, row, position):
+    """Alignment column (0-based) of residue `position` (1-based) of sequence `row`."""
+    columns = np.flatnonzero(stats.matrix[row] != GAP)
+    if len(columns) == 0:
+        return 0
+    return int(columns[min(max(position, 1), len(columns)) - 1])
+
+
+def residue_count(stats, row):
+    return int(np.count_nonzero(stats.matrix[row] != GAP))
+
+
+def _ruler(start, end):
+    """Column numbers (1-based) every ten columns, over `start`..`end`."""
+    chars = [" "] * (end - start)
+    for column in range(start, end):
+        position = column + 1
+        if position % 10 and column != start:
+            continue
+        label = str(position)
+        offset = column - start
+        if offset + len(label) <= len(chars) and all(c == " " for c in chars[max(0, offset - 1):offset + len(label)]):
+            chars[offset:offset + len(label)] = label
+    return "".join(chars)
+
+
+def _row_html(residues, classes, marked):
+    """One alignment row, with runs of equally shaded columns in one span each."""
+    bounds = np.flatnonzero(np.diff(classes)) + 1
+    starts = np.r_[0, bounds]
+    ends = np.r_[bounds, len(classes)]
+    out = []
+    for a, b in zip(starts, ends):
+        text = residues[a:b].tobytes().decode("ascii", "replace")
+        if a <= marked < b:
+            at = marked - a
+            text = f"{html.escape(text[:at])}<span class=at>{html.escape(text[at])}</span>{html.escape(text[at + 1:])}"
+        else:
+            text = html.escape(text)
+        out.append(f"<span class=c{classes[a]}>{text}</span>" if classes[a] else text)
+    return "".join(out)
+
+
+def window_html(stats, start, end, first_row=0, last_row=None, marked=None):
+    """HTML of columns `start`..`end` (0-based, exclusive) of rows `first_row`..`last_row`.
+
+    Columns are shaded by conservation and the column `marked` is underlined;
+    the last line holds the match symbols of `AlignmentStats`.
+    """
+    last_row = stats.num_sequences if last_row is None else min(last_row, stats.num_sequences)
+    window = stats.matrix[first_row:last_row, start:end]
+    levels = np.digitize(stats.conservation[start:end], CONSERVATION_LEVELS)
+    marked = -1 if marked is None else marked - start
+    names = stats.ids[first_row:last_row]
+    width = max([len(name) for name in names] + [6])
+    lines = [" " * (width + 1) + _ruler(start, end)]
+    for name, residues in zip(names, window):
+        classes = np.where(residues == GAP, _GAP_CLASS, levels)
+        lines.append(f"{html.escape(name.ljust(width))} {_row_html(residues, classes, marked)}")
+    lines.append(" " * (width + 1) + html.escape(stats.match_symbols[start:end]))
+    return _STYLE + '<div class="mangodb-aln">' + "<br>".join(lines) + "</div>"
+
+
+def overview(stats, bins=OVERVIEW_BINS, window=None):
+    """Mean conservation and gap occupancy (%) in `bins` equal spans of the alignment.
+
+    Indexed by each span's first column (1-based); with `window`
+    (`(start, end)` columns) a "Window" column marks the spans it covers.
+    """
+    length = stats.alignment_length
+    if length == 0:
+        return pd.DataFrame(columns=["Conservation %", "Gaps %"])
+    edges = np.unique(np.linspace(0, length, min(bins, length) + 1).astype(np.int64))
+    starts, sizes = edges[:-1], np.diff(edges)
+    gaps = np.zeros(length)
+    step = max(1, 16 * 1024 * 1024 // max(1, stats.num_sequences))
+    for a in range(0, length, step):
+        gaps[a:a + step] = (stats.matrix[:, a:a + step] == GAP).mean(axis=0)
+    table = pd.DataFrame({"Conservation %": np.add.reduceat(stats.conservation, starts) / sizes * 100,
+                          "Gaps %": np.add.reduceat(gaps, starts) / sizes * 100},
+                         index=pd.Index(starts + 1, name="Column"))
+    if window is not None:
+        covered = (edges[1:] > window[0]) & (starts < window[1])
+        table["Window"] = np.where(covered, 100.0, 0.0)
+    return table
+
+
+def iter_symbolic(stats, line_width=REPORT_LINE_WIDTH):
+    """The symbolic alignment view, one block of `line_width` columns at a time.
+
+    Each block lists every sequence's residues and, below them, the match
+    symbols: `|` identical, `:` all purines or all pyrimidines, space for
+    mismatches or gaps.
+    """
+    for start in range(0, stats.alignment_length, line_width):
+        end = min(start + line_width, stats.alignment_length)
+        block = stats.matrix[:, start:end]
+        lines = [f"Seq{i + 1:<4} {row.tobytes().decode('ascii', 'replace')}\n" for i, row in enumerate(block)]
+        lines.append("        " + stats.match_symbols[start:end] + "\n\n")
+        yield "".join(lines)
+
+
+def iter_report(stats, line_width=REPORT_LINE_WIDTH):
+    """The alignment report (statistics, then the symbolic view) as text chunks."""
+    yield ("### Alignment Statistics\n"
+           f"Alignment Length: {stats.alignment_length}\n"
+           f"Average Pairwise Identity: {stats.average_identity:.2f}%\n"
+           f"Average Gaps per Pair: {stats.average_gaps:.2f}\n"
+           f"Total Sequences: {stats.num_sequences}\n\n"
+           "### Visual Alignment\n")
+    yield from iter_symbolic(stats, line_width)
+
+
+def report_from_fasta(aligned_fasta, line_width=REPORT_LINE_WIDTH):
+    """`iter_report` of an aligned FASTA string."""
+    return iter_report(compute_alignment_stats(AlignIO.read(io.StringIO(aligned_fasta), "fasta")), line_width)
@@ -1,15 +1,28 @@
+import os
+import time
 import streamlit as st
-from blast import blast_ui
-from msa import msa_ui
+import metrics
+from static_assets import image_bytes
 from pathlib import Path
 
+run_started = time.perf_counter()
+
+# The admin page (metrics, profiling) is only listed when enabled.
+ADMIN = os.environ.get("MANGODB_ADMIN", "0") == "1"
+metrics.start_server()
+
+# Display widths (pixels) of the header logos and gallery photos.
+HEADER_LOGO_WIDTH = 130
+HEADER_MANGO_WIDTH = 125
+GALLERY_WIDTH = 200
+
 st.set_page_config(page_title="Mango Genome Database")
 def app_header():
     # Use columns to place logo on left, text on right
     col1, col2, col3 = st.columns([3, 6, 3])  # Adjust ratio as needed
 
     with col1:
-        st.image("static/SSUETLogo.png", width=130)  # your app logo here
+        st.image(image_bytes("static/SSUETLogo.png", HEADER_LOGO_WIDTH), width=HEADER_LOGO_WIDTH)
 
     with col2:
         st.markdown("""
@@ -17,7 +30,7 @@ def app_header():
         """)
        
     with col3:
-        st.image("logo.png", width=125)  # your app logo here
+        st.image(image_bytes("logo.png", HEADER_MANGO_WIDTH), width=HEADER_MANGO_WIDTH)
 
 def app_footer():
     # Footer with link centered
@@ -54,7 +67,7 @@ st.markdown(
     unsafe_allow_html=True
 )
 
-sidebar_main = st.sidebar.radio("Menu", ["BLAST", "MSA", "Downloads", "About", "Help"])
+sidebar_main = st.sidebar.radio("Menu", ["BLAST", "MSA", "Downloads", "About", "Help"] + (["Admin"] if ADMIN else []))
 choice = None
 
 if sidebar_main == "About":
@@ -92,13 +105,13 @@ if choice == "About - Project":
     col1, col2, col3, col4 = st.columns(4)
 
     with col1:
-        st.image("static/Images/s1.jpg", caption='Mango (*Mangifera indica* L.) is called “king of fruits" in Pakistan.', use_column_width=True)
+        st.image(image_bytes("static/Images/s1.jpg", GALLERY_WIDTH), caption='Mango (*Mangifera indica* L.) is called “king of fruits" in Pakistan.', width="stretch")
     with col2:
-        st.image("static/Images/fc.jpg", caption='The Experimental procedure done at ICCBS (UoK).', use_column_width=True)
+        st.image(image_bytes("static/Images/fc.jpg", GALLERY_WIDTH), caption='The Experimental procedure done at ICCBS (UoK).', width="stretch")
     with col3:
-        st.image("static/Images/s3.jpg", caption='Sir Syed University of Engineering and Technology, Karachi.', use_column_width=True)
+        st.image(image_bytes("static/Images/s3.jpg", GALLERY_WIDTH), caption='Sir Syed University of Engineering and Technology, Karachi.', width="stretch")
     with col4:
-        st.image("static/Images/s4.jpg", caption='Mango Genome Database online project 2017.\nSir Syed University of Engineering and Technology, Karachi.', use_column_width=True)
+        st.image(image_bytes("static/Images/s4.jpg", GALLERY_WIDTH), caption='Mango Genome Database online project 2017.\nSir Syed University of Engineering and Technology, Karachi.', width="stretch")
 
 
 elif choice == "About - Disclaimer":
@@ -276,15 +289,23 @@ elif choice == "Help - User Guide":
     """)
 
 
-elif choice == "BLAST":
-    #st.title("BLAST Tool")
-    # Call your BLAST function here
-    blast_ui()
-
-elif choice == "MSA":
-    #st.title("MSA Tool")
-    # Call your MSA function here
-    msa_ui()
+elif choice in ("BLAST", "MSA"):
+    # Page modules, and pandas, matplotlib and Biopython behind them, are
+    # only imported once one of their pages is opened.
+    if choice == "BLAST":
+        from blast import blast_ui as page_ui
+    else:
+        from msa import msa_ui as page_ui
+    # The admin page can ask for one run of a page to be profiled.
+    if st.session_state.get("profile_next") == choice:
+        st.session_state.pop("profile_next")
+        metrics.profile(page_ui, label=f"{choice} page")
+    else:
+        page_ui()
+
+elif choice == "Admin" and ADMIN:
+    from admin import admin_ui
+    admin_ui()
 
 elif choice == "Downloads":
     st.title("Downloads")
@@ -302,3 +323,5 @@ elif choice == "Downloads":
     """)
 
 app_footer()
+# Runs cut short by `st.rerun` (job polling) are not counted.
+metrics.record_page_run(choice, time.perf_counter() - run_started)
@@ -0,0 +1,505 @@
+"""Benchmarks of the BLAST, MSA and statistics hot paths on synthetic data.
+
+    python benchmark.py run [--scale small|medium|large] [--only CASE,...] [--out bench.json]
+    python benchmark.py compare OLD.json NEW.json
+    python benchmark.py generate OUT.fasta [--type nucl|prot] [--count N] [--length L] [--divergence D]
+
+`run` generates its inputs in a temporary directory: families of sequences
+mutated from a common ancestor with a given divergence (substitutions plus
+a tenth as many indels), and for BLAST a throwaway database built with
+`makeblastdb`. Each case runs in its own freshly spawned process, so its
+peak RSS is not inflated by the cases before it; inputs are prepared before
+the clock starts. For every case the JSON report holds the wall time of
+each repeat, the CPU time of the process and of its child processes (BLAST,
+aligners) and the peak RSS of both. Cases whose tools are not installed are
+reported as skipped. `compare` prints the median wall-time ratio of two
+reports, e.g. of two commits.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, NamedTuple
+
+import numpy as np
+
+NUCLEOTIDES = "ACGT"
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+SCALES = {
+    "small": 0.1,
+    "medium": 1.0,
+    "large": 5.0,
+}
+
+
+def mutate(rng, seq, divergence, alphabet):
+    """`seq` with substitutions at rate `divergence` and indels at a tenth of it."""
+    letters = np.frombuffer(alphabet.encode(), dtype=np.uint8)
+    codes = np.frombuffer(seq.encode(), dtype=np.uint8).copy()
+    substituted = rng.random(len(codes)) < divergence
+    codes[substituted] = rng.choice(letters, substituted.sum())
+    roll = rng.random(len(codes))
+    inserted = np.flatnonzero(roll < divergence / 20)
+    codes = np.insert(codes, inserted, rng.choice(letters, len(inserted)))
+    deleted = np.flatnonzero(rng.random(len(codes)) < divergence / 20)
+    return np.delete(codes, deleted).tobytes().decode()
+
+
+def synthetic_records(count, length, divergence=0.1, alphabet=NUCLEOTIDES, families=None, seed=0):
+    """`count` `(ID, sequence)` records around `length`, in families sharing an ancestor.
+
+    Records in a family differ from its ancestor by `divergence`; lengths
+    vary by up to 20 %. `families` defaults to one per 10 records.
+    """
+    rng = np.random.default_rng(seed)
+    letters = np.frombuffer(alphabet.encode(), dtype=np.uint8)
+    families = families or max(1, count // 10)
+    ancestors = [rng.choice(letters, max(1, int(length * rng.uniform(0.8, 1.2)))).tobytes().decode()
+                 for _ in range(families)]
+    return [(f"seq{i + 1}", mutate(rng, ancestors[i % families], divergence, alphabet)) for i in range(count)]
+
+
+def synthetic_alignment(count, length, divergence=0.1, gap_rate=0.05, alphabet=NUCLEOTIDES, seed=0):
+    """`count` aligned rows of exactly `length` columns, as `(ID, row)` pairs."""
+    rng = np.random.default_rng(seed)
+    letters = np.frombuffer(alphabet.encode(), dtype=np.uint8)
+    ancestor = rng.choice(letters, length)
+    rows = np.tile(ancestor, (count, 1))
+    substituted = rng.random(rows.shape) < divergence
+    rows[substituted] = rng.choice(letters, substituted.sum())
+    rows[rng.random(rows.shape) < gap_rate] = ord("-")
+    return [(f"seq{i + 1}", row.tobytes().decode()) for i, row in enumerate(rows)]
+
+
+def write_fasta(path, records, line_width=60):
+    with open(path, "w") as f:
+        for name, seq in records:
+            f.write(f">{name}\n")
+            for start in range(0, len(seq), line_width):
+                f.write(seq[start:start + line_width] + "\n")
+    return path
+
+
+# --- cases -----------------------------------------------------------------
+# Each case prepares its inputs with `setup(work_dir, scale)`, which returns
+# `(params, state)`; `run(state)` is the timed part and must be repeatable.
+
+def _setup_ingest(work_dir, scale):
+    params = {"records": int(20000 * scale), "length": 1000}
+    path = write_fasta(os.path.join(work_dir, "ingest.fasta"),
+                       synthetic_records(params["records"], params["length"], 0.1))
+    return params, path
+
+
+def _run_ingest(path):
+    from fasta_ingest import ingest_to_file
+    with open(path, "rb") as f:
+        out_path, _ = ingest_to_file([f])
+    os.remove(out_path)
+
+
+def _setup_hit_parsing(work_dir, scale):
+    import pandas as pd
+    params = {"rows": int(500000 * scale)}
+    rows = params["rows"]
+    rng = np.random.default_rng(0)
+    ends = rng.integers(50, 500, rows)
+    pd.DataFrame({
+        "qseqid": np.char.add("q", (np.arange(rows) // 50).astype(str)),
+        "sseqid": np.char.add("s", rng.integers(0, 100000, rows).astype(str)),
+        "pident": rng.uniform(70, 100, rows).round(3), "length": ends, "mismatch": rng.integers(0, 20, rows),
+        "gapopen": rng.integers(0, 5, rows), "qstart": 1, "qend": ends, "sstart": 1, "send": ends,
+        "evalue": rng.uniform(0, 1e-5, rows), "bitscore": rng.uniform(40, 900, rows).round(1),
+    }).to_csv(os.path.join(work_dir, "hits.tsv"), sep="\t", header=False, index=False, float_format="%.4g")
+    return params, os.path.join(work_dir, "hits.tsv")
+
+
+def _run_hit_parsing(path):
+    from blast_search import read_hits
+    read_hits(path)
+
+
+def _setup_blast(work_dir, scale):
+    params = {"subjects": int(5000 * scale), "length": 1500, "queries": max(1, int(50 * scale)),
+              "divergence": 0.05}
+    subjects = synthetic_records(params["subjects"], params["length"], params["divergence"], seed=1)
+    write_fasta(os.path.join(work_dir, "subjects.fasta"), subjects)
+    db_path = os.path.join(work_dir, "benchdb")
+    subprocess.run(["makeblastdb", "-in", os.path.join(work_dir, "subjects.fasta"), "-dbtype", "nucl",
+                    "-out", db_path], check=True, capture_output=True)
+    rng = np.random.default_rng(2)
+    picked = rng.choice(len(subjects), params["queries"], replace=False)
+    queries = [(f"q{i + 1}", mutate(rng, subjects[k][1][:500], 0.05, NUCLEOTIDES)) for i, k in enumerate(picked)]
+    query_path = write_fasta(os.path.join(work_dir, "queries.fasta"), queries)
+    return params, (query_path, db_path)
+
+
+def _run_blast(state):
+    from blast_search import run_blast
+    from jobs import FAILED, get_queue
+    query_path, db_path = state
+    # run_blast owns (and removes) its query file.
+    fd, copy_path = tempfile.mkstemp(suffix=".fasta")
+    os.close(fd)
+    shutil.copyfile(query_path, copy_path)
+    pool = get_queue()
+    job = pool.get(pool.submit(run_blast, "blastn", copy_path, db_path))
+    job.wait()
+    if job.status == FAILED:
+        raise RuntimeError(job.error)
+
+
+def _setup_msa(work_dir, scale):
+    from aligners import available_aligners
+    params = {"sequences": max(2, int(100 * scale)), "length": 1000, "divergence": 0.1}
+    aligner = available_aligners()[0]
+    params["aligner"] = aligner.name
+    path = write_fasta(os.path.join(work_dir, "msa.fasta"),
+                       synthetic_records(params["sequences"], params["length"], params["divergence"], families=1))
+    return params, (aligner, path)
+
+
+def _run_msa(state):
+    from aligners import run_alignment
+    from jobs import FAILED, get_queue
+    aligner, path = state
+    fd, copy_path = tempfile.mkstemp(suffix=".fasta")
+    os.close(fd)
+    shutil.copyfile(path, copy_path)
+    pool = get_queue()
+    job = pool.get(pool.submit(run_alignment, aligner, copy_path))
+    job.wait()
+    if job.status == FAILED:
+        raise RuntimeError(job.error)
+
+
+def _alignment(scale):
+    from Bio.Align import MultipleSeqAlignment
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
+    params = {"sequences": max(2, int(200 * scale)), "length": 5000, "divergence": 0.1}
+    rows = synthetic_alignment(params["sequences"], params["length"], params["divergence"])
+    return params, MultipleSeqAlignment([SeqRecord(Seq(row), id=name) for name, row in rows])
+
+
+def _setup_alignment_stats(work_dir, scale):
+    return _alignment(scale)
+
+
+def _run_alignment_stats(alignment):
+    from alignment_stats import compute_alignment_stats
+    compute_alignment_stats(alignment)
+
+
+def _setup_with_stats(work_dir, scale):
+    from alignment_stats import compute_alignment_stats
+    params, alignment = _alignment(scale)
+    return params, (alignment, compute_alignment_stats(alignment))
+
+
+def _setup_extend_stats(work_dir, scale):
+    from Bio.Align import MultipleSeqAlignment
+    from alignment_stats import compute_alignment_stats
+    params, alignment = _alignment(scale)
+    params["added"] = 5
+    base = MultipleSeqAlignment(list(alignment)[:-params["added"]])
+    return params, (compute_alignment_stats(base), alignment)
+
+
+def _run_extend_stats(state):
+    from alignment_stats import extend_alignment_stats
+    extend_alignment_stats(*state)
+
+
+def _run_identity_heatmap(state):
+    from figures import render
+    from msa import plot_identity_heatmap
+    render(plot_identity_heatmap(state[1]))
+
+
+def _run_neighbor_joining(state):
+    from phylogeny import KIMURA, tree_newick
+    _, stats = state
+    tree_newick(stats, KIMURA)
+
+
+def _run_format_alignment(state):
+    from msa import format_alignment_with_symbols
+    _, stats = state
+    format_alignment_with_symbols(stats)
+
+
+def _run_alignment_window(state):
+    from alignment_view import overview, window_html
+    stats = state[1]
+    window_html(stats, 0, 120, 0, 40)
+    overview(stats, window=(0, 120))
+
+
+def _setup_dotplot(work_dir, scale):
+    params = {"length": int(200000 * scale), "divergence": 0.05}
+    (_, seq1), (_, seq2) = synthetic_records(2, params["length"], params["divergence"], families=1)
+    return params, (seq1, seq2)
+
+
+def _run_dotplot(state):
+    import matplotlib.pyplot as plt
+    from dotplot import compute_dotplot, draw_dotplot
+    from figures import render
+    counts, extent, _ = compute_dotplot(*state)
+    fig, ax = plt.subplots()
+    draw_dotplot(ax, counts, extent)
+    render(fig)
+
+
+def _setup_clustering(work_dir, scale):
+    params = {"sequences": max(10, int(2000 * scale)), "length": 1000, "divergence": 0.02, "identity": 0.9}
+    records = synthetic_records(params["sequences"], params["length"], params["divergence"])
+    return params, ([(name, seq.encode()) for name, seq in records], params["identity"])
+
+
+def _run_clustering(state):
+    from seq_clusters import cluster_sequences
+    records, identity = state
+    cluster_sequences(records, identity)
+
+
+def _setup_plot_rendering(work_dir, scale):
+    params = {"values": int(1000000 * scale), "formats": ["png", "svg"]}
+    return params, np.random.default_rng(0).uniform(70, 100, params["values"])
+
+
+def _run_plot_rendering(values):
+    from blast import plot_histogram
+    from figures import render
+    for fmt in ("png", "svg"):
+        render(plot_histogram(values, "skyblue", "% Identity Distribution", "% Identity"), fmt)
+
+
+_COLD_START = ("import sys\n"
+               "from streamlit.testing.v1 import AppTest\n"
+               "at = AppTest.from_file('app.py', default_timeout=120)\n"
+               "at.run()\n"
+               "sys.exit(1 if at.exception else 0)\n")
+
+
+def _setup_app_cold_start(work_dir, scale):
+    return {"page": "BLAST"}, os.path.dirname(os.path.abspath(__file__))
+
+
+def _run_app_cold_start(repo_dir):
+    # A fresh interpreter each time: imports and the first script run.
+    subprocess.run([sys.executable, "-c", _COLD_START], cwd=repo_dir, check=True, capture_output=True)
+
+
+def _setup_app_rerun(work_dir, scale):
+    from streamlit.testing.v1 import AppTest
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(repo_dir)  # the app opens its images by relative path
+    app = AppTest.from_file(os.path.join(repo_dir, "app.py"), default_timeout=120)
+    app.run()
+    app.sidebar.radio[0].set_value("About").run()
+    return {"page": "About - Project"}, app
+
+
+def _run_app_rerun(app):
+    app.run()
+
+
+class Case(NamedTuple):
+    setup: Callable
+    run: Callable
+    tools: tuple = ()
+    repeat: int = 3
+
+
+CASES = {
+    "fasta_ingest": Case(_setup_ingest, _run_ingest),
+    "hit_parsing": Case(_setup_hit_parsing, _run_hit_parsing),
+    "blast_end_to_end": Case(_setup_blast, _run_blast, tools=("makeblastdb", "blastn")),
+    "msa_end_to_end": Case(_setup_msa, _run_msa, tools=("clustalo|mafft|muscle",), repeat=1),
+    "alignment_stats": Case(_setup_alignment_stats, _run_alignment_stats),
+    "identity_heatmap": Case(_setup_with_stats, _run_identity_heatmap),
+    "extend_alignment_stats": Case(_setup_extend_stats, _run_extend_stats),
+    "neighbor_joining": Case(_setup_with_stats, _run_neighbor_joining),
+    "format_alignment": Case(_setup_with_stats, _run_format_alignment),
+    "alignment_window": Case(_setup_with_stats, _run_alignment_window),
+    "dotplot": Case(_setup_dotplot, _run_dotplot),
+    "redundancy_clustering": Case(_setup_clustering, _run_clustering),
+    "app_cold_start": Case(_setup_app_cold_start, _run_app_cold_start),
+    "app_rerun": Case(_setup_app_rerun, _run_app_rerun),
+    "plot_rendering": Case(_setup_plot_rendering, _run_plot_rendering),
+}
+
+
+def _missing_tools(case):
+    missing = []
+    for tool in case.tools:
+        if not any(shutil.which(name) for name in tool.split("|")):
+            missing.append(tool)
+    return missing
+
+
+def _rss_mb(rusage):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return round(rusage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _measure(name, scale, repeat, results):
+    """Child process: set up case `name`, time `repeat` runs and send the figures back."""
+    case = CASES[name]
+    work_dir = tempfile.mkdtemp(prefix="mangodb-bench-")
+    try:
+        params, state = case.setup(work_dir, scale)
+        case.run(state)  # warm-up: imports, caches, page-ins
+        walls = []
+        self_start = resource.getrusage(resource.RUSAGE_SELF)
+        children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            case.run(state)
+            walls.append(time.perf_counter() - start)
+        self_end = resource.getrusage(resource.RUSAGE_SELF)
+        children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        results.put({
+            "params": params,
+            "repeat": repeat,
+            "wall_s": [round(wall, 4) for wall in walls],
+            "wall_median_s": round(statistics.median(walls), 4),
+            "cpu_s": round((self_end.ru_utime + self_end.ru_stime - self_start.ru_utime - self_start.ru_stime)
+                           / repeat, 4),
+            "children_cpu_s": round((children_end.ru_utime + children_end.ru_stime
+                                     - children_start.ru_utime - children_start.ru_stime) / repeat, 4),
+            "peak_rss_mb": _rss_mb(self_end),
+            "children_peak_rss_mb": _rss_mb(children_end),
+        })
+    except Exception as e:
+        results.put({"error": f"{type(e).__name__}: {e}"})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_cases(names, scale="medium", repeat=None):
+    """Run the benchmark cases `names`, each in a spawned process; returns the report."""
+    context = multiprocessing.get_context("spawn")
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scale": scale,
+        "cases": {},
+    }
+    for name in names:
+        case = CASES[name]
+        missing = _missing_tools(case)
+        if missing:
+            report["cases"][name] = {"skipped": f"not installed: {', '.join(missing)}"}
+            print(f"{name}: skipped ({', '.join(missing)} not installed)")
+            continue
+        results = context.Queue()
+        process = context.Process(target=_measure, args=(name, SCALES[scale], repeat or case.repeat, results))
+        process.start()
+        while True:
+            try:
+                result = results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not process.is_alive():
+                    result = {"error": f"benchmark process exited with code {process.exitcode}"}
+                    break
+        process.join()
+        report["cases"][name] = result
+        if "error" in result:
+            print(f"{name}: failed ({result['error']})")
+        else:
+            print(f"{name}: {result['wall_median_s']:.3f} s wall, {result['cpu_s']:.3f} s CPU "
+                  f"(+{result['children_cpu_s']:.3f} s children), {result['peak_rss_mb']} MB peak RSS")
+    return report
+
+
+def _git_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def compare_reports(old, new):
+    """`[(case, old median, new median, new/old)]` for cases timed in both reports."""
+    rows = []
+    for name, result in new["cases"].items():
+        before = old["cases"].get(name, {})
+        if "wall_median_s" in result and "wall_median_s" in before:
+            ratio = result["wall_median_s"] / before["wall_median_s"] if before["wall_median_s"] else float("inf")
+            rows.append((name, before["wall_median_s"], result["wall_median_s"], ratio))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the BLAST, MSA and statistics code on synthetic data.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run the benchmarks and write a JSON report")
+    run.add_argument("--scale", choices=SCALES, default="medium", help="input sizes")
+    run.add_argument("--only", help=f"comma-separated cases out of: {', '.join(CASES)}")
+    run.add_argument("--repeat", type=int, help="timed runs per case (default: per case)")
+    run.add_argument("--out", default="benchmark.json")
+
+    compare = commands.add_parser("compare", help="compare the wall times of two reports")
+    compare.add_argument("old")
+    compare.add_argument("new")
+
+    generate = commands.add_parser("generate", help="write a synthetic FASTA file")
+    generate.add_argument("out")
+    generate.add_argument("--type", choices=["nucl", "prot"], default="nucl")
+    generate.add_argument("--count", type=int, default=100)
+    generate.add_argument("--length", type=int, default=1000)
+    generate.add_argument("--divergence", type=float, default=0.1)
+    generate.add_argument("--families", type=int, help="ancestral sequences (default: one per 10 records)")
+    generate.add_argument("--aligned", action="store_true", help="write aligned rows with gaps instead")
+    generate.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        names = args.only.split(",") if args.only else list(CASES)
+        unknown = [name for name in names if name not in CASES]
+        if unknown:
+            parser.error(f"unknown case(s): {', '.join(unknown)}")
+        report = run_cases(names, args.scale, args.repeat)
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.out}")
+    elif args.command == "compare":
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        print(f"{'case':<20} {'old (s)':>10} {'new (s)':>10} {'new/old':>8}")
+        for name, before, after, ratio in compare_reports(old, new):
+            print(f"{name:<20} {before:>10.3f} {after:>10.3f} {ratio:>8.2f}")
+    else:
+        alphabet = NUCLEOTIDES if args.type == "nucl" else AMINO_ACIDS
+        if args.aligned:
+            records = synthetic_alignment(args.count, args.length, args.divergence, alphabet=alphabet, seed=args.seed)
+        else:
+            records = synthetic_records(args.count, args.length, args.divergence, alphabet, args.families, args.seed)
+        write_fasta(args.out, records)
+        print(f"Wrote {len(records)} record(s) to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,25 @@
 import streamlit as st
-import subprocess
-import tempfile
 import os
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import io
+import time
+import metrics
+from blast_search import DB_DIR, all_db_label, resolve_db_path
+from db_catalog import NUCL, PROT, get_catalog
+from blast_batch import CHUNK_RECORDS, PREVIEW_ROWS, discard_batch, submit_batch
+from kmer_index import MAX_MISMATCHES, MAX_QUERY_LENGTH, read_fasta, search_datasets
+from fasta_ingest import FastaError, ingest_to_file, sniff_sequence_type
+from jobs import CANCELLED, DONE, FAILED, QUEUED, get_queue
+from job_client import JobNotFound, get_backend
+from job_service import BLAST, COMPARE
+from figures import data_key, figure_bytes, show_figure
+from hit_table import COVERAGE, HitFilter, csv_file, filter_hits, page, parquet_bytes
+from seq_stats import SUBJECT_LENGTH
+from seq_retrieval import hit_sequences_fasta
+from comparative import CULTIVAR, METRICS, matrix
+
+# Seconds between reruns while a submitted job is still queued or running.
+POLL_INTERVAL = 1.0
 
 def blast_ui():
     #st.image("logo.png", width=150)
@@ -23,133 +37,454 @@ def blast_ui():
     uploaded_file = st.file_uploader("Upload your FASTA file", type=["fasta", "fa"])
     sequence_text = st.text_area("Or paste your FASTA sequence here", height=200)
 
-    blast_type = st.selectbox("Select BLAST type", ["blastn", "blastp"])
+    if sequence_text.strip():
+        sources = [sequence_text]
+    elif uploaded_file:
+        sources = [uploaded_file]
+    else:
+        sources = []
+    # Default to the program matching the query; the full check runs on submit.
+    detected = sniff_sequence_type(sources)
+    blast_type = st.selectbox("Select BLAST type", ["blastn", "blastp"], index=1 if detected == PROT else 0)
+    if detected is not None:
+        st.caption(f"Query looks like {'protein' if detected == PROT else 'nucleotide'} sequence.")
 
     # Get DBs
-    db_dir = "db"
-    db_files = os.listdir(db_dir)
-    db_suffix = ".nsq" if blast_type == "blastn" else ".psq"
-    label = "All Genomes" if blast_type == "blastn" else "All Proteomes"
+    db_dir = DB_DIR
+    dbtype = NUCL if blast_type == "blastn" else PROT
+    label = all_db_label(blast_type)
+    all_db = os.path.basename(resolve_db_path(blast_type, label, db_dir))
+    databases = {info.name: info for info in get_catalog(db_dir).databases(dbtype)}
 
     # Build DB list
-    db_names = sorted({f.split(".")[0] for f in db_files if f.endswith(db_suffix)})
-    if label not in db_names:
-        db_names.insert(0, label)  # Prepend 'All' option
+    db_names = sorted(name for name in databases if name != all_db)
+    db_names.insert(0, label)  # Prepend 'All' option
     db_choice = st.selectbox("Choose Database", db_names, index=0)  # default to 'All'
+    db_info = databases.get(all_db if db_choice == label else db_choice)
+    if db_info is not None:
+        st.caption(f"{db_info.title}: {db_info.num_sequences:,} sequences, "
+                   f"{db_info.total_length:,} {'bp' if dbtype == NUCL else 'residues'}")
+    # E-values are computed against the catalog's database length.
+    dbsize = db_info.total_length if db_info is not None else None
+
+    max_mismatches = 0
+    if blast_type == "blastn":
+        max_mismatches = st.number_input(
+            f"Mismatches allowed when looking up short queries (up to {MAX_QUERY_LENGTH} bp) in the k-mer index",
+            min_value=0, max_value=MAX_MISMATCHES, value=0)
 
-    def gc_content(seq):
-        seq = seq.upper()
-        gc_count = seq.count("G") + seq.count("C")
-        return round(gc_count / len(seq) * 100, 2) if len(seq) > 0 else 0
+    compare_mode = st.checkbox(
+        "Compare cultivars (search every cultivar database and show a gene × cultivar best-hit matrix)")
+    batch_mode = st.checkbox(
+        "Batch mode (many queries: run in parallel chunks and show results query by query)",
+        disabled=compare_mode) and not compare_mode
+    chunk_records = CHUNK_RECORDS
+    if batch_mode:
+        chunk_records = st.number_input("Queries per chunk", min_value=1, value=CHUNK_RECORDS)
+        st.caption("Batch searches always run in this app process, even with a job server configured, "
+                   "and stop if the app restarts.")
 
     run_button = st.button("Run BLAST")
 
     if run_button:
-        if sequence_text.strip():
-            input_data = sequence_text.strip()
-        elif uploaded_file:
-            input_data = uploaded_file.read().decode()
-        else:
+        if not sources:
             st.warning("Please upload a FASTA file or paste a sequence.")
             st.stop()
+        try:
+            with metrics.span("blast.ingest"):
+                query_path, summary = ingest_to_file(sources)
+        except FastaError as e:
+            st.error(f"Invalid FASTA input: {e}")
+            st.stop()
+        if summary.blast_type != blast_type:
+            os.remove(query_path)
+            kind = "protein" if summary.sequence_type == PROT else "nucleotide"
+            st.error(f"The query is a {kind} sequence; use {summary.blast_type} instead of {blast_type}.")
+            st.stop()
+
+        # DB path
+        db_path = resolve_db_path(blast_type, db_choice, db_dir)
 
+        queue = get_queue()
+        discard_previous_search(queue)
+
+    if run_button and batch_mode:
+        with open(query_path) as lines:
+            st.session_state["blast_batch"] = submit_batch(
+                queue, blast_type, lines, db_path, chunk_records=int(chunk_records), dbsize=dbsize,
+                label=f"{blast_type} vs {db_choice}"
+            )
+        os.remove(query_path)
+
+    elif run_button and compare_mode:
+        st.session_state["blast_query_stats"] = (summary.total_length, summary.gc_percent)
+        st.session_state["blast_hits"] = None
+        try:
+            with metrics.span("blast.submit", mode="compare"):
+                st.session_state["blast_job"] = get_backend().submit_compare(query_path, summary, blast_type)
+        except (ValueError, RuntimeError) as e:
+            st.error(f"Error running BLAST:\n{e}")
+
+    elif run_button:
         # Basic stats
-        lines = input_data.splitlines()
-        seq_lines = [line.strip() for line in lines if not line.startswith(">")]
-        query_seq = "".join(seq_lines)
-        seq_len = len(query_seq)
-        gc = gc_content(query_seq)
+        st.session_state["blast_query_stats"] = (summary.total_length, summary.gc_percent)
+
+        # Short single nucleotide queries are answered from the k-mer index
+        # when it has (near-)exact matches; everything else goes to BLAST.
+        index_hits = None
+        if blast_type == "blastn" and summary.num_records == 1 and summary.total_length <= MAX_QUERY_LENGTH:
+            _, query_seq = next(read_fasta(query_path))
+            datasets = None if db_choice == label else [db_choice]
+            with metrics.span("blast.kmer_lookup"):
+                index_hits = search_datasets(query_seq, datasets, int(max_mismatches))
+
+        if index_hits:
+            st.session_state["blast_index_hits"] = pd.DataFrame(index_hits)
+        else:
+            # The backend answers repeated searches from the result cache.
+            st.session_state["blast_hits"] = None
+            try:
+                with metrics.span("blast.submit", mode="search"):
+                    st.session_state["blast_job"] = get_backend().submit_blast(
+                        query_path, summary, blast_type, db_choice)
+            except (ValueError, RuntimeError) as e:
+                st.error(f"Error running BLAST:\n{e}")
+            query_path = None  # the backend owns it now
+        if query_path is not None:
+            os.remove(query_path)
+
+    # Jobs outlive the browser tab; their results can be reopened by ID.
+    with st.expander("Open a BLAST job by ID"):
+        opened = st.text_input("Job ID", key="blast_open_job").strip()
+        if st.button("Open job", key="blast_open_button") and opened:
+            discard_previous_search(get_queue())
+            st.session_state["blast_query_stats"] = None
+            st.session_state["blast_job"] = opened
 
+    if "blast_batch" in st.session_state:
+        render_blast_batch(st.session_state["blast_batch"])
+        return
+    if "blast_query_stats" not in st.session_state:
+        return
+    if st.session_state["blast_query_stats"] is not None:
+        seq_len, gc = st.session_state["blast_query_stats"]
         st.markdown(f"**Query sequence length:** {seq_len} bp")
         st.markdown(f"**GC content:** {gc} %")
-        st.info("Running BLAST, please wait...")
 
-        with tempfile.NamedTemporaryFile(mode='w+', delete=False) as query_file:
-            query_file.write(input_data)
-            query_file.flush()
+    if "blast_index_hits" in st.session_state:
+        render_index_hits(st.session_state["blast_index_hits"])
+        return
+
+    job_id = st.session_state.get("blast_job")
+    if job_id:
+        st.caption(f"Job ID: `{job_id}`")
+        df = st.session_state["blast_hits"] = wait_for_blast_job(job_id)
+    else:
+        df = st.session_state.get("blast_hits")
+    if df is not None and st.session_state.get("blast_job_info", (BLAST,))[0] == COMPARE:
+        with metrics.span("blast.render", mode="compare"):
+            render_comparison(df, st.session_state["blast_job_info"][1])
+    elif df is not None:
+        with metrics.span("blast.render", mode="search"):
+            render_blast_results(df)
+
+
+def wait_for_blast_job(job_id):
+    """Render the state of a submitted BLAST job and return its hits once done.
+
+    While the job is queued or running this polls by rerunning the script.
+    """
+    backend = get_backend()
+    try:
+        job = backend.status(job_id)
+    except JobNotFound:
+        st.warning("This BLAST job has expired. Please run the search again.")
+        st.session_state["blast_job"] = None
+        return None
+
+    if job["kind"] not in (BLAST, COMPARE):
+        st.warning(f"Job {job_id} is not a BLAST search.")
+        st.session_state["blast_job"] = None
+        return None
+    hits = None
+    if job["status"] == DONE:
+        with metrics.span("blast.load_result"):
+            hits = backend.result(job_id)
+    if hits is None and job["status"] not in (CANCELLED, FAILED):
+        if job["status"] == QUEUED:
+            st.info(f"BLAST job queued ({job['position']} job(s) ahead), please wait...")
+        else:
+            st.info(f"Running BLAST, please wait... ({job['elapsed']:.0f} s)")
+        if st.button("Cancel BLAST"):
+            backend.cancel(job_id)
+            st.rerun()
+        time.sleep(POLL_INTERVAL)
+        st.rerun()
+
+    st.session_state["blast_job"] = None
+    st.session_state["blast_job_info"] = (job["kind"], job["params"])
+    if job["status"] == CANCELLED:
+        st.warning("BLAST search cancelled.")
+        return None
+    if job["status"] == FAILED:
+        st.error("Error running BLAST:\n" + (job["error"] or ""))
+        return None
+    return hits
+
+
+def discard_previous_search(queue):
+    """Cancel this session's previous search, single or batch, before a new one."""
+    job_id = st.session_state.pop("blast_job", None)
+    if job_id:
+        try:
+            get_backend().cancel(job_id)
+        except JobNotFound:
+            pass
+    batch = st.session_state.pop("blast_batch", None)
+    if batch:
+        discard_batch(queue, *batch)
+    st.session_state.pop("blast_query_stats", None)
+    st.session_state.pop("blast_hits", None)
+    st.session_state.pop("blast_index_hits", None)
+    st.session_state.pop("blast_job_info", None)
+
 
-            blast_output = tempfile.NamedTemporaryFile(mode='w+', delete=False)
+def render_index_hits(df):
+    st.success(f"Found {len(df)} exact/near-exact match(es) in the k-mer index.")
+    st.subheader("Index Matches")
+    st.dataframe(df)
+    st.download_button(
+        label="Download Matches (CSV)",
+        data=df.to_csv(index=False),
+        file_name="index_matches.csv",
+        mime="text/csv"
+    )
 
-            # DB path
-            db_path = os.path.join(db_dir, label.replace(" ", "_").lower()) if db_choice == label else os.path.join(db_dir, db_choice)
 
-            result = subprocess.run(
-                [blast_type, "-query", query_file.name, "-db", db_path,
-                "-outfmt", "6", "-evalue", "1e-5", "-out", blast_output.name],
-                capture_output=True, text=True
+def render_blast_batch(batch):
+    """Render a batch's progress, per-query summary and histograms so far."""
+    queue = get_queue()
+    work_dir, progress, job_ids = batch
+    jobs = [job for job in (queue.get(job_id) for job_id in job_ids) if job is not None]
+    running = any(not job.is_finished for job in jobs)
+    failed = [job for job in jobs if job.status == FAILED]
+
+    st.progress(progress.fraction,
+                text=f"{progress.queries_done} / {progress.total_queries} queries searched, "
+                     f"{progress.hit_count} hits")
+    if failed:
+        st.error("Error running BLAST:\n" + (failed[0].error or ""))
+    if running and st.button("Cancel BLAST"):
+        for job_id in job_ids:
+            queue.cancel(job_id)
+        st.rerun()
+    if not running and not failed:
+        st.success("BLAST completed.")
+
+    st.subheader("Per-query Summary")
+    st.dataframe(progress.summary_frame())
+    st.subheader(f"Latest Hits (up to {PREVIEW_ROWS})")
+    st.dataframe(progress.recent_frame())
+
+    if progress.hit_count:
+        st.subheader("Alignment Statistics Plots")
+        colors = {"% Identity": "skyblue", "-log10(E-value)": "salmon", "Bit Score": "lightgreen"}
+        for name, (edges, counts) in progress.histograms().items():
+            # Redrawn only when the counts change between polls.
+            st.image(figure_bytes(data_key("batch", name, counts),
+                                  lambda: plot_binned_histogram(name, edges, counts, colors[name])))
+
+    if running:
+        time.sleep(POLL_INTERVAL)
+        st.rerun()
+
+    progress.close()
+    if progress.hit_count and os.path.exists(progress.spool_path):
+        with open(progress.spool_path, "rb") as f:
+            st.download_button(
+                label="Download All Hits (TSV)",
+                data=f,
+                file_name="blast_batch_results.tsv",
+                mime="text/tab-separated-values"
             )
 
-            if result.returncode != 0:
-                st.error("Error running BLAST:\n" + result.stderr)
-            else:
-                output_text = open(blast_output.name).read()
-                if not output_text.strip():
-                    st.warning("No hits found.")
-                else:
-                    st.success("BLAST completed.")
-
-                    colnames = ["Query ID", "Subject ID", "% Identity", "Alignment Length", "Mismatches",
-                                "Gap Openings", "Query Start", "Query End", "Subject Start", "Subject End",
-                                "E-value", "Bit Score"]
-                    df = pd.read_csv(blast_output.name, sep="\t", names=colnames)
-
-                    st.subheader("BLAST Hits Table")
-                    st.dataframe(df)
-
-                    # Download raw & parsed
-                    #st.download_button(
-                    #    label="Download Raw BLAST Output",
-                    #    data=output_text,
-                    #    file_name="blast_output.tsv",
-                    #    mime="text/tab-separated-values"
-                    #)
-                    csv_buffer = df.to_csv(index=False)
-                    st.download_button(
-                        label="Download Parsed Results (CSV)",
-                        data=csv_buffer,
-                        file_name="blast_results.csv",
-                        mime="text/csv"
-                    )
-
-                    st.subheader("Alignment Statistics Plots")
-
-                    def save_and_show_plot(fig, title, filename):
-                        st.pyplot(fig)
-                        buf = io.BytesIO()
-                        fig.savefig(buf, format='png')
-                        buf.seek(0)
-                        st.download_button(
-                            label=f"Download {title} as PNG",
-                            data=buf,
-                            file_name=filename,
-                            mime="image/png"
-                        )
-
-                    # 1. Identity %
-                    fig1, ax1 = plt.subplots(figsize=(10, 5))
-                    ax1.hist(df["% Identity"], bins=20, color="skyblue", edgecolor="black")
-                    ax1.set_title("% Identity Distribution")
-                    ax1.set_xlabel("% Identity")
-                    ax1.set_ylabel("Count")
-                    plt.tight_layout()
-                    save_and_show_plot(fig1, "Identity Plot", "percent_identity.png")
-
-                    # 2. E-value (-log10)
-                    fig2, ax2 = plt.subplots(figsize=(10, 5))
-                    evalues = df["E-value"].replace(0, 1e-180)
-                    ax2.hist(-np.log10(evalues), bins=20, color="salmon", edgecolor="black")
-                    ax2.set_title("Log10(E-value) Distribution")
-                    ax2.set_xlabel("-log10(E-value)")
-                    ax2.set_ylabel("Count")
-                    plt.tight_layout()
-                    save_and_show_plot(fig2, "E-value Plot", "evalue_log10.png")
-
-                    # 3. Bit Score
-                    fig3, ax3 = plt.subplots(figsize=(10, 5))
-                    ax3.hist(df["Bit Score"], bins=20, color="lightgreen", edgecolor="black")
-                    ax3.set_title("Bit Score Distribution")
-                    ax3.set_xlabel("Bit Score")
-                    ax3.set_ylabel("Count")
-                    plt.tight_layout()
-                    save_and_show_plot(fig3, "Bit Score Plot", "bit_score.png")
 
+def plot_binned_histogram(name, edges, counts, color):
+    import matplotlib.pyplot as plt  # only once a plot is drawn
+    fig, ax = plt.subplots(figsize=(10, 5))
+    ax.stairs(counts, edges, fill=True, color=color, edgecolor="black")
+    if name == "Bit Score":
+        ax.set_xscale("log")
+    ax.set_title(f"{name} Distribution")
+    ax.set_xlabel(name)
+    ax.set_ylabel("Count")
+    fig.tight_layout()
+    return fig
+
+
+def render_blast_results(df):
+    if df.empty:
+        st.warning("No hits found.")
+        return
+    st.success("BLAST completed.")
+    blast_hits_viewer(df)
+
+
+@st.fragment
+def blast_hits_viewer(df):
+    """Filtered, paged hit table with its downloads and plots.
+
+    Runs as a fragment: changing a filter or page reruns just this section.
+    Only the current page is sent to the browser; the downloads are built
+    when clicked.
+    """
+    st.subheader("BLAST Hits Table")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        min_identity = st.number_input("Min % identity", min_value=0.0, max_value=100.0, value=0.0)
+        min_bitscore = st.number_input("Min bit score", min_value=0.0, value=0.0)
+    with col2:
+        max_evalue = st.text_input("Max E-value", value="", placeholder="e.g. 1e-10")
+        min_coverage = st.number_input("Min query coverage %", min_value=0.0, max_value=100.0, value=0.0,
+                                       disabled=COVERAGE not in df.columns)
+    with col3:
+        top = st.number_input("Best hits per query (0 = all)", min_value=0, value=0)
+        page_size = st.selectbox("Rows per page", [50, 100, 500, 1000], index=1)
+    try:
+        max_evalue = float(max_evalue) if max_evalue.strip() else None
+    except ValueError:
+        st.error("Max E-value must be a number.")
+        max_evalue = None
+
+    df = filter_hits(df, HitFilter(min_identity, max_evalue, min_bitscore, min_coverage, int(top)))
+    pages = max(1, -(-len(df) // page_size))
+    number = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1)
+    rows, _ = page(df, int(number), page_size)
+    st.caption(f"{len(df):,} hits match the filters.")
+    if SUBJECT_LENGTH in df.columns:
+        st.caption("Subject length, coverage and percentiles are relative to every sequence "
+                   "of the searched database.")
+    st.dataframe(rows)
+
+    # Download raw & parsed
+    #st.download_button(
+    #    label="Download Raw BLAST Output",
+    #    data=output_text,
+    #    file_name="blast_output.tsv",
+    #    mime="text/tab-separated-values"
+    #)
+    st.download_button(
+        label="Download Parsed Results (CSV)",
+        data=lambda: csv_file(df),
+        file_name="blast_results.csv",
+        mime="text/csv",
+        on_click="ignore"
+    )
+    st.download_button(
+        label="Download Parsed Results (Parquet)",
+        data=lambda: parquet_bytes(df),
+        file_name="blast_results.parquet",
+        mime="application/vnd.apache.parquet",
+        on_click="ignore"
+    )
+    kind, params = st.session_state.get("blast_job_info", (None, None))
+    if kind == BLAST and not df.empty:
+        program, db_choice = params["program"], params["database"]
+        regions = st.radio("Subject sequences", ["Aligned regions", "Whole subjects"], horizontal=True)
+        st.download_button(
+            label="Download Subject Sequences (FASTA)",
+            data=lambda: hit_sequences_fasta(df, resolve_db_path(program, db_choice),
+                                             NUCL if program == "blastn" else PROT,
+                                             aligned=regions == "Aligned regions"),
+            file_name="blast_subjects.fasta",
+            mime="text/x-fasta",
+            on_click="ignore"
+        )
+    if df.empty:
+        return
+
+    st.subheader("Alignment Statistics Plots")
+
+    # 1. Identity %
+    identities = df["% Identity"].to_numpy()
+    show_figure(data_key("identity", identities),
+                lambda: plot_histogram(identities, "skyblue", "% Identity Distribution", "% Identity"),
+                "Identity Plot", "percent_identity")
+
+    # 2. E-value (-log10)
+    log_evalues = -np.log10(np.maximum(df["E-value"].to_numpy(), 1e-180))
+    show_figure(data_key("evalue", log_evalues),
+                lambda: plot_histogram(log_evalues, "salmon", "Log10(E-value) Distribution", "-log10(E-value)"),
+                "E-value Plot", "evalue_log10")
+
+    # 3. Bit Score
+    bitscores = df["Bit Score"].to_numpy()
+    show_figure(data_key("bitscore", bitscores),
+                lambda: plot_histogram(bitscores, "lightgreen", "Bit Score Distribution", "Bit Score"),
+                "Bit Score Plot", "bit_score")
+
+
+def plot_histogram(values, color, title, xlabel):
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(10, 5))
+    ax.hist(values, bins=20, color=color, edgecolor="black")
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel("Count")
+    fig.tight_layout()
+    return fig
+
+
+def render_comparison(comparison, params):
+    """Gene × cultivar matrix of a cross-cultivar comparison, with heatmap and downloads."""
+    if comparison.empty:
+        st.warning("No hits found in any cultivar.")
+        return
+    st.success("Cultivar comparison completed.")
+    cultivars = params["cultivars"]
+    genes = comparison["Query ID"].nunique()
+    in_all = int((comparison.groupby("Query ID", observed=True)[CULTIVAR].nunique() == len(cultivars)).sum())
+    st.caption(f"{genes:,} of {params['queries']:,} queries have hits; {in_all:,} in all {len(cultivars)} cultivars.")
+
+    metric = st.selectbox("Best-hit value", METRICS)
+    table = matrix(comparison, metric, cultivars=cultivars)
+    st.subheader(f"Best {metric} per Gene and Cultivar")
+    st.dataframe(table)
+    show_figure(data_key("compare", metric, table.to_numpy(), cultivars),
+                lambda: plot_comparison_heatmap(table, metric),
+                "Heatmap", f"cultivar_{metric.replace(' ', '_').replace('%', 'pct').lower()}")
+    st.download_button(
+        label="Download Comparison (Parquet)",
+        data=lambda: parquet_bytes(comparison),
+        file_name="cultivar_comparison.parquet",
+        mime="application/vnd.apache.parquet",
+        on_click="ignore"
+    )
+    st.download_button(
+        label=f"Download {metric} Matrix (CSV)",
+        data=lambda: table.to_csv(),
+        file_name="cultivar_matrix.csv",
+        mime="text/csv",
+        on_click="ignore"
+    )
+
+
+def plot_comparison_heatmap(table, metric):
+    values = table.to_numpy(dtype=float)
+    if metric == "E-value":
+        values = -np.log10(np.maximum(values, 1e-180))
+        metric = "-log10(E-value)"
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(max(6, len(table.columns) * 1.2), min(20, 3 + len(table) * 0.25)))
+    image = ax.imshow(np.ma.masked_invalid(values), aspect="auto", cmap="viridis", interpolation="nearest")
+    ax.set_xticks(range(len(table.columns)))
+    ax.set_xticklabels(table.columns, rotation=45, ha="right")
+    if len(table) <= 60:
+        ax.set_yticks(range(len(table)))
+        ax.set_yticklabels(table.index)
+    else:
+        ax.set_ylabel(f"{len(table):,} genes")
+    fig.colorbar(image, ax=ax, label=metric)
+    ax.set_title(f"Best {metric} per Gene and Cultivar")
+    fig.tight_layout()
+    return fig
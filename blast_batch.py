@@ -0,0 +1,205 @@
+"""Batch BLAST: chunked, parallel multi-query searches with streamed results.
+
+A large multi-FASTA query is split into chunk files while it is read, each
+chunk runs as its own job on the shared worker pool, and the outfmt 6 lines
+are folded into a `BatchProgress` as BLAST prints them. Only per-query
+summaries, fixed-bin histograms and a bounded preview of recent hits stay in
+memory; every hit is appended to a TSV spool on disk for download.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from blast_search import COLNAMES, DEFAULT_EVALUE, build_blast_command, typed_hits
+
+CHUNK_RECORDS = int(os.environ.get("MANGODB_BATCH_CHUNK_RECORDS", 50))
+PREVIEW_ROWS = 500
+
+# Work directories a session left behind without `discard_batch` (closed
+# tab, reload mid-batch) are removed this many seconds after their last write.
+BATCH_TTL = int(os.environ.get("MANGODB_BATCH_TTL", 86400))
+WORK_DIR_PREFIX = "mangodb-batch-"
+
+# Fixed bin edges so histograms can be accumulated hit by hit.
+IDENTITY_BINS = np.linspace(0, 100, 21)
+EVALUE_BINS = np.linspace(0, 180, 37)  # -log10(E-value); 0 is clipped to 1e-180
+BITSCORE_BINS = np.logspace(0, 5, 41)
+
+SUMMARY_COLUMNS = ["Query ID", "Hits", "Best Subject", "Best % Identity", "Best E-value", "Top Bit Score"]
+
+
+def split_fasta(lines, out_dir, chunk_records=CHUNK_RECORDS):
+    """Write FASTA `lines` to chunk files of at most `chunk_records` records.
+
+    Reads one line at a time, so the input is never held in memory as a
+    whole. Returns `[(path, [query IDs in order]), ...]`.
+    """
+    chunks = []
+    out = None
+    ids = []
+    for line in lines:
+        if line.startswith(">"):
+            if out is None or len(ids) >= chunk_records:
+                if out is not None:
+                    out.close()
+                    chunks.append((out.name, ids))
+                out = open(os.path.join(out_dir, f"chunk{len(chunks):05d}.fasta"), "w")
+                ids = []
+            words = line[1:].split()
+            ids.append(words[0] if words else "")
+        elif out is None:
+            continue  # text before the first header is not part of any record
+        out.write(line if line.endswith("\n") else line + "\n")
+    if out is not None:
+        out.close()
+        chunks.append((out.name, ids))
+    return chunks
+
+
+class BatchProgress:
+    """Thread-safe accumulator fed by the chunk jobs of one batch."""
+
+    def __init__(self, chunks, spool_path):
+        self.total_queries = sum(len(ids) for _, ids in chunks)
+        self.spool_path = spool_path
+        self.hit_count = 0
+        self.summary = {}  # query ID -> [hits, best subject, identity, evalue, bitscore]
+        self.recent = deque(maxlen=PREVIEW_ROWS)
+        self.identity_counts = np.zeros(len(IDENTITY_BINS) - 1, dtype=np.int64)
+        self.evalue_counts = np.zeros(len(EVALUE_BINS) - 1, dtype=np.int64)
+        self.bitscore_counts = np.zeros(len(BITSCORE_BINS) - 1, dtype=np.int64)
+        self._index = [{query_id: i for i, query_id in enumerate(ids)} for _, ids in chunks]
+        self._done = [0] * len(chunks)
+        self._lock = threading.Lock()
+        self._spool = open(spool_path, "w")
+
+    @property
+    def queries_done(self):
+        return sum(self._done)
+
+    @property
+    def fraction(self):
+        return self.queries_done / self.total_queries if self.total_queries else 1.0
+
+    def add_line(self, chunk, line):
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) != len(COLNAMES):
+            return
+        query_id, subject_id = fields[0], fields[1]
+        identity, evalue, bitscore = float(fields[2]), float(fields[10]), float(fields[11])
+        with self._lock:
+            if self._spool.closed:
+                return  # batch was discarded while BLAST was still printing
+            self._spool.write(line)
+            self.hit_count += 1
+            self.recent.append(fields)
+            entry = self.summary.get(query_id)
+            if entry is None:
+                self.summary[query_id] = [1, subject_id, identity, evalue, bitscore]
+            else:
+                entry[0] += 1
+                if bitscore > entry[4]:
+                    entry[1:] = [subject_id, identity, evalue, bitscore]
+            # BLAST reports queries in input order, so earlier ones are finished.
+            position = self._index[chunk].get(query_id)
+            if position is not None and position > self._done[chunk]:
+                self._done[chunk] = position
+            self._add_to_histograms(identity, evalue, bitscore)
+
+    def finish_chunk(self, chunk):
+        with self._lock:
+            self._done[chunk] = len(self._index[chunk])
+            self._spool.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._spool.closed:
+                self._spool.close()
+
+    def _add_to_histograms(self, identity, evalue, bitscore):
+        log_evalue = -np.log10(max(evalue, 1e-180))
+        for value, edges, counts in ((identity, IDENTITY_BINS, self.identity_counts),
+                                     (log_evalue, EVALUE_BINS, self.evalue_counts),
+                                     (bitscore, BITSCORE_BINS, self.bitscore_counts)):
+            i = int(np.searchsorted(edges, value, side="right")) - 1
+            counts[min(max(i, 0), len(counts) - 1)] += 1
+
+    def summary_frame(self):
+        with self._lock:
+            rows = [[query_id] + entry for query_id, entry in self.summary.items()]
+        return pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+
+    def recent_frame(self):
+        with self._lock:
+            rows = list(self.recent)
+        return typed_hits(pd.DataFrame(rows, columns=COLNAMES))
+
+    def histograms(self):
+        with self._lock:
+            return {
+                "% Identity": (IDENTITY_BINS, self.identity_counts.copy()),
+                "-log10(E-value)": (EVALUE_BINS, self.evalue_counts.copy()),
+                "Bit Score": (BITSCORE_BINS, self.bitscore_counts.copy()),
+            }
+
+
+def run_blast_chunk(job, blast_type, chunk_path, db_path, progress, chunk, evalue=DEFAULT_EVALUE,
+                    dbsize=None):
+    """Job target: BLAST one chunk, streaming its hits into `progress`."""
+    argv = build_blast_command(blast_type, chunk_path, db_path, None, threads=job.threads,
+                               evalue=evalue, dbsize=dbsize)
+    try:
+        for line in job.stream_command(argv):
+            progress.add_line(chunk, line)
+        progress.finish_chunk(chunk)
+    finally:
+        if os.path.exists(chunk_path):
+            os.remove(chunk_path)
+
+
+def submit_batch(queue, blast_type, lines, db_path, threads=1, chunk_records=CHUNK_RECORDS, dbsize=None,
+                 label=""):
+    """Split `lines` into chunks and queue one job per chunk.
+
+    Batch jobs run at a lower priority than interactive searches. Returns
+    `(work_dir, progress, job_ids)`; `work_dir` holds the spool and is
+    removed with `discard_batch`.
+    """
+    sweep_work_dirs()
+    work_dir = tempfile.mkdtemp(prefix=WORK_DIR_PREFIX)
+    chunks = split_fasta(lines, work_dir, chunk_records)
+    progress = BatchProgress(chunks, os.path.join(work_dir, "hits.tsv"))
+    job_ids = [
+        queue.submit(run_blast_chunk, blast_type, path, db_path, progress, i, dbsize=dbsize,
+                     threads=threads, priority=1, label=f"{label} [chunk {i + 1}/{len(chunks)}]")
+        for i, (path, _) in enumerate(chunks)
+    ]
+    return work_dir, progress, job_ids
+
+
+def sweep_work_dirs(ttl=BATCH_TTL, tmp_dir=None):
+    """Remove batch work directories with nothing written for `ttl` seconds."""
+    tmp_dir = tmp_dir or tempfile.gettempdir()
+    cutoff = time.time() - ttl
+    for entry in os.scandir(tmp_dir):
+        if not entry.name.startswith(WORK_DIR_PREFIX) or not entry.is_dir(follow_symlinks=False):
+            continue
+        try:
+            newest = max([entry.stat().st_mtime] + [f.stat().st_mtime for f in os.scandir(entry.path)])
+        except OSError:
+            continue
+        if newest < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def discard_batch(queue, work_dir, progress, job_ids):
+    for job_id in job_ids:
+        queue.cancel(job_id)
+    progress.close()
+    shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,211 @@
+"""BLAST command construction and execution, independent of the UI."""
+import heapq
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from result_cache import ResultCache, make_key
+
+DB_DIR = "db"
+
+# Threads handed to `-num_threads` for each BLAST job; also the share of the
+# worker pool's CPU budget the job reserves.
+BLAST_THREADS = int(os.environ.get("MANGODB_BLAST_THREADS", 2))
+
+DEFAULT_EVALUE = "1e-5"
+
+# Search databases made of several parts (volumes, alias members, or the
+# cultivar databases behind a combined one) one process per part; "0"
+# searches them as a whole.
+SHARDED_SEARCH = os.environ.get("MANGODB_SHARDED_SEARCH", "1") != "0"
+# BLAST's default -max_target_seqs: subjects reported per query.
+MAX_TARGET_SEQS = 500
+
+COLNAMES = ["Query ID", "Subject ID", "% Identity", "Alignment Length", "Mismatches",
+            "Gap Openings", "Query Start", "Query End", "Subject Start", "Subject End",
+            "E-value", "Bit Score"]
+
+# Fixed column types of a hit table. E-values stay float64: float32 would
+# flush the smallest ones to zero.
+HIT_DTYPES = {
+    "Query ID": "category", "Subject ID": "category", "% Identity": "float32",
+    "Alignment Length": "int32", "Mismatches": "int32", "Gap Openings": "int32",
+    "Query Start": "int32", "Query End": "int32", "Subject Start": "int32", "Subject End": "int32",
+    "E-value": "float64", "Bit Score": "float32",
+}
+
+
+# Parsed hit tables of finished searches, shared by every session.
+RESULT_CACHE = ResultCache("blast")
+
+
+def all_db_label(blast_type):
+    return "All Genomes" if blast_type == "blastn" else "All Proteomes"
+
+
+def resolve_db_path(blast_type, db_choice, db_dir=DB_DIR):
+    label = all_db_label(blast_type)
+    if db_choice == label:
+        return os.path.join(db_dir, label.replace(" ", "_").lower())
+    return os.path.join(db_dir, db_choice)
+
+
+def db_fingerprint(db_dir=DB_DIR):
+    """Name, size and mtime of every file in `db_dir`.
+
+    Rebuilding or adding any database changes the fingerprint, which
+    invalidates every cached search against the directory.
+    """
+    entries = []
+    with os.scandir(db_dir) as it:
+        for entry in it:
+            if entry.is_file():
+                st = entry.stat()
+                entries.append((entry.name, st.st_size, st.st_mtime_ns))
+    return sorted(entries)
+
+
+def blast_cache_key(query_digest, blast_type, db_path, evalue=DEFAULT_EVALUE, dbsize=None):
+    """Cache key of a search; `query_digest` is the ingested query's `FastaSummary.digest`."""
+    return make_key(
+        query_digest,
+        blast_type,
+        os.path.realpath(db_path),
+        db_fingerprint(os.path.dirname(db_path) or "."),
+        {"outfmt": "6", "evalue": str(evalue), "dbsize": dbsize},
+    )
+
+
+def build_blast_command(blast_type, query_path, db_path, out_path, threads=1, evalue=DEFAULT_EVALUE,
+                        dbsize=None):
+    """BLAST argv writing outfmt 6 to `out_path` (stdout when None).
+
+    `dbsize` sets the database length used for E-values; pass the catalog's
+    total letters to keep E-values comparable between searches that only
+    cover part of a database.
+    """
+    argv = [blast_type, "-query", query_path, "-db", db_path,
+            "-outfmt", "6", "-evalue", str(evalue), "-num_threads", str(threads)]
+    if out_path is not None:
+        argv += ["-out", out_path]
+    if dbsize:
+        argv += ["-dbsize", str(dbsize)]
+    return argv
+
+
+def typed_hits(df):
+    """`df` with the `HIT_DTYPES` column types."""
+    return df.astype({name: dtype for name, dtype in HIT_DTYPES.items() if name in df.columns})
+
+
+def read_hits(path):
+    """Typed hit table from an outfmt 6 file."""
+    if os.path.getsize(path) == 0:
+        return typed_hits(pd.DataFrame(columns=COLNAMES))
+    return pd.read_csv(path, sep="\t", names=COLNAMES, dtype=HIT_DTYPES)
+
+
+def run_blast(job, blast_type, query_path, db_path, evalue=DEFAULT_EVALUE, dbsize=None, cache_key=None):
+    """Job target: search `query_path` against `db_path` and return the hits.
+
+    The query file belongs to the job and is removed once BLAST has run.
+    When `cache_key` is given the hits are stored in `RESULT_CACHE`.
+    """
+    out_fd, out_path = tempfile.mkstemp(suffix=".tsv")
+    os.close(out_fd)
+    try:
+        argv = build_blast_command(blast_type, query_path, db_path, out_path,
+                                   threads=job.threads, evalue=evalue, dbsize=dbsize)
+        with metrics.span("blast.search", program=blast_type):
+            result = job.run_command(argv)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip() or f"{blast_type} exited with {result.returncode}")
+        with metrics.span("blast.parse"):
+            hits = read_hits(out_path)
+        if cache_key is not None:
+            with metrics.span("blast.cache_put"):
+                RESULT_CACHE.put(cache_key, hits)
+        return hits
+    finally:
+        for path in (query_path, out_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def merge_hits(frames, query_ids, max_target_seqs=MAX_TARGET_SEQS):
+    """Merge the hit tables of a query searched against several shards.
+
+    Duplicate HSPs are dropped and each query keeps the hits of its
+    `max_target_seqs` best subjects (lowest E-value, then highest bit score,
+    picked with a heap), ordered as one search of the whole database would
+    report them: by query in `query_ids` order, then by E-value.
+    """
+    hits = pd.concat([frame.astype({"Query ID": str, "Subject ID": str}) for frame in frames], ignore_index=True)
+    hits = hits.drop_duplicates(subset=["Query ID", "Subject ID", "Query Start", "Query End",
+                                        "Subject Start", "Subject End"])
+    if hits.empty:
+        return typed_hits(hits)
+    queries = hits["Query ID"].to_numpy()
+    subjects = hits["Subject ID"].to_numpy()
+    evalues = hits["E-value"].to_numpy()
+    bitscores = hits["Bit Score"].to_numpy()
+    best = {}  # query -> {subject: (E-value, -bit score)}
+    for query, subject, evalue, bitscore in zip(queries, subjects, evalues, bitscores):
+        ranks = best.setdefault(query, {})
+        rank = (evalue, -bitscore)
+        if subject not in ranks or rank < ranks[subject]:
+            ranks[subject] = rank
+    keep = set()
+    for query, ranks in best.items():
+        for subject in heapq.nsmallest(max_target_seqs, ranks, key=ranks.get):
+            keep.add((query, subject))
+    kept = np.fromiter(((q, s) in keep for q, s in zip(queries, subjects)), dtype=bool, count=len(hits))
+    hits = hits[kept]
+    order = {query_id: i for i, query_id in enumerate(query_ids)}
+    hits = hits.assign(_query=hits["Query ID"].map(order), _bitscore=-hits["Bit Score"])
+    hits = hits.sort_values(["_query", "E-value", "_bitscore"], kind="stable")
+    return typed_hits(hits.drop(columns=["_query", "_bitscore"]).reset_index(drop=True))
+
+
+def run_sharded_blast(job, blast_type, query_path, shard_paths, evalue=DEFAULT_EVALUE, dbsize=None,
+                      cache_key=None):
+    """Job target: search `query_path` against every shard in parallel and merge the hits.
+
+    The job's threads are shared out between the shard processes. `dbsize`
+    should be the whole database's length, so every shard computes E-values
+    as one search would. Like `run_blast`, the query file is removed and the
+    hits stored in `RESULT_CACHE` under `cache_key`.
+    """
+    parallel = min(len(shard_paths), job.threads)
+    threads = max(1, job.threads // parallel)
+    out_paths = []
+    try:
+        argvs = []
+        for shard_path in shard_paths:
+            out_fd, out_path = tempfile.mkstemp(suffix=".tsv")
+            os.close(out_fd)
+            out_paths.append(out_path)
+            argvs.append(build_blast_command(blast_type, query_path, shard_path, out_path,
+                                             threads=threads, evalue=evalue, dbsize=dbsize))
+        with metrics.span("blast.search", program=blast_type, shards=len(shard_paths)):
+            results = job.run_commands(argvs, parallel)
+        for result in results:
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.strip() or f"{blast_type} exited with {result.returncode}")
+        with open(query_path) as f:
+            query_ids = [line[1:].split()[0] for line in f if line.startswith(">") and line[1:].split()]
+        with metrics.span("blast.parse"):
+            frames = [read_hits(path) for path in out_paths]
+        with metrics.span("blast.merge"):
+            hits = merge_hits(frames, query_ids)
+        if cache_key is not None:
+            with metrics.span("blast.cache_put"):
+                RESULT_CACHE.put(cache_key, hits)
+        return hits
+    finally:
+        for path in [query_path] + out_paths:
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,131 @@
+"""Cross-cultivar comparison: every query against every cultivar database.
+
+A batch of genes is searched against each single cultivar database of the
+sequence type (not the combined `all_genomes`/`all_proteomes`), one BLAST
+process per cultivar running in parallel. Each search only needs the best
+hit of every query, so BLAST is asked for a few target sequences instead of
+hundreds. The hit tables are then reduced with vectorized pandas operations
+to a long table with one row per gene and cultivar: the best hit by bit
+score, its identity, E-value and query coverage. `matrix` pivots that into
+a gene x cultivar matrix of one of those values.
+"""
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from blast_search import (DEFAULT_EVALUE, RESULT_CACHE, all_db_label, build_blast_command, db_fingerprint,
+                          read_hits, resolve_db_path)
+from db_catalog import DB_DIR, NUCL, PROT, get_catalog
+from hit_table import COVERAGE
+from result_cache import make_key
+
+# Subjects BLAST reports per query and cultivar; only the best one is kept.
+COMPARE_TARGET_SEQS = 5
+
+CULTIVAR = "Cultivar"
+METRICS = ["% Identity", "Bit Score", COVERAGE, "E-value"]
+COMPARISON_COLUMNS = ["Query ID", CULTIVAR, "Subject ID"] + METRICS
+COMPARISON_DTYPES = {"Query ID": "category", CULTIVAR: "category", "Subject ID": "category",
+                     "% Identity": "float32", "Bit Score": "float32", COVERAGE: "float32", "E-value": "float64"}
+
+
+def cultivar_databases(blast_type, db_dir=DB_DIR):
+    """`{name: path}` of the single cultivar databases searched by `blast_type`.
+
+    Alias databases and the combined all-genomes/proteomes database are left
+    out, so every sequence is searched once per cultivar.
+    """
+    dbtype = NUCL if blast_type == "blastn" else PROT
+    combined = os.path.basename(resolve_db_path(blast_type, all_db_label(blast_type), db_dir))
+    return {info.name: info.path for info in get_catalog(db_dir).databases(dbtype)
+            if info.name != combined and not info.members}
+
+
+def comparison_cache_key(query_digest, blast_type, databases, evalue=DEFAULT_EVALUE, db_dir=DB_DIR):
+    return make_key(query_digest, "compare", blast_type, sorted(databases), db_fingerprint(db_dir),
+                    {"evalue": str(evalue), "max_target_seqs": COMPARE_TARGET_SEQS})
+
+
+def typed_comparison(df):
+    return df.astype({name: dtype for name, dtype in COMPARISON_DTYPES.items() if name in df.columns})
+
+
+def best_hits(hits, query_lengths):
+    """Best hit (highest bit score) of every query in `hits`, with its query coverage."""
+    if hits.empty:
+        return hits.iloc[:0].assign(**{COVERAGE: np.empty(0, dtype=np.float32)})
+    order = np.lexsort((-hits["Bit Score"].to_numpy(), hits["Query ID"].cat.codes.to_numpy()))
+    hits = hits.iloc[order]
+    codes = hits["Query ID"].cat.codes.to_numpy()
+    first = np.r_[True, codes[1:] != codes[:-1]]
+    best = hits[first]
+    lengths = best["Query ID"].astype(str).map(query_lengths).astype("float32").to_numpy()
+    span = np.abs(best["Query End"].to_numpy() - best["Query Start"].to_numpy()) + 1
+    return best.assign(**{COVERAGE: (span / lengths * 100).astype(np.float32)})
+
+
+def compare_hits(hits_by_cultivar, query_lengths):
+    """Long comparison table from `{cultivar: hit table}`, one row per gene and cultivar hit."""
+    frames = []
+    for cultivar, hits in hits_by_cultivar.items():
+        best = best_hits(hits, query_lengths)
+        frames.append(pd.DataFrame({
+            "Query ID": best["Query ID"].astype(str).to_numpy(),
+            CULTIVAR: cultivar,
+            "Subject ID": best["Subject ID"].astype(str).to_numpy(),
+            **{metric: best[metric].to_numpy() for metric in METRICS},
+        }))
+    if not frames:
+        return typed_comparison(pd.DataFrame(columns=COMPARISON_COLUMNS))
+    long = pd.concat(frames, ignore_index=True)
+    order = {query_id: i for i, query_id in enumerate(query_lengths)}
+    long = long.iloc[np.lexsort((long[CULTIVAR].to_numpy(), long["Query ID"].map(order).to_numpy()))]
+    return typed_comparison(long.reset_index(drop=True))
+
+
+def matrix(comparison, metric, query_ids=None, cultivars=None):
+    """Gene x cultivar matrix of `metric`; NaN where a gene has no hit in a cultivar."""
+    table = comparison.pivot(index="Query ID", columns=CULTIVAR, values=metric)
+    index = list(query_ids) if query_ids is not None else list(dict.fromkeys(comparison["Query ID"]))
+    columns = list(cultivars) if cultivars is not None else list(comparison[CULTIVAR].cat.categories)
+    return table.reindex(index=index, columns=columns)
+
+
+def run_comparison(job, blast_type, query_path, databases, query_lengths, evalue=DEFAULT_EVALUE, cache_key=None):
+    """Job target: search `query_path` against every `{cultivar: db path}` in parallel.
+
+    The job's threads are shared out between the cultivar searches. Returns
+    the long comparison table, stored in `RESULT_CACHE` under `cache_key`.
+    The query file is removed once BLAST has run.
+    """
+    names = list(databases)
+    parallel = min(len(names), job.threads)
+    threads = max(1, job.threads // parallel)
+    out_paths = []
+    try:
+        argvs = []
+        for name in names:
+            out_fd, out_path = tempfile.mkstemp(suffix=".tsv")
+            os.close(out_fd)
+            out_paths.append(out_path)
+            argvs.append(build_blast_command(blast_type, query_path, databases[name], out_path,
+                                             threads=threads, evalue=evalue)
+                         + ["-max_target_seqs", str(COMPARE_TARGET_SEQS)])
+        with metrics.span("compare.search", program=blast_type, cultivars=len(names)):
+            results = job.run_commands(argvs, parallel)
+        for result in results:
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.strip() or f"{blast_type} exited with {result.returncode}")
+        with metrics.span("compare.reduce"):
+            comparison = compare_hits({name: read_hits(path) for name, path in zip(names, out_paths)},
+                                      query_lengths)
+        if cache_key is not None:
+            RESULT_CACHE.put(cache_key, comparison)
+        return comparison
+    finally:
+        for path in [query_path] + out_paths:
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,189 @@
+"""Catalog of the BLAST databases in `db/`.
+
+Databases are found by their index files (`.nin`/`.pin`) and alias files
+(`.nal`/`.pal`), so volumes shipped without `.nsq`/`.psq` or with an LMDB
+(`.ndb`/`.pdb`) are listed too. Title, sequence count and total letters are
+read from the index header. The scan is cached per process and repeated only
+when the directory's mtime changes, and the mtime itself is checked at most
+every `RECHECK_SECONDS`, so ordinary page interactions never touch the disk.
+"""
+import os
+import struct
+import threading
+import time
+from typing import NamedTuple
+
+DB_DIR = "db"
+RECHECK_SECONDS = 5.0
+
+NUCL = "nucl"
+PROT = "prot"
+
+_INDEX_EXTENSIONS = {".nin": NUCL, ".pin": PROT}
+_ALIAS_EXTENSIONS = {".nal": NUCL, ".pal": PROT}
+
+
+class DatabaseInfo(NamedTuple):
+    name: str
+    path: str
+    dbtype: str
+    title: str
+    num_sequences: int
+    total_length: int
+    max_length: int
+    members: tuple = ()  # volumes/databases listed by an alias file
+    aliases: tuple = ()  # alias databases that include this one
+    volumes: tuple = ()  # paths of the NAME.00, NAME.01, ... volumes of a multi-volume database
+
+
+def read_index_header(path):
+    """Parse the header of a BLAST v4/v5 `.nin`/`.pin` index file.
+
+    Returns `(dbtype, title, num_sequences, total_length, max_length)`.
+    """
+    with open(path, "rb") as f:
+        data = f.read(4096)
+
+    def read_int(offset):
+        return struct.unpack_from(">I", data, offset)[0], offset + 4
+
+    def read_string(offset):
+        length, offset = read_int(offset)
+        raw = data[offset:offset + length]
+        return raw.split(b"\0", 1)[0].decode("ascii", "replace").strip(), offset + length
+
+    version, offset = read_int(0)
+    if version not in (4, 5):
+        raise ValueError(f"{path}: unsupported BLAST database version {version}")
+    dbtype, offset = read_int(offset)
+    if version == 5:
+        _, offset = read_int(offset)  # volume number
+    title, offset = read_string(offset)
+    if version == 5:
+        _, offset = read_string(offset)  # LMDB file name
+    _, offset = read_string(offset)  # creation date
+    num_sequences, offset = read_int(offset)
+    total_length = struct.unpack_from("<Q", data, offset)[0]
+    max_length, _ = read_int(offset + 8)
+    return (PROT if dbtype == 1 else NUCL), title, num_sequences, total_length, max_length
+
+
+def read_alias_file(path):
+    """Return `(title, [member names])` from a `.nal`/`.pal` alias file."""
+    title = ""
+    members = []
+    with open(path) as f:
+        for line in f:
+            key, _, value = line.strip().partition(" ")
+            if key == "TITLE":
+                title = value.strip()
+            elif key == "DBLIST":
+                members = [os.path.basename(m.strip('"')) for m in value.split()]
+    return title, members
+
+
+def scan(db_dir=DB_DIR):
+    """Read every database in `db_dir` into `{name: DatabaseInfo}`."""
+    found = {}
+    aliases = {}
+    for filename in sorted(os.listdir(db_dir)):
+        stem, ext = os.path.splitext(filename)
+        path = os.path.join(db_dir, filename)
+        if ext in _INDEX_EXTENSIONS:
+            # Multi-volume databases name their volumes NAME.00, NAME.01, ...
+            name, volume = os.path.splitext(stem)
+            volumes = (os.path.join(db_dir, stem),)
+            if not volume[1:].isdigit():
+                name = stem
+                volumes = ()
+            try:
+                dbtype, title, count, total, longest = read_index_header(path)
+            except (OSError, ValueError, struct.error):
+                continue
+            previous = found.get((name, dbtype))
+            if previous is not None:
+                count += previous.num_sequences
+                total += previous.total_length
+                longest = max(longest, previous.max_length)
+                title = previous.title
+                volumes = previous.volumes + volumes
+            found[(name, dbtype)] = DatabaseInfo(name, os.path.join(db_dir, name), dbtype,
+                                                 title, count, total, longest, volumes=volumes)
+        elif ext in _ALIAS_EXTENSIONS:
+            aliases[(stem, _ALIAS_EXTENSIONS[ext])] = read_alias_file(path)
+
+    for (name, dbtype), (title, members) in aliases.items():
+        parts = [found[(m, dbtype)] for m in members if (m, dbtype) in found]
+        found[(name, dbtype)] = DatabaseInfo(
+            name, os.path.join(db_dir, name), dbtype, title or name,
+            sum(p.num_sequences for p in parts), sum(p.total_length for p in parts),
+            max((p.max_length for p in parts), default=0), members=tuple(members))
+        for m in members:
+            if (m, dbtype) in found:
+                info = found[(m, dbtype)]
+                found[(m, dbtype)] = info._replace(aliases=info.aliases + (name,))
+    return {(name, dbtype): info for (name, dbtype), info in sorted(found.items())}
+
+
+class Catalog:
+    def __init__(self, db_dir=DB_DIR):
+        self.db_dir = db_dir
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked = 0.0
+        self._databases = {}
+
+    def databases(self, dbtype=None):
+        """All databases, or only those of `dbtype` (`"nucl"`/`"prot"`)."""
+        self._refresh()
+        return [info for info in self._databases.values() if dbtype is None or info.dbtype == dbtype]
+
+    def get(self, name, dbtype):
+        self._refresh()
+        return self._databases.get((name, dbtype))
+
+    def shards(self, name, dbtype):
+        """Paths of separately searchable parts that together make up `name`.
+
+        These are the volumes of a multi-volume database, the members of an
+        alias, or else the other single databases of the type when their
+        sequence counts and lengths add up exactly to `name`'s (a combined
+        database such as `all_genomes`). Empty when `name` cannot be split.
+        """
+        info = self.get(name, dbtype)
+        if info is None:
+            return []
+        if len(info.volumes) > 1:
+            return list(info.volumes)
+        if info.members:
+            parts = [self.get(member, dbtype) for member in info.members]
+            return [part.path for part in parts] if all(parts) and len(parts) > 1 else []
+        parts = [other for other in self.databases(dbtype)
+                 if other.name != name and not other.members and name not in other.aliases]
+        if (len(parts) > 1 and sum(part.num_sequences for part in parts) == info.num_sequences
+                and sum(part.total_length for part in parts) == info.total_length):
+            return [part.path for part in parts]
+        return []
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._mtime is not None and now - self._checked < RECHECK_SECONDS:
+            return
+        with self._lock:
+            self._checked = now
+            mtime = os.stat(self.db_dir).st_mtime_ns
+            if mtime != self._mtime:
+                self._databases = scan(self.db_dir)
+                self._mtime = mtime
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(db_dir=DB_DIR):
+    """Process-wide catalog for `db_dir`."""
+    with _catalogs_lock:
+        if db_dir not in _catalogs:
+            _catalogs[db_dir] = Catalog(db_dir)
+        return _catalogs[db_dir]
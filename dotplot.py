@@ -0,0 +1,107 @@
+"""Dot plots from k-mer (word) matches in roughly linear time.
+
+Every word of `word_size` residues in both sequences is hashed; matching
+hashes give the dots, found with one sort and a binary search instead of
+comparing all `len1 x len2` positions. Words that would produce more than
+`MAX_PAIRS` dots in total (low-complexity repeats) are masked, most frequent
+first. Dots are then merged into diagonal segments, tolerating gaps up to
+one word, and segments shorter than `stringency` residues are dropped.
+
+The result is binned into a fixed-size 2D histogram, so drawing costs the
+same however many dots there are.
+"""
+import numpy as np
+
+RESOLUTION = 500
+MAX_PAIRS = 5_000_000
+NUCLEOTIDE_WORD_SIZE = 10
+PROTEIN_WORD_SIZE = 3
+
+
+def default_word_size(seq):
+    sample = seq[:10000].upper()
+    acgtn = sum(sample.count(base) for base in "ACGTUN")
+    return NUCLEOTIDE_WORD_SIZE if sample and acgtn / len(sample) >= 0.9 else PROTEIN_WORD_SIZE
+
+
+def word_hashes(seq, word_size):
+    """64-bit polynomial hash of every word of the upper-cased `seq`."""
+    codes = np.frombuffer(seq.upper().encode("ascii", "replace"), dtype=np.uint8).astype(np.uint64)
+    n = len(codes) - word_size + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint64)
+    hashes = np.zeros(n, dtype=np.uint64)
+    base = np.uint64(1099511628211)  # FNV prime; overflow wraps modulo 2**64
+    with np.errstate(over="ignore"):
+        for j in range(word_size):
+            hashes = hashes * base + codes[j:j + n]
+    return hashes
+
+
+def word_matches(seq1, seq2, word_size, max_pairs=MAX_PAIRS):
+    """Positions `(i, j)` where `seq1[i:i+w] == seq2[j:j+w]`."""
+    h1 = word_hashes(seq1, word_size)
+    h2 = word_hashes(seq2, word_size)
+    empty = np.empty(0, dtype=np.int64)
+    if len(h1) == 0 or len(h2) == 0:
+        return empty, empty
+
+    order = np.argsort(h1, kind="stable")
+    sorted_h1 = h1[order]
+    lo = np.searchsorted(sorted_h1, h2, side="left")
+    counts = np.searchsorted(sorted_h1, h2, side="right") - lo
+
+    if counts.sum() > max_pairs:
+        # Drop the most repetitive words until the dots fit the budget.
+        ascending = np.sort(counts)
+        fits = np.searchsorted(np.cumsum(ascending), max_pairs, side="right")
+        counts = np.where(counts < ascending[fits], counts, 0)
+
+    total = int(counts.sum())
+    if total == 0:
+        return empty, empty
+    j = np.repeat(np.arange(len(h2), dtype=np.int64), counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    i = order[np.repeat(lo, counts) + (np.arange(total) - starts)]
+    return i.astype(np.int64), j
+
+
+def filter_segments(i, j, word_size, stringency):
+    """Keep dots on diagonal segments at least `stringency` residues long."""
+    if len(i) == 0 or stringency <= word_size:
+        return i, j
+    diagonal = i - j
+    order = np.lexsort((i, diagonal))
+    i, j, diagonal = i[order], j[order], diagonal[order]
+    new_segment = np.ones(len(i), dtype=bool)
+    new_segment[1:] = (np.diff(diagonal) != 0) | (np.diff(i) > word_size)
+    starts = np.flatnonzero(new_segment)
+    lengths = np.maximum.reduceat(i, starts) + word_size - i[starts]
+    keep = np.repeat(lengths >= stringency, np.diff(np.append(starts, len(i))))
+    return i[keep], j[keep]
+
+
+def compute_dotplot(seq1, seq2, word_size=None, stringency=None, resolution=RESOLUTION, max_pairs=MAX_PAIRS):
+    """Binned dot plot of two (ungapped) sequences.
+
+    Returns `(counts, extent, dots)`: a `bins1 x bins2` histogram of dot
+    counts, the `(0, len1, 0, len2)` extent for `imshow`, and the number of
+    dots drawn.
+    """
+    seq1 = seq1.replace("-", "")
+    seq2 = seq2.replace("-", "")
+    word_size = word_size or default_word_size(seq1)
+    i, j = word_matches(seq1, seq2, word_size, max_pairs)
+    i, j = filter_segments(i, j, word_size, stringency or word_size)
+    len1, len2 = max(len(seq1), 1), max(len(seq2), 1)
+    bins = (min(resolution, len1), min(resolution, len2))
+    counts, _, _ = np.histogram2d(i, j, bins=bins, range=((0, len1), (0, len2)))
+    return counts, (0, len1, 0, len2), len(i)
+
+
+def draw_dotplot(ax, counts, extent, xlabel="Sequence 1", ylabel="Sequence 2"):
+    ax.imshow((counts > 0).T, origin="lower", extent=extent, cmap="Greys",
+              aspect="auto", interpolation="nearest")
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title("Dot Plot")
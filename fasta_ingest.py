@@ -0,0 +1,183 @@
+"""Streaming FASTA ingestion shared by the BLAST and MSA pages.
+
+Uploads and pasted text are read line by line, never as one string, and
+written straight to a temporary FASTA file in canonical form: a `>ID` header
+(the first word of the original header) and upper-cased residues. The same
+pass validates the alphabet, counts per-record length and GC, decides
+between nucleotide and protein (mostly ACGTUN, not counting the gaps of an
+aligned input, means nucleotide) and hashes
+the canonical sequences, so the input never needs to be read again to key a
+cache. Input size and record count are capped by `MAX_INPUT_BYTES` and
+`MAX_RECORDS`.
+"""
+import hashlib
+import os
+import tempfile
+from typing import NamedTuple
+
+from db_catalog import NUCL, PROT
+
+MAX_INPUT_BYTES = int(os.environ.get("MANGODB_MAX_INPUT_MB", 500)) * 1024 * 1024
+MAX_RECORDS = int(os.environ.get("MANGODB_MAX_RECORDS", 1_000_000))
+
+# Letters are all valid protein residues; '*' is a stop and '-'/'.' gaps.
+_VALID = bytes(range(ord("A"), ord("Z") + 1)) + b"*-."
+_NUCLEOTIDE = b"ACGTURYKMSWBDHVN-."
+_GAPS = b"-."
+_NUCLEOTIDE_FRACTION = 0.9
+SNIFF_BYTES = 64 * 1024
+
+
+class FastaError(ValueError):
+    pass
+
+
+class FastaSummary(NamedTuple):
+    records: list  # [(ID, length, GC count), ...] in input order
+    total_length: int
+    gc_count: int
+    sequence_type: str  # NUCL or PROT
+    digest: str  # SHA-256 of the canonical FASTA
+    gap_count: int = 0  # '-' and '.' in `total_length`; record lengths include them
+
+    @property
+    def num_records(self):
+        return len(self.records)
+
+    @property
+    def mean_length(self):
+        return self.total_length / len(self.records) if self.records else 0.0
+
+    @property
+    def residue_count(self):
+        return self.total_length - self.gap_count
+
+    @property
+    def gc_percent(self):
+        return round(self.gc_count / self.residue_count * 100, 2) if self.residue_count else 0
+
+    @property
+    def blast_type(self):
+        return "blastn" if self.sequence_type == NUCL else "blastp"
+
+
+def _lines(source):
+    """Byte lines of pasted text or an uploaded (binary) file."""
+    if isinstance(source, str):
+        for line in source.splitlines():
+            yield line.encode("utf-8", "replace")
+        return
+    source.seek(0)
+    yield from source
+
+
+def ingest(sources, out=None, max_bytes=MAX_INPUT_BYTES, max_records=MAX_RECORDS, min_records=1):
+    """Validate FASTA `sources` in one pass, writing the canonical form to `out`.
+
+    `sources` are strings or binary file objects; `out` is a binary file or
+    None. Sequence before any header becomes a record of its own. Raises
+    `FastaError` on the first problem.
+    """
+    digest = hashlib.sha256()
+    records = []
+    record_id = None
+    length = gc = 0
+    acgtun = non_nucleotide = gaps = 0
+    total_bytes = 0
+
+    def finish_record():
+        if length == 0:
+            raise FastaError(f"Record '{record_id}' has no sequence.")
+        records.append((record_id, length, gc))
+        digest.update(b"\n")
+
+    def start_record(name):
+        if len(records) >= max_records:
+            raise FastaError(f"Too many sequences: at most {max_records:,} are allowed.")
+        encoded = name.encode("utf-8", "replace")
+        if out is not None:
+            out.write(b">" + encoded + b"\n")
+        digest.update(b">" + encoded + b"\n")
+
+    for source in sources:
+        for line_number, line in enumerate(_lines(source), 1):
+            total_bytes += len(line)
+            if total_bytes > max_bytes:
+                raise FastaError(f"Input is larger than {max_bytes // (1024 * 1024)} MB.")
+            if line.startswith(b">"):
+                if record_id is not None:
+                    finish_record()
+                words = line[1:].split()
+                record_id = words[0].decode("utf-8", "replace") if words else ""
+                length = gc = 0
+                start_record(record_id)
+                continue
+            seq = b"".join(line.split()).upper()
+            if not seq:
+                continue
+            if record_id is None:
+                record_id = f"seq{len(records) + 1}"
+                length = gc = 0
+                start_record(record_id)
+            invalid = seq.translate(None, _VALID)
+            if invalid:
+                raise FastaError(f"Record '{record_id}' (line {line_number}): invalid character "
+                                 f"'{chr(invalid[0])}'.")
+            length += len(seq)
+            gc += seq.count(b"G") + seq.count(b"C")
+            acgtun += sum(seq.count(base) for base in b"ACGTUN")
+            gaps += seq.count(b"-") + seq.count(b".")
+            non_nucleotide += len(seq.translate(None, _NUCLEOTIDE))
+            if out is not None:
+                out.write(seq + b"\n")
+            digest.update(seq)
+        if record_id is not None:
+            finish_record()
+            record_id = None
+
+    if len(records) < min_records:
+        if not records:
+            raise FastaError("No sequences found.")
+        raise FastaError(f"At least {min_records} sequences are needed.")
+    total_length = sum(r[1] for r in records)
+    is_nucleotide = acgtun >= _NUCLEOTIDE_FRACTION * (total_length - gaps)
+    if is_nucleotide and non_nucleotide:
+        raise FastaError("Nucleotide input contains characters that are not IUPAC nucleotide codes.")
+    return FastaSummary(records, total_length, sum(r[2] for r in records),
+                        NUCL if is_nucleotide else PROT, digest.hexdigest(), gaps)
+
+
+def ingest_to_file(sources, **limits):
+    """`ingest` into a new temporary FASTA file; returns `(path, summary)`.
+
+    The caller owns the file. It is removed if the input is rejected.
+    """
+    with tempfile.NamedTemporaryFile(mode="wb", delete=False, suffix=".fasta") as out:
+        try:
+            summary = ingest(sources, out, **limits)
+        except BaseException:
+            out.close()
+            os.remove(out.name)
+            raise
+    return out.name, summary
+
+
+def sniff_sequence_type(sources, sample=SNIFF_BYTES):
+    """Best guess (NUCL/PROT) from the first residues of `sources`, or None."""
+    residues = b""
+    for source in sources:
+        if isinstance(source, str):
+            head = source[:sample].encode("utf-8", "replace")
+        else:
+            source.seek(0)
+            head = source.read(sample)
+            source.seek(0)
+        for line in head.splitlines():
+            if not line.startswith(b">"):
+                residues += b"".join(line.split()).upper().translate(None, _GAPS)
+        if len(residues) >= sample:
+            break
+    if not residues:
+        return None
+    acgtun = sum(residues.count(base) for base in b"ACGTUN")
+    return NUCL if acgtun >= _NUCLEOTIDE_FRACTION * len(residues) else PROT
@@ -0,0 +1,70 @@
+"""Render matplotlib figures once and reuse the bytes for display and download.
+
+`figure_bytes` calls a `draw()` function that builds a figure, saves it in
+one format and closes it straight away, caching the bytes in `FIGURE_CACHE`
+under a key derived from the figure's input data (`data_key`). The pages
+show the PNG with `st.image` and offer those very same bytes for download,
+so a figure is drawn once per distinct input rather than twice per rerun,
+and no figure is left open in a long-running server. SVG is only drawn when
+its download is clicked.
+"""
+import hashlib
+import io
+
+import numpy as np
+import streamlit as st
+
+import metrics
+from result_cache import ResultCache, make_key
+
+FIGURE_CACHE = ResultCache("figures")
+MIME_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+def data_key(name, *data):
+    """Cache key of figure `name` drawn from `data` (arrays, frames or JSON values)."""
+    parts = []
+    for value in data:
+        if hasattr(value, "to_numpy"):
+            value = value.to_numpy()
+        if isinstance(value, np.ndarray):
+            value = np.ascontiguousarray(value)
+            digest = hashlib.sha256(value.tobytes()).hexdigest()
+            value = [str(value.dtype), value.shape, digest]
+        parts.append(value)
+    return make_key("figure", name, parts)
+
+
+def render(fig, fmt="png"):
+    """`fig` saved as `fmt` bytes; the figure is closed either way."""
+    import matplotlib.pyplot as plt  # by the time a figure exists, pyplot is loaded
+    try:
+        buf = io.BytesIO()
+        fig.savefig(buf, format=fmt)
+        return buf.getvalue()
+    finally:
+        plt.close(fig)
+
+
+def figure_bytes(key, draw, fmt="png"):
+    """Bytes of the figure built by `draw()`, cached under `key` and `fmt`."""
+    cache_key = make_key(key, fmt)
+    data = FIGURE_CACHE.get(cache_key)
+    if data is None:
+        with metrics.span("figure.draw", fmt=fmt):
+            data = render(draw(), fmt)
+        FIGURE_CACHE.put(cache_key, data)
+    return data
+
+
+def show_figure(key, draw, title, filename):
+    """Display a figure and offer it as PNG (the displayed bytes) and SVG."""
+    png = figure_bytes(key, draw)
+    st.image(png)
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button(label=f"Download {title} as PNG", data=png, file_name=f"{filename}.png",
+                           mime=MIME_TYPES["png"], on_click="ignore")
+    with col2:
+        st.download_button(label=f"Download {title} as SVG", data=lambda: figure_bytes(key, draw, "svg"),
+                           file_name=f"{filename}.svg", mime=MIME_TYPES["svg"], on_click="ignore")
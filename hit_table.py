@@ -0,0 +1,109 @@
+"""Filtering, top-N per query, paging and export of typed BLAST hit tables.
+
+Hit tables carry the fixed column types of `blast_search.HIT_DTYPES`, plus a
+float32 `Query Coverage` column when the query lengths are known. Filters
+are NumPy masks over those columns, so only the rows of the current page
+ever reach the browser. CSV is written in chunks of `CSV_CHUNK_ROWS` rows
+and Parquet through Arrow, never as one big string.
+"""
+import io
+import tempfile
+from typing import NamedTuple, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+COVERAGE = "Query Coverage"
+CSV_CHUNK_ROWS = 100_000
+PAGE_SIZE = 100
+
+
+class HitFilter(NamedTuple):
+    min_identity: float = 0.0
+    max_evalue: Optional[float] = None
+    min_bitscore: float = 0.0
+    min_coverage: float = 0.0
+    top_per_query: int = 0  # best hits kept per query by bit score; 0 keeps all
+
+    @classmethod
+    def from_params(cls, params):
+        """Filter from query-string style `{name: str}` parameters."""
+        return cls(
+            min_identity=float(params.get("min_identity", 0)),
+            max_evalue=float(params["max_evalue"]) if params.get("max_evalue") else None,
+            min_bitscore=float(params.get("min_bitscore", 0)),
+            min_coverage=float(params.get("min_coverage", 0)),
+            top_per_query=int(params.get("top", 0)),
+        )
+
+
+def add_coverage(hits, query_lengths):
+    """Add `Query Coverage` (% of the query covered by each hit)."""
+    if not query_lengths:
+        return hits
+    lengths = hits["Query ID"].map(query_lengths).astype("float32").to_numpy()
+    span = np.abs(hits["Query End"].to_numpy() - hits["Query Start"].to_numpy()) + 1
+    hits = hits.copy()
+    hits[COVERAGE] = (span / lengths * 100).astype(np.float32)
+    return hits
+
+
+def filter_hits(hits, hit_filter):
+    keep = np.ones(len(hits), dtype=bool)
+    if hit_filter.min_identity:
+        keep &= hits["% Identity"].to_numpy() >= hit_filter.min_identity
+    if hit_filter.max_evalue is not None:
+        keep &= hits["E-value"].to_numpy() <= hit_filter.max_evalue
+    if hit_filter.min_bitscore:
+        keep &= hits["Bit Score"].to_numpy() >= hit_filter.min_bitscore
+    if hit_filter.min_coverage and COVERAGE in hits.columns:
+        keep &= hits[COVERAGE].to_numpy() >= hit_filter.min_coverage
+    if not keep.all():
+        hits = hits[keep]
+    if hit_filter.top_per_query:
+        hits = top_per_query(hits, hit_filter.top_per_query)
+    return hits
+
+
+def top_per_query(hits, n):
+    """The `n` best hits (by bit score) of every query, in input order."""
+    codes = hits["Query ID"].cat.codes.to_numpy()
+    order = np.lexsort((-hits["Bit Score"].to_numpy(), codes))
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    return hits.iloc[np.sort(order[rank < n])]
+
+
+def page(hits, number, size=PAGE_SIZE):
+    """Rows of 1-based page `number`, and the number of pages."""
+    pages = max(1, -(-len(hits) // size))
+    number = min(max(1, number), pages)
+    return hits.iloc[(number - 1) * size:number * size], pages
+
+
+def iter_csv(hits, chunk_rows=CSV_CHUNK_ROWS):
+    """CSV of `hits` as UTF-8 byte chunks, header first."""
+    yield (",".join(hits.columns) + "\n").encode()
+    for start in range(0, len(hits), chunk_rows):
+        yield hits.iloc[start:start + chunk_rows].to_csv(index=False, header=False).encode()
+
+
+def csv_file(hits):
+    """CSV of `hits` in a temporary file (spilled to disk when large), rewound."""
+    f = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+    for chunk in iter_csv(hits):
+        f.write(chunk)
+    f.seek(0)
+    return f
+
+
+def to_arrow(hits):
+    return pa.Table.from_pandas(hits, preserve_index=False)
+
+
+def parquet_bytes(hits):
+    buf = io.BytesIO()
+    pq.write_table(to_arrow(hits), buf)
+    return buf.getvalue()
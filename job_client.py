@@ -0,0 +1,129 @@
+"""HTTP client for the job server, with the same functions as `job_service`.
+
+Set `MANGODB_JOB_SERVER` (e.g. `http://127.0.0.1:8502`) to make the pages
+submit their BLAST searches and alignments to a running `job_server.py`
+instead of this process's worker pool. `get_backend` returns whichever
+applies.
+"""
+import json
+import os
+import sys
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import pandas as pd
+
+import job_service
+from aligners import MSA_THREADS
+from blast_search import DEFAULT_EVALUE, typed_hits
+from comparative import CULTIVAR, typed_comparison
+from hit_table import COVERAGE
+from job_service import JobNotFound, QueueFull
+from seq_stats import ANNOTATION_DTYPES
+
+JOB_SERVER = os.environ.get("MANGODB_JOB_SERVER", "").rstrip("/")
+TIMEOUT = 60
+
+
+def get_backend():
+    """`job_client` when a job server is configured, else `job_service`."""
+    return sys.modules[__name__] if JOB_SERVER else job_service
+
+
+def _request(method, path, params=None, body_path=None):
+    url = JOB_SERVER + path
+    if params:
+        url += "?" + urllib.parse.urlencode({k: v for k, v in params.items() if v is not None})
+    body = open(body_path, "rb") if body_path else None
+    headers = {}
+    if body is not None:
+        headers = {"Content-Type": "text/x-fasta", "Content-Length": str(os.path.getsize(body_path))}
+    request = urllib.request.Request(url, data=body, method=method, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.load(e).get("error", str(e))
+        except ValueError:
+            message = str(e)
+        if e.code == 404:
+            raise JobNotFound(message)
+        if e.code == 409 and method == "GET":
+            return None  # result requested before the job finished
+        if e.code in (400, 409, 413):
+            raise ValueError(message)
+        if e.code == 503:
+            raise QueueFull(message)
+        raise RuntimeError(message)
+    finally:
+        if body is not None:
+            body.close()
+
+
+def submit_blast(query_path, summary, program=None, database=None, evalue=DEFAULT_EVALUE):
+    try:
+        record = _request("POST", "/jobs/blast", {"program": program, "database": database, "evalue": evalue},
+                          body_path=query_path)
+    finally:
+        os.remove(query_path)
+    return record["id"]
+
+
+def submit_compare(query_path, summary, program=None, evalue=DEFAULT_EVALUE):
+    try:
+        record = _request("POST", "/jobs/compare", {"program": program, "evalue": evalue}, body_path=query_path)
+    finally:
+        os.remove(query_path)
+    return record["id"]
+
+
+def submit_msa(input_path, summary, aligner=None, threads=MSA_THREADS, cluster_identity=None):
+    try:
+        record = _request("POST", "/jobs/msa", {"aligner": aligner, "threads": threads, "cluster": cluster_identity},
+                          body_path=input_path)
+    finally:
+        os.remove(input_path)
+    return record["id"]
+
+
+def submit_msa_add(input_path, summary, added, aligner=None, threads=MSA_THREADS):
+    try:
+        record = _request("POST", "/jobs/msa", {"add": added, "aligner": aligner, "threads": threads},
+                          body_path=input_path)
+    finally:
+        os.remove(input_path)
+    return record["id"]
+
+
+def status(job_id):
+    return _request("GET", f"/jobs/{urllib.parse.quote(job_id)}")
+
+
+def result(job_id):
+    payload = _request("GET", f"/jobs/{urllib.parse.quote(job_id)}/result")
+    if payload is None:
+        return None
+    if "aligned_fasta" in payload:
+        return payload["aligned_fasta"]
+    if CULTIVAR in payload["columns"]:
+        return typed_comparison(pd.DataFrame(payload["rows"], columns=payload["columns"]))
+    hits = typed_hits(pd.DataFrame(payload["rows"], columns=payload["columns"]))
+    extra = {COVERAGE: "float32", **ANNOTATION_DTYPES}
+    return hits.astype({name: dtype for name, dtype in extra.items() if name in hits.columns})
+
+
+def clusters(job_id):
+    payload = _request("GET", f"/jobs/{urllib.parse.quote(job_id)}/result", {"format": "clusters"})
+    if payload is None:
+        return None
+    return pd.DataFrame(payload["rows"], columns=payload["columns"])
+
+
+def cancel(job_id):
+    return _request("DELETE", f"/jobs/{urllib.parse.quote(job_id)}")
+
+
+def list_jobs():
+    return _request("GET", "/jobs")
@@ -0,0 +1,310 @@
+"""Local HTTP/JSON job server for BLAST searches, cultivar comparisons and alignments.
+
+Run it next to the app with `python job_server.py` (see `--help`) to submit
+jobs from scripts and pipelines, or set `MANGODB_JOB_SERVER` so the pages
+hand their jobs to it. Jobs share one worker pool and its CPU budget and are
+kept on disk by `job_service`, so they survive closed browser tabs.
+
+    POST   /jobs/blast?program=&database=&evalue=   body: FASTA query
+    POST   /jobs/compare?program=&evalue=           body: FASTA queries, searched in every cultivar
+    POST   /jobs/msa?aligner=&threads=              body: FASTA sequences
+           &cluster=0.9                             align one representative per cluster of near-identical ones
+           &add=N                                   body: an alignment, then N sequences to add to it
+           &add=N&base=<id>                         body: N sequences to add to MSA job <id>'s alignment
+    GET    /jobs                                    all known jobs
+    GET    /jobs/<id>                               status
+    GET    /jobs/<id>/result                        hits, comparison or aligned FASTA (409 until done)
+           ?format=report                           an alignment's statistics and symbolic view, streamed
+           ?format=clusters                         a clustered alignment's cluster membership (JSON)
+           ?format=newick&model=                    a neighbor-joining tree of an alignment (p-distance,
+                                                    Jukes-Cantor or Kimura)
+           ?format=json|csv|parquet|fasta           BLAST hits as paged JSON, streamed CSV or Parquet,
+                                                    or the subject sequences (&regions=aligned|full)
+           &min_identity=&max_evalue=&min_bitscore=&min_coverage=&top=&page=&page_size=
+    DELETE /jobs/<id>                               cancel (also POST /jobs/<id>/cancel)
+    GET    /health                                  queue depth
+    GET    /metrics                                 Prometheus text: stage timings, queue, caches
+
+The server is a small asyncio HTTP/1.1 implementation (one request per
+connection); request bodies are streamed to a temporary file and all disk and
+queue work runs in the default executor, so slow uploads and downloads never
+block other clients.
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import urllib.parse
+
+import job_service
+import metrics
+from hit_table import PAGE_SIZE, HitFilter, filter_hits, iter_csv, page, parquet_bytes
+from fasta_ingest import MAX_INPUT_BYTES, FastaError, ingest_to_file
+from aligners import MAX_SEQUENCES
+from alignment_view import report_from_fasta
+from blast_search import resolve_db_path
+from db_catalog import NUCL, PROT
+from jobs import DONE, get_queue
+from phylogeny import MAX_TREE_SEQUENCES, P_DISTANCE, newick_from_fasta
+from seq_retrieval import hit_sequences_fasta
+
+HOST = "127.0.0.1"
+PORT = int(os.environ.get("MANGODB_JOB_SERVER_PORT", 8502))
+READ_CHUNK = 1024 * 1024
+
+_REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error",
+            503: "Service Unavailable"}
+
+
+class Body:
+    """A non-JSON response body: `chunks` are sent with chunked transfer encoding."""
+
+    def __init__(self, content_type, chunks):
+        self.content_type = content_type
+        self.chunks = chunks
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def _read_body(reader, length):
+    """Stream a request body of `length` bytes into a temporary file."""
+    if length > MAX_INPUT_BYTES:
+        raise HTTPError(413, f"Input is larger than {MAX_INPUT_BYTES // (1024 * 1024)} MB.")
+    fd, path = tempfile.mkstemp(suffix=".fasta")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            remaining = length
+            while remaining:
+                chunk = await reader.read(min(READ_CHUNK, remaining))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+        if remaining:
+            raise HTTPError(400, f"Request body ended {remaining} bytes short of its Content-Length.")
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+def _ingest_upload(raw_path, **limits):
+    try:
+        with open(raw_path, "rb") as raw:
+            return ingest_to_file([raw], **limits)
+    except FastaError as e:
+        raise HTTPError(400, str(e))
+    finally:
+        os.remove(raw_path)
+
+
+def _evalue(params):
+    evalue = params.get("evalue", job_service.DEFAULT_EVALUE)
+    float(evalue)  # a ValueError (400) before the upload is read
+    return evalue
+
+
+# The submitters check their parameters before reading the upload; `route`
+# removes the upload if one still fails after that.
+def _submit_blast(raw_path, params):
+    program, database, evalue = params.get("program"), params.get("database"), _evalue(params)
+    query_path, summary = _ingest_upload(raw_path)
+    return job_service.submit_blast(query_path, summary, program, database, evalue)
+
+
+def _submit_compare(raw_path, params):
+    program, evalue = params.get("program"), _evalue(params)
+    query_path, summary = _ingest_upload(raw_path)
+    return job_service.submit_compare(query_path, summary, program, evalue)
+
+
+def _submit_msa(raw_path, params):
+    threads = int(params.get("threads", job_service.MSA_THREADS))
+    if "add" not in params:
+        identity = float(params["cluster"]) if "cluster" in params else None
+        input_path, summary = _ingest_upload(raw_path, max_records=MAX_SEQUENCES, min_records=2)
+        return job_service.submit_msa(input_path, summary, params.get("aligner"), threads, identity)
+    added = int(params["add"])
+    if "base" in params:
+        base = job_service.status(params["base"])
+        alignment = job_service.result(params["base"]) if base["kind"] == job_service.MSA else None
+        if alignment is None:
+            raise HTTPError(409, f"Job {params['base']} has no alignment to add to.")
+        try:
+            with open(raw_path, "rb") as raw:
+                input_path, summary = ingest_to_file([alignment, raw], max_records=MAX_SEQUENCES)
+        except FastaError as e:
+            raise HTTPError(400, str(e))
+        finally:
+            os.remove(raw_path)
+    else:
+        input_path, summary = _ingest_upload(raw_path, max_records=MAX_SEQUENCES, min_records=2)
+    return job_service.submit_msa_add(input_path, summary, added, params.get("aligner"), threads)
+
+
+_SUBMITTERS = {"blast": _submit_blast, "compare": _submit_compare, "msa": _submit_msa}
+
+
+def _result(job_id, params):
+    record = job_service.status(job_id)
+    value = job_service.result(job_id)
+    if value is None:
+        raise HTTPError(409, f"Job is {record['status']}." if record["status"] != DONE else "Result not ready.")
+    if record["kind"] == job_service.MSA:
+        if params.get("format") == "report":
+            return Body("text/plain", (chunk.encode() for chunk in report_from_fasta(value)))
+        if params.get("format") == "newick":
+            if value.count(">") > MAX_TREE_SEQUENCES:
+                raise HTTPError(400, f"Trees are built for up to {MAX_TREE_SEQUENCES} sequences.")
+            return Body("text/plain", iter([newick_from_fasta(value, params.get("model", P_DISTANCE)).encode()]))
+        if params.get("format") == "clusters":
+            membership = job_service.clusters(job_id)
+            if membership is None:
+                raise HTTPError(404, "This alignment was not clustered.")
+            return job_service.hits_payload(membership)
+        return {"aligned_fasta": value}
+    if record["kind"] == job_service.COMPARE:
+        result_format = params.get("format", "json")
+        if result_format == "csv":
+            return Body("text/csv", iter_csv(value))
+        if result_format == "parquet":
+            return Body("application/vnd.apache.parquet", iter([parquet_bytes(value)]))
+        return job_service.hits_payload(value)
+    hits = filter_hits(value, HitFilter.from_params(params))
+    result_format = params.get("format", "json")
+    if result_format == "csv":
+        return Body("text/csv", iter_csv(hits))
+    if result_format == "parquet":
+        return Body("application/vnd.apache.parquet", iter([parquet_bytes(hits)]))
+    if result_format == "fasta":
+        program, database = record["params"]["program"], record["params"]["database"]
+        fasta = hit_sequences_fasta(hits, resolve_db_path(program, database), NUCL if program == "blastn" else PROT,
+                                    aligned=params.get("regions", "aligned") == "aligned")
+        return Body("text/x-fasta", iter([fasta]))
+    if "page" in params:
+        rows, _ = page(hits, int(params["page"]), int(params.get("page_size", PAGE_SIZE)))
+        return job_service.hits_payload(rows, total=len(hits))
+    return job_service.hits_payload(hits)
+
+
+async def route(method, path, params, reader, length):
+    loop = asyncio.get_running_loop()
+    parts = [p for p in path.split("/") if p]
+
+    def run(func, *args):
+        return loop.run_in_executor(None, func, *args)
+
+    if parts == ["health"] and method == "GET":
+        queued, running = get_queue().depth()
+        return 200, {"status": "ok", "queued": queued, "running": running}
+    if parts == ["metrics"] and method == "GET":
+        text = await run(metrics.render_prometheus)
+        return 200, Body("text/plain; version=0.0.4", iter([text.encode()]))
+    if parts == ["jobs"] and method == "GET":
+        return 200, await run(job_service.list_jobs)
+    if len(parts) == 2 and parts[0] == "jobs" and parts[1] in _SUBMITTERS and method == "POST":
+        raw_path = await _read_body(reader, length)
+        try:
+            job_id = await run(_SUBMITTERS[parts[1]], raw_path, params)
+        finally:
+            if os.path.exists(raw_path):
+                os.remove(raw_path)
+        return 202, await run(job_service.status, job_id)
+    if len(parts) == 2 and parts[0] == "jobs" and method == "GET":
+        return 200, await run(job_service.status, parts[1])
+    if len(parts) == 2 and parts[0] == "jobs" and method == "DELETE":
+        return 200, await run(job_service.cancel, parts[1])
+    if len(parts) == 3 and parts[0] == "jobs" and parts[2] == "cancel" and method == "POST":
+        return 200, await run(job_service.cancel, parts[1])
+    if len(parts) == 3 and parts[0] == "jobs" and parts[2] == "result" and method == "GET":
+        return 200, await run(_result, parts[1], params)
+    raise HTTPError(405 if parts and parts[0] in ("jobs", "health", "metrics") else 404, f"No route for {method} {path}")
+
+
+async def handle(reader, writer):
+    try:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if len(request_line) < 2:
+            raise HTTPError(400, "Malformed request line.")
+        method, target = request_line[0].upper(), request_line[1]
+        url = urllib.parse.urlsplit(target)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        status, payload = await route(method, url.path, params, reader, int(headers.get("content-length", 0)))
+    except HTTPError as e:
+        status, payload = e.status, {"error": str(e)}
+    except job_service.JobNotFound as e:
+        status, payload = 404, {"error": f"Unknown job {e.args[0]}"}
+    except job_service.QueueFull as e:
+        status, payload = 503, {"error": str(e)}
+    except ValueError as e:
+        status, payload = 400, {"error": str(e)}
+    except Exception as e:
+        status, payload = 500, {"error": str(e)}
+    metrics.inc("mangodb_http_requests_total", status=status)
+    try:
+        if isinstance(payload, Body):
+            await _send_chunked(writer, status, payload)
+        else:
+            body = json.dumps(payload).encode()
+            writer.write(f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+                         f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def _send_chunked(writer, status, body):
+    """Send `body.chunks`, producing each one in the executor."""
+    loop = asyncio.get_running_loop()
+    writer.write(f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+                 f"Content-Type: {body.content_type}\r\nTransfer-Encoding: chunked\r\n"
+                 f"Connection: close\r\n\r\n".encode("latin-1"))
+    chunks = iter(body.chunks)
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            break
+        if chunk:
+            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            await writer.drain()
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+async def serve(host=HOST, port=PORT):
+    server = await asyncio.start_server(handle, host, port)
+    print(f"Job server listening on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+metrics.describe("mangodb_http_requests_total", "Job server requests, by response status.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the BLAST/MSA job API over HTTP.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
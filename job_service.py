@@ -0,0 +1,466 @@
+"""Submission, status and results of BLAST, cross-cultivar and MSA jobs.
+
+This is the API behind both the Streamlit pages and the HTTP job server
+(`job_server.py`). Jobs run on the process-wide worker pool
+(`jobs.get_queue`); every job also gets a record in `JOB_DIR`:
+
+- `<id>.json`: kind, label, parameters and state;
+- `<id>.hits.parquet` (BLAST hits, with query coverage and annotations),
+  `<id>.parquet` (cultivar comparison) or `<id>.fasta` (aligned FASTA),
+  written when the job finishes or, for cached results, at submission;
+- `<id>.queries.json`: BLAST query lengths, for the hits' query coverage;
+- `<id>.clusters.json`: for alignments of clustered input, every input
+  sequence's cluster and representative (`seq_clusters.Clusters.frame`).
+
+Records outlive the browser session and the in-memory queue, so a job can be
+looked up by ID until `RESULT_TTL` seconds after it finished. Searches and
+alignments found in the result caches finish at once without queueing.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+import pandas as pd
+
+import metrics
+from aligners import (ALIGNERS, MSA_CACHE, MSA_THREADS, addition_cache_key, alignment_cache_key, choose_add_aligner,
+                      choose_aligner, clustered_cache_key, run_addition, run_alignment)
+from blast_search import (BLAST_THREADS, DB_DIR, DEFAULT_EVALUE, RESULT_CACHE, SHARDED_SEARCH, all_db_label,
+                          blast_cache_key, resolve_db_path, run_blast, run_sharded_blast, typed_hits)
+from comparative import cultivar_databases, comparison_cache_key, run_comparison, typed_comparison
+from db_catalog import NUCL, PROT, get_catalog
+from hit_table import add_coverage
+from jobs import CANCELLED, DONE, FAILED, FINISHED_STATES, QUEUED, RUNNING, JobCancelled, get_queue
+from seq_clusters import MIN_IDENTITY, cluster_fasta, write_representatives
+from seq_stats import annotate_hits
+
+JOB_DIR = os.environ.get("MANGODB_JOB_DIR", "jobs")
+RESULT_TTL = int(os.environ.get("MANGODB_RESULT_TTL", 86400))
+# Submissions are refused while this many jobs are waiting for a worker.
+MAX_QUEUED = int(os.environ.get("MANGODB_MAX_QUEUED", 100))
+
+BLAST = "blast"
+MSA = "msa"
+COMPARE = "compare"
+_RESULT_SUFFIX = {BLAST: ".hits.parquet", MSA: ".fasta", COMPARE: ".parquet"}
+
+
+class JobNotFound(KeyError):
+    pass
+
+
+class QueueFull(RuntimeError):
+    pass
+
+
+class JobStore:
+    """Job records and results on disk, one JSON file per job."""
+
+    def __init__(self, directory=JOB_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def path(self, job_id, suffix=".json"):
+        return os.path.join(self.directory, job_id + suffix)
+
+    def read(self, job_id):
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(self.path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, record):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp_path, self.path(record["id"]))
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            record = self.read(job_id)
+            if record is None:
+                return None
+            record.update(fields)
+            self.write(record)
+            return record
+
+    def records(self):
+        if not os.path.isdir(self.directory):
+            return []
+        found = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                record = self.read(name[:-len(".json")])
+                if record is not None:
+                    found.append(record)
+        return sorted(found, key=lambda record: record["submitted"])
+
+    def prune(self, ttl=RESULT_TTL):
+        """Remove jobs that finished more than `ttl` seconds ago."""
+        cutoff = time.time() - ttl
+        for record in self.records():
+            if record["status"] in FINISHED_STATES and (record["finished"] or 0) < cutoff:
+                for suffix in (".json", ".queries.json", ".clusters.json", _RESULT_SUFFIX[record["kind"]]):
+                    if os.path.exists(self.path(record["id"], suffix)):
+                        os.remove(self.path(record["id"], suffix))
+
+
+_store = JobStore()
+
+# Seconds a record may wait for its queue ID while `_submit` queues it.
+_SUBMIT_GRACE = 60
+
+
+def _new_record(kind, label, params):
+    return {
+        "id": uuid.uuid4().hex[:12],
+        "kind": kind,
+        "label": label,
+        "params": params,
+        "status": QUEUED,
+        "cached": False,
+        "queue_id": None,
+        "submitted": time.time(),
+        "started": None,
+        "finished": None,
+        "error": None,
+    }
+
+
+def _save_result(kind, job_id, result, params):
+    path = _store.path(job_id, _RESULT_SUFFIX[kind])
+    tmp_path = path + ".tmp"
+    if kind == BLAST:
+        # Kept with coverage and annotations, so `result` only reads it back.
+        hits = add_coverage(result, query_lengths(job_id))
+        hits = annotate_hits(hits, os.path.basename(resolve_db_path(params["program"], params["database"])))
+        hits.to_parquet(tmp_path, index=False)
+    elif kind == COMPARE:
+        result.to_parquet(tmp_path, index=False)
+    else:
+        with open(tmp_path, "w") as f:
+            f.write(result)
+    os.replace(tmp_path, path)
+
+
+def _run_stored(job, kind, job_id, target, *args, **kwargs):
+    """Job target: run `target` and keep its state and result in the job store."""
+    _store.update(job_id, status=RUNNING, started=time.time())
+    try:
+        with metrics.span(f"job.{kind}"):
+            result = target(job, *args, **kwargs)
+            _save_result(kind, job_id, result, _store.read(job_id)["params"])
+    except JobCancelled:
+        _store.update(job_id, status=CANCELLED, finished=time.time())
+        metrics.inc("mangodb_jobs_finished_total", kind=kind, status=CANCELLED)
+        raise
+    except Exception as e:
+        state = CANCELLED if job.cancel_requested else FAILED
+        _store.update(job_id, status=state, error=str(e), finished=time.time())
+        metrics.inc("mangodb_jobs_finished_total", kind=kind, status=state)
+        raise
+    _store.update(job_id, status=DONE, finished=time.time())
+    metrics.inc("mangodb_jobs_finished_total", kind=kind, status=DONE)
+    return result
+
+
+def _submit(kind, label, params, threads, cached, target, *args, query_lengths=None, clusters=None, job_id=None,
+            **kwargs):
+    _store.prune()
+    metrics.inc("mangodb_jobs_submitted_total", kind=kind, cached=str(cached is not None).lower())
+    record = _new_record(kind, label, params)
+    if job_id is not None:
+        record["id"] = job_id
+    for suffix, value in ((".queries.json", query_lengths), (".clusters.json", clusters)):
+        if value is not None:
+            os.makedirs(_store.directory, exist_ok=True)
+            with open(_store.path(record["id"], suffix), "w") as f:
+                json.dump(value, f)
+    if cached is not None:
+        _save_result(kind, record["id"], cached, params)
+        now = time.time()
+        record.update(status=DONE, cached=True, started=now, finished=now)
+        _store.write(record)
+        return record["id"]
+
+    queue = get_queue()
+    if queue.depth()[0] >= MAX_QUEUED:
+        raise QueueFull(f"Too many jobs waiting ({MAX_QUEUED}); try again later.")
+    _store.write(record)
+    queue_id = queue.submit(_run_stored, kind, record["id"], target, *args,
+                            threads=threads, label=label, **kwargs)
+    _store.update(record["id"], queue_id=queue_id)
+    return record["id"]
+
+
+def submit_blast(query_path, summary, program=None, database=None, evalue=DEFAULT_EVALUE, db_dir=DB_DIR):
+    """Queue a BLAST search of an ingested query file and return the job ID.
+
+    `summary` is the query's `FastaSummary`; `program` defaults to the one
+    matching its sequence type and `database` (a catalog name) to all
+    genomes/proteomes. Databases the catalog can split into shards are
+    searched one BLAST process per shard. The query file belongs to the job
+    from here on.
+    """
+    program = program or summary.blast_type
+    try:
+        if program not in ("blastn", "blastp"):
+            raise ValueError(f"Unknown BLAST program '{program}'.")
+        if program != summary.blast_type:
+            raise ValueError(f"The query is a {'protein' if summary.sequence_type == PROT else 'nucleotide'} "
+                             f"sequence; use {summary.blast_type} instead of {program}.")
+        dbtype = NUCL if program == "blastn" else PROT
+        db_choice = database or all_db_label(program)
+        # Only catalog names are accepted, so `database` can never be a path.
+        if db_choice != all_db_label(program) and get_catalog(db_dir).get(db_choice, dbtype) is None:
+            raise ValueError(f"Unknown {program} database '{db_choice}'.")
+        db_path = resolve_db_path(program, db_choice, db_dir)
+        info = get_catalog(db_dir).get(os.path.basename(db_path), dbtype)
+        if info is None:
+            raise ValueError(f"Unknown {program} database '{db_choice}'.")
+        # E-values are computed against the catalog's database length.
+        cache_key = blast_cache_key(summary.digest, program, db_path, evalue, dbsize=info.total_length)
+        cached = RESULT_CACHE.get(cache_key)
+        shards = get_catalog(db_dir).shards(info.name, info.dbtype) if SHARDED_SEARCH else []
+        threads = BLAST_THREADS * max(1, len(shards))
+        params = {"program": program, "database": db_choice, "evalue": str(evalue),
+                  "queries": summary.num_records, "threads": threads, "shards": len(shards)}
+        lengths = {query_id: length for query_id, length, _ in summary.records}
+        if shards:
+            job_id = _submit(BLAST, f"{program} vs {db_choice} ({len(shards)} shards)", params, threads, cached,
+                             run_sharded_blast, program, query_path, shards, evalue=evalue,
+                             dbsize=info.total_length, cache_key=cache_key, query_lengths=lengths)
+        else:
+            job_id = _submit(BLAST, f"{program} vs {db_choice}", params, threads, cached,
+                             run_blast, program, query_path, db_path, evalue=evalue,
+                             dbsize=info.total_length, cache_key=cache_key, query_lengths=lengths)
+    except BaseException:
+        os.remove(query_path)
+        raise
+    if cached is not None:
+        os.remove(query_path)
+    return job_id
+
+
+def submit_compare(query_path, summary, program=None, evalue=DEFAULT_EVALUE, db_dir=DB_DIR):
+    """Queue a cross-cultivar comparison of an ingested query file and return the job ID.
+
+    Every query is searched against each cultivar database of its sequence
+    type (`comparative.cultivar_databases`), in parallel. The query file
+    belongs to the job from here on.
+    """
+    program = program or summary.blast_type
+    try:
+        if program != summary.blast_type:
+            raise ValueError(f"The query is a {'protein' if summary.sequence_type == PROT else 'nucleotide'} "
+                             f"sequence; use {summary.blast_type} instead of {program}.")
+        databases = cultivar_databases(program, db_dir)
+        if not databases:
+            raise ValueError(f"No cultivar databases for {program}.")
+        cache_key = comparison_cache_key(summary.digest, program, databases.values(), evalue, db_dir)
+        cached = RESULT_CACHE.get(cache_key)
+        threads = BLAST_THREADS * len(databases)
+        params = {"program": program, "cultivars": list(databases), "evalue": str(evalue),
+                  "queries": summary.num_records, "threads": threads}
+        lengths = {query_id: length for query_id, length, _ in summary.records}
+        job_id = _submit(COMPARE, f"{program} vs {len(databases)} cultivars, {summary.num_records} queries",
+                         params, threads, cached, run_comparison, program, query_path, databases, lengths,
+                         evalue=evalue, cache_key=cache_key)
+    except BaseException:
+        os.remove(query_path)
+        raise
+    if cached is not None:
+        os.remove(query_path)
+    return job_id
+
+
+def submit_msa(input_path, summary, aligner=None, threads=MSA_THREADS, cluster_identity=None):
+    """Queue an alignment of an ingested FASTA file and return the job ID.
+
+    `aligner` is an `aligners.ALIGNERS` name, or None to choose by input
+    size. With `cluster_identity` (0-1) near-identical sequences are first
+    collapsed (`seq_clusters`) and only the cluster representatives are
+    aligned; `clusters` gives every input sequence's representative. The
+    input file belongs to the job from here on.
+    """
+    try:
+        if aligner is not None and aligner not in ALIGNERS:
+            raise ValueError(f"Unknown aligner '{aligner}'.")
+        if cluster_identity is not None and not MIN_IDENTITY <= cluster_identity <= 1:
+            raise ValueError(f"Clustering identity must be between {MIN_IDENTITY} and 1.")
+        # The engine is chosen for the whole input, so the cache key is known
+        # before the (queued) clustering has run.
+        engine = ALIGNERS[aligner] if aligner else choose_aligner(summary.num_records, summary.mean_length)
+        params = {"aligner": engine.name, "sequences": summary.num_records, "threads": int(threads)}
+        label = f"MSA: {engine.label}, {summary.num_records} sequence(s)"
+        if cluster_identity is None:
+            key = alignment_cache_key(summary.digest, engine)
+            artifacts = MSA_CACHE.get(key)
+            cached = artifacts["aligned_fasta"] if artifacts is not None else None
+            params["cache_key"] = key
+            job_id = _submit(MSA, label, params, threads, cached, run_alignment, engine, input_path)
+        else:
+            key = clustered_cache_key(summary.digest, cluster_identity, engine)
+            artifacts = MSA_CACHE.get(key)
+            membership = None
+            if artifacts is not None and artifacts.get("clusters") is not None:
+                membership = hits_payload(artifacts["clusters"])
+            cached = artifacts["aligned_fasta"] if membership is not None else None
+            params.update(cache_key=key, cluster_identity=cluster_identity)
+            job_id = uuid.uuid4().hex[:12]
+            job_id = _submit(MSA, label + f", clustered at {cluster_identity:.0%}", params, threads, cached,
+                             run_clustered_alignment, engine, input_path, cluster_identity, summary.sequence_type,
+                             _store.path(job_id, ".clusters.json"), clusters=membership, job_id=job_id)
+    except BaseException:
+        os.remove(input_path)
+        raise
+    if cached is not None:
+        os.remove(input_path)
+    return job_id
+
+
+def run_clustered_alignment(job, aligner, input_path, identity, sequence_type, clusters_path):
+    """Job target: cluster `input_path` at `identity` and align the representatives.
+
+    The membership is written to `clusters_path`. The input file belongs to
+    the job and is removed once the aligner has run.
+    """
+    try:
+        with metrics.span("msa.cluster"):
+            clusters = cluster_fasta(input_path, identity, sequence_type)
+        with open(clusters_path, "w") as f:
+            json.dump(hits_payload(clusters.frame()), f)
+        if clusters.num_clusters < 2:
+            raise ValueError(f"All {len(clusters.ids)} sequences fall into one cluster at {identity:.0%} identity; "
+                             "raise the threshold or align without clustering.")
+        fd, reps_path = tempfile.mkstemp(suffix=".fasta")
+        os.close(fd)
+        write_representatives(input_path, clusters, reps_path)
+        os.replace(reps_path, input_path)
+    except BaseException:
+        os.remove(input_path)
+        raise
+    return run_alignment(job, aligner, input_path)
+
+
+def submit_msa_add(input_path, summary, added, aligner=None, threads=MSA_THREADS):
+    """Queue adding sequences to an existing alignment and return the job ID.
+
+    The ingested `input_path` holds the alignment followed by the `added`
+    new sequences; `aligner` must be an engine that can add (`Aligner.can_add`),
+    or None to choose one. The result is the aligned FASTA of all sequences.
+    The input file belongs to the job from here on.
+    """
+    try:
+        existing = summary.records[:summary.num_records - added]
+        if added < 1 or not existing:
+            raise ValueError("Give an alignment and at least one sequence to add to it.")
+        if len({length for _, length, _ in existing}) != 1:
+            raise ValueError("The existing alignment's sequences must all have the same aligned length.")
+        if aligner is not None and (aligner not in ALIGNERS or not ALIGNERS[aligner].can_add):
+            raise ValueError(f"Aligner '{aligner}' cannot add sequences to an alignment.")
+        engine = ALIGNERS[aligner] if aligner else choose_add_aligner(len(existing))
+        key = addition_cache_key(summary.digest, added, engine)
+        artifacts = MSA_CACHE.get(key)
+        cached = artifacts["aligned_fasta"] if artifacts is not None else None
+        params = {"aligner": engine.name, "cache_key": key, "sequences": summary.num_records, "added": added,
+                  "threads": int(threads)}
+        job_id = _submit(MSA, f"MSA: add {added} to {len(existing)} sequence(s) with {engine.label}", params,
+                         threads, cached, run_addition, engine, input_path, added)
+    except BaseException:
+        os.remove(input_path)
+        raise
+    if cached is not None:
+        os.remove(input_path)
+    return job_id
+
+
+def status(job_id):
+    """The job's record, with live `status`, `position` and `elapsed`."""
+    record = _store.read(job_id)
+    if record is None:
+        raise JobNotFound(job_id)
+    live = get_queue().status(record["queue_id"]) if record["queue_id"] else None
+    if live is None and record["status"] not in FINISHED_STATES and (
+            record["queue_id"] or time.time() - record["submitted"] > _SUBMIT_GRACE):
+        # Queued or running in a process that has since exited: the job
+        # will never finish, so fail it rather than leave callers polling.
+        record = _store.update(job_id, status=FAILED, finished=time.time(),
+                               error="Interrupted by a server restart; please submit the job again.") or record
+    if live is not None:
+        record["status"] = live["status"]
+        record["error"] = live["error"] or record["error"]
+        record["position"] = live["position"]
+        record["elapsed"] = live["elapsed"]
+    else:
+        record["position"] = 0
+        record["elapsed"] = ((record["finished"] or time.time()) - record["started"]) if record["started"] else 0.0
+    return record
+
+
+def result(job_id):
+    """BLAST hits or comparison (DataFrame), or aligned FASTA (str) of a finished job, else None.
+
+    BLAST hits come with query coverage and, when the database's statistics
+    are built (`seq_stats.py`), the subject annotations.
+    """
+    record = status(job_id)
+    if record["status"] != DONE:
+        return None
+    path = _store.path(job_id, _RESULT_SUFFIX[record["kind"]])
+    if not os.path.exists(path):
+        return None  # finished in the queue, result still being written
+    if record["kind"] == COMPARE:
+        return typed_comparison(pd.read_parquet(path))
+    if record["kind"] == BLAST:
+        return typed_hits(pd.read_parquet(path))
+    with open(path) as f:
+        return f.read()
+
+
+def query_lengths(job_id):
+    """`{query ID: length}` of a BLAST job, or None when unknown."""
+    try:
+        with open(_store.path(job_id, ".queries.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def clusters(job_id):
+    """The cluster membership (DataFrame) of a clustered alignment job, or None."""
+    try:
+        with open(_store.path(job_id, ".clusters.json")) as f:
+            payload = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return pd.DataFrame(payload["rows"], columns=payload["columns"])
+
+
+def cancel(job_id):
+    record = _store.read(job_id)
+    if record is None:
+        raise JobNotFound(job_id)
+    if record["queue_id"]:
+        get_queue().cancel(record["queue_id"])
+    if record["status"] == QUEUED:
+        # A job cancelled before it started never runs `_run_stored`.
+        _store.update(job_id, status=CANCELLED, finished=time.time())
+    return status(job_id)
+
+
+def list_jobs():
+    return _store.records()
+
+
+def hits_payload(hits, total=None):
+    """JSON-ready form of a BLAST hit table."""
+    return {"columns": list(hits.columns), "rows": hits.values.tolist(),
+            "total": len(hits) if total is None else total}
@@ -0,0 +1,364 @@
+"""Shared worker pool for the external tools (BLAST, aligners).
+
+Streamlit reruns the page script for every session, so anything started from
+a page would normally run on that session's thread. Jobs submitted here run on
+a fixed set of worker threads instead. Each job reserves a number of CPU
+threads from one process-wide budget, so the host load stays capped however
+many sessions are open.
+
+Jobs are ordered by priority (lower runs first), then by submission order.
+Child processes are reaped with `os.wait4`, so their CPU time and peak RSS
+are recorded in `metrics` along with queue waits and job outcomes.
+"""
+import heapq
+import itertools
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+import metrics
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+CPU_BUDGET = int(os.environ.get("MANGODB_CPU_BUDGET", os.cpu_count() or 1))
+MAX_WORKERS = int(os.environ.get("MANGODB_WORKERS", max(1, CPU_BUDGET // 2)))
+JOB_THREADS = int(os.environ.get("MANGODB_JOB_THREADS", 2))
+
+# Finished jobs are kept around this long so pages can still render them.
+JOB_TTL = int(os.environ.get("MANGODB_JOB_TTL", 3600))
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, target, args, kwargs, threads, priority, label):
+        self.id = uuid.uuid4().hex[:12]
+        self.label = label
+        self.threads = threads
+        self.priority = priority
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._target = target
+        self._args = args
+        self._kwargs = kwargs
+        self._procs = set()
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+
+    @property
+    def cancel_requested(self):
+        return self._cancel.is_set()
+
+    @property
+    def is_finished(self):
+        return self.status in FINISHED_STATES
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def run_command(self, argv, **kwargs):
+        """Run `argv` as a child process that `JobQueue.cancel` can kill.
+
+        Returns a `subprocess.CompletedProcess` with text output, like
+        `subprocess.run(argv, capture_output=True, text=True)`.
+        """
+        if self.cancel_requested:
+            raise JobCancelled()
+        with tempfile.TemporaryFile(mode="w+") as out, tempfile.TemporaryFile(mode="w+") as err:
+            started = time.perf_counter()
+            proc = subprocess.Popen(argv, stdout=out, stderr=err, text=True, **kwargs)
+            self._procs.add(proc)
+            try:
+                _reap(proc, argv, started)
+            finally:
+                if proc.returncode is None:
+                    proc.kill()
+                    proc.wait()
+                self._procs.discard(proc)
+            out.seek(0)
+            err.seek(0)
+            stdout, stderr = out.read(), err.read()
+        if self.cancel_requested:
+            raise JobCancelled()
+        return subprocess.CompletedProcess(argv, proc.returncode, stdout, stderr)
+
+    def stream_command(self, argv, **kwargs):
+        """Run `argv` and yield its stdout line by line as it is produced.
+
+        stderr is spooled to a temporary file so a chatty tool cannot block
+        on a full pipe; it becomes the message of the `RuntimeError` raised
+        when the tool exits non-zero.
+        """
+        if self.cancel_requested:
+            raise JobCancelled()
+        with tempfile.TemporaryFile(mode="w+") as stderr:
+            started = time.perf_counter()
+            proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=stderr,
+                                    text=True, **kwargs)
+            self._procs.add(proc)
+            try:
+                for line in proc.stdout:
+                    yield line
+                _reap(proc, argv, started)
+            finally:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+                proc.stdout.close()
+                self._procs.discard(proc)
+            if self.cancel_requested:
+                raise JobCancelled()
+            if proc.returncode != 0:
+                stderr.seek(0)
+                raise RuntimeError(stderr.read().strip() or f"{argv[0]} exited with {proc.returncode}")
+
+    def run_commands(self, argvs, parallel):
+        """Run every argv in `argvs`, at most `parallel` at a time.
+
+        Returns their `subprocess.CompletedProcess`es in order, like
+        `run_command`; cancelling the job kills all running children.
+        """
+        results = [None] * len(argvs)
+        pending = list(enumerate(argvs))
+        running = {}
+        try:
+            while pending or running:
+                while pending and len(running) < max(1, parallel):
+                    if self.cancel_requested:
+                        raise JobCancelled()
+                    i, argv = pending.pop(0)
+                    out = tempfile.TemporaryFile(mode="w+")
+                    err = tempfile.TemporaryFile(mode="w+")
+                    started = time.perf_counter()
+                    proc = subprocess.Popen(argv, stdout=out, stderr=err, text=True)
+                    self._procs.add(proc)
+                    running[proc] = (i, argv, out, err, started)
+                proc = _wait_any(running)
+                i, argv, out, err, _ = running.pop(proc)
+                self._procs.discard(proc)
+                out.seek(0)
+                err.seek(0)
+                results[i] = subprocess.CompletedProcess(argv, proc.returncode, out.read(), err.read())
+                out.close()
+                err.close()
+        finally:
+            for proc, (_, _, out, err, _) in running.items():
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+                self._procs.discard(proc)
+                out.close()
+                err.close()
+        if self.cancel_requested:
+            raise JobCancelled()
+        return results
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def _kill(self):
+        for proc in list(self._procs):
+            if proc.poll() is None:
+                proc.kill()
+
+
+def _reap(proc, argv, started, block=True):
+    """Wait for `proc` with `os.wait4` and record its resource usage in `metrics`.
+
+    Sets and returns `proc.returncode`; without `block`, returns None if the
+    process is still running.
+    """
+    usage = None
+    if proc.returncode is None:
+        try:
+            pid, status, usage = os.wait4(proc.pid, 0 if block else os.WNOHANG)
+        except ChildProcessError:
+            proc.wait()  # already reaped elsewhere, e.g. by `Popen.poll` in `_kill`
+        else:
+            if pid == 0:
+                return None
+            proc.returncode = os.waitstatus_to_exitcode(status)
+    metrics.record_process(argv, time.perf_counter() - started, usage)
+    return proc.returncode
+
+
+def _wait_any(running, interval=0.05):
+    """The first process in `running` (`{proc: (..., argv, ..., started)}`) to exit, reaped."""
+    while True:
+        for proc, entry in running.items():
+            if _reap(proc, entry[1], entry[-1], block=False) is not None:
+                return proc
+        time.sleep(interval)
+
+
+class JobQueue:
+    def __init__(self, workers=MAX_WORKERS, cpu_budget=CPU_BUDGET):
+        self.cpu_budget = max(1, cpu_budget)
+        self._free = self.cpu_budget
+        self._cond = threading.Condition()
+        self._heap = []
+        self._order = itertools.count()
+        self._jobs = {}
+        self._shutdown = False
+        self._workers = [
+            threading.Thread(target=self._worker, name=f"mangodb-worker-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for thread in self._workers:
+            thread.start()
+
+    def submit(self, target, *args, threads=JOB_THREADS, priority=0, label="", **kwargs):
+        """Queue `target(job, *args, **kwargs)` and return the job ID."""
+        threads = max(1, min(int(threads), self.cpu_budget))
+        job = Job(target, args, kwargs, threads, priority, label)
+        with self._cond:
+            self._prune()
+            self._jobs[job.id] = job
+            heapq.heappush(self._heap, (priority, next(self._order), job))
+            self._cond.notify_all()
+        return job.id
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def status(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        return {
+            "id": job.id,
+            "label": job.label,
+            "status": job.status,
+            "position": self.position(job_id),
+            "threads": job.threads,
+            "elapsed": job.elapsed,
+            "error": job.error,
+        }
+
+    def position(self, job_id):
+        """Number of queued jobs that will start before this one."""
+        with self._cond:
+            waiting = sorted(entry for entry in self._heap if entry[2].status == QUEUED)
+        for i, (_, _, job) in enumerate(waiting):
+            if job.id == job_id:
+                return i
+        return 0
+
+    def cancel(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None or job.is_finished:
+            return False
+        with self._cond:
+            job._cancel.set()
+            if job.status == QUEUED:
+                self._finish(job, CANCELLED)
+        job._kill()
+        return True
+
+    def depth(self):
+        with self._cond:
+            queued = sum(1 for job in self._jobs.values() if job.status == QUEUED)
+            running = sum(1 for job in self._jobs.values() if job.status == RUNNING)
+        return queued, running
+
+    def shutdown(self):
+        with self._cond:
+            self._shutdown = True
+            for job in list(self._jobs.values()):
+                if not job.is_finished:
+                    job._cancel.set()
+                    job._kill()
+            self._cond.notify_all()
+
+    def _next_job(self):
+        # Strict ordering: the head of the queue waits for enough free threads
+        # rather than letting smaller jobs overtake it forever.
+        while True:
+            while self._heap and self._heap[0][2].status != QUEUED:
+                heapq.heappop(self._heap)
+            if self._shutdown:
+                return None
+            if self._heap and self._heap[0][2].threads <= self._free:
+                return heapq.heappop(self._heap)[2]
+            self._cond.wait()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                if job is None:
+                    return
+                self._free -= job.threads
+                job.status = RUNNING
+                job.started = time.time()
+            metrics.observe("mangodb_queue_wait_seconds", job.started - job.submitted)
+            state = DONE
+            try:
+                job.result = job._target(job, *job._args, **job._kwargs)
+            except JobCancelled:
+                state = CANCELLED
+            except Exception as e:
+                state = CANCELLED if job.cancel_requested else FAILED
+                job.error = str(e)
+            with self._cond:
+                self._free += job.threads
+                self._finish(job, state)
+                self._cond.notify_all()
+
+    def _finish(self, job, state):
+        job.status = state
+        job.finished = time.time()
+        metrics.inc("mangodb_queue_jobs_total", status=state)
+        job._target = job._args = job._kwargs = None
+        job._done.set()
+
+    def _prune(self):
+        cutoff = time.time() - JOB_TTL
+        for job_id, job in list(self._jobs.items()):
+            if job.is_finished and job.finished < cutoff:
+                del self._jobs[job_id]
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Process-wide queue shared by every Streamlit session."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+            metrics.register_collector(_queue_metrics)
+        return _queue
+
+
+def _queue_metrics():
+    queued, running = _queue.depth()
+    return [("mangodb_queue_depth", "gauge", {"state": QUEUED}, queued),
+            ("mangodb_queue_depth", "gauge", {"state": RUNNING}, running),
+            ("mangodb_queue_free_threads", "gauge", {}, _queue._free),
+            ("mangodb_queue_cpu_budget", "gauge", {}, _queue.cpu_budget)]
+
+
+metrics.describe("mangodb_queue_wait_seconds", "Time jobs spent queued before a worker started them.")
+metrics.describe("mangodb_queue_jobs_total", "Jobs finished, by final state.")
+metrics.describe("mangodb_queue_depth", "Jobs queued and running.")
@@ -0,0 +1,295 @@
+"""In-process k-mer index for exact and near-exact lookups of short queries.
+
+Primers, probes and short reads do not need a full `blastn` run. Each
+nucleotide FASTA in `data/` gets its own index directory holding:
+
+- `seq.npy`: every record's bases as uint8 codes (A=0, C=1, G=2, T=3, other=4),
+  records separated by one code-4 byte;
+- `offsets.npy`: start of each record in `seq.npy` (plus the end);
+- `kmers.npy` / `positions.npy`: all k-mers without ambiguous bases, sorted,
+  with their start positions;
+- `names.json` / `meta.json`: record IDs, `k` and the source file's size/mtime.
+
+The arrays are opened memory-mapped, so a lookup only touches the pages it
+needs. A query with up to `m` mismatches is split into `m + 1` segments; by
+pigeonhole one of them matches exactly, so the first k-mer without
+ambiguous bases in every segment is looked up and each candidate is
+verified against `seq.npy`. Ambiguous query bases get a code of their own
+(5), so they count as mismatches and never match a separator.
+
+Build the indexes with `python kmer_index.py` (see `--help`).
+"""
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+
+DATA_DIR = "data"
+INDEX_DIR = os.path.join(os.environ.get("MANGODB_INDEX_DIR", "index"), "kmer")
+K = 11
+
+# Longer queries, or queries too short to seed with the requested number of
+# mismatches, are left to BLAST.
+MAX_QUERY_LENGTH = int(os.environ.get("MANGODB_KMER_MAX_QUERY", 200))
+MAX_MISMATCHES = 3
+
+_CODES = np.full(256, 4, dtype=np.uint8)
+for _i, _base in enumerate(b"ACGT"):
+    _CODES[_base] = _i
+    _CODES[ord(chr(_base).lower())] = _i
+_QUERY_CODES = _CODES.copy()
+_QUERY_CODES[_CODES == 4] = 5
+_COMPLEMENT = np.array([3, 2, 1, 0, 4, 5], dtype=np.uint8)
+
+
+def encode(seq, table=_CODES):
+    """uint8 base codes for a str/bytes sequence."""
+    if isinstance(seq, str):
+        seq = seq.encode("ascii", "replace")
+    return table[np.frombuffer(seq, dtype=np.uint8)]
+
+
+def reverse_complement(codes):
+    return _COMPLEMENT[codes[::-1]]
+
+
+def kmer_codes(codes, k=K):
+    """2-bit packed k-mers starting at every position, and a validity mask.
+
+    k-mers overlapping an ambiguous base (code 4 or 5) are marked invalid.
+    """
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint32), np.empty(0, dtype=bool)
+    bits = (codes & 3).astype(np.uint32)
+    packed = np.zeros(n, dtype=np.uint32)
+    for j in range(k):
+        packed <<= 2
+        packed |= bits[j:j + n]
+    bad = np.zeros(len(codes) + 1, dtype=np.int64)
+    bad[1:] = (codes >= 4).astype(np.int64).cumsum()
+    valid = (bad[k:k + n] - bad[:n]) == 0
+    return packed, valid
+
+
+def read_fasta(path):
+    """Yield `(record ID, bytes sequence)` from a FASTA file."""
+    name = None
+    parts = []
+    with open(path, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                if name is not None:
+                    yield name, b"".join(parts)
+                words = line[1:].split()
+                name = words[0].decode("ascii", "replace") if words else ""
+                parts = []
+            elif name is not None:
+                parts.append(line.strip())
+    if name is not None:
+        yield name, b"".join(parts)
+
+
+def is_nucleotide_fasta(path, sample=100000):
+    """True when the first `sample` residues of `path` are mostly ACGTN."""
+    seen = 0
+    acgtn = 0
+    for _, seq in read_fasta(path):
+        head = seq[:sample - seen].upper()
+        seen += len(head)
+        acgtn += sum(head.count(base) for base in b"ACGTN")
+        if seen >= sample:
+            break
+    return seen > 0 and acgtn / seen >= 0.9
+
+
+def _source_stamp(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def build_index(fasta_path, out_dir, k=K):
+    """Index one nucleotide FASTA file into `out_dir`."""
+    names = []
+    chunks = []
+    offsets = [0]
+    for name, seq in read_fasta(fasta_path):
+        names.append(name)
+        chunks.append(encode(seq))
+        chunks.append(np.array([4], dtype=np.uint8))
+        offsets.append(offsets[-1] + len(seq) + 1)
+    seq = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.uint8)
+    del chunks
+
+    packed, valid = kmer_codes(seq, k)
+    position_dtype = np.uint32 if len(seq) < 2 ** 32 else np.uint64
+    positions = np.flatnonzero(valid).astype(position_dtype)
+    packed = packed[valid]
+    order = np.argsort(packed, kind="stable")
+
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, "seq.npy"), seq)
+    np.save(os.path.join(out_dir, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(out_dir, "kmers.npy"), packed[order])
+    np.save(os.path.join(out_dir, "positions.npy"), positions[order])
+    with open(os.path.join(out_dir, "names.json"), "w") as f:
+        json.dump(names, f)
+    # meta.json is written last: its presence marks a complete index.
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump({"k": k, "source": fasta_path, **_source_stamp(fasta_path)}, f)
+
+
+def build_all(data_dir=DATA_DIR, index_dir=INDEX_DIR, k=K, force=False):
+    """Index every nucleotide FASTA in `data_dir` that changed since its last build."""
+    built = []
+    for filename in sorted(os.listdir(data_dir)):
+        stem, ext = os.path.splitext(filename)
+        if ext.lower() not in (".fasta", ".fa", ".fna"):
+            continue
+        path = os.path.join(data_dir, filename)
+        out_dir = os.path.join(index_dir, stem)
+        if not force and _is_current(out_dir, path, k):
+            continue
+        if not is_nucleotide_fasta(path):
+            continue
+        build_index(path, out_dir, k)
+        built.append(stem)
+    return built
+
+
+def _is_current(out_dir, fasta_path, k):
+    try:
+        with open(os.path.join(out_dir, "meta.json")) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return meta.get("k") == k and all(meta.get(key) == value
+                                      for key, value in _source_stamp(fasta_path).items())
+
+
+class KmerIndex:
+    def __init__(self, directory):
+        self.name = os.path.basename(os.path.normpath(directory))
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.k = json.load(f)["k"]
+        with open(os.path.join(directory, "names.json")) as f:
+            self.names = json.load(f)
+        self.seq = np.load(os.path.join(directory, "seq.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"))
+        self.kmers = np.load(os.path.join(directory, "kmers.npy"), mmap_mode="r")
+        self.positions = np.load(os.path.join(directory, "positions.npy"), mmap_mode="r")
+
+    def search(self, query, max_mismatches=0):
+        """All placements of `query` with at most `max_mismatches` substitutions.
+
+        Returns a list of dicts (1-based, inclusive coordinates on the forward
+        strand of the subject), or None when the query is too short to seed
+        with `self.k`-mers at this mismatch level or has more ambiguous bases
+        than mismatches allowed.
+        """
+        codes = encode(query, _QUERY_CODES)
+        length = len(codes)
+        segment = length // (max_mismatches + 1)
+        if segment < self.k or np.count_nonzero(codes == 5) > max_mismatches:
+            return None
+        hits = []
+        for strand, q in (("+", codes), ("-", reverse_complement(codes))):
+            starts = self._candidates(q, segment, max_mismatches + 1)
+            starts = starts[(starts >= 0) & (starts + length <= len(self.seq))]
+            if len(starts) == 0:
+                continue
+            window = self.seq[starts[:, None] + np.arange(length)]
+            mismatches = (window != q).sum(axis=1)
+            keep = mismatches <= max_mismatches
+            starts, mismatches = starts[keep], mismatches[keep]
+            records = np.searchsorted(self.offsets, starts, side="right") - 1
+            # Placements spanning a record separator are not real hits.
+            inside = starts + length <= self.offsets[records + 1] - 1
+            for start, record, mm in zip(starts[inside], records[inside], mismatches[inside]):
+                local = int(start - self.offsets[record])
+                hits.append({
+                    "Dataset": self.name,
+                    "Subject ID": self.names[record],
+                    "Subject Start": local + 1 if strand == "+" else local + length,
+                    "Subject End": local + length if strand == "+" else local + 1,
+                    "Strand": strand,
+                    "Mismatches": int(mm),
+                })
+        return hits
+
+    def _candidates(self, codes, segment, pieces):
+        found = []
+        for i in range(pieces):
+            packed, valid = kmer_codes(codes[i * segment:(i + 1) * segment], self.k)
+            if not valid.any():
+                continue  # an ambiguous base in every k-mer: not the exact segment
+            first = int(np.argmax(valid))
+            offset = i * segment + first
+            lo = np.searchsorted(self.kmers, packed[first], side="left")
+            hi = np.searchsorted(self.kmers, packed[first], side="right")
+            found.append(self.positions[lo:hi].astype(np.int64) - offset)
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_indexes(index_dir=INDEX_DIR):
+    """`{dataset name: KmerIndex}` for every complete index in `index_dir`."""
+    if not os.path.isdir(index_dir):
+        return {}
+    with _indexes_lock:
+        cached = _indexes.get(index_dir)
+        mtime = os.stat(index_dir).st_mtime_ns
+        if cached is None or cached[0] != mtime:
+            loaded = {}
+            for name in sorted(os.listdir(index_dir)):
+                directory = os.path.join(index_dir, name)
+                if os.path.exists(os.path.join(directory, "meta.json")):
+                    loaded[name] = KmerIndex(directory)
+            cached = _indexes[index_dir] = (mtime, loaded)
+        return cached[1]
+
+
+def search_datasets(query, datasets=None, max_mismatches=0, index_dir=INDEX_DIR):
+    """Search `query` in the indexed `datasets` (all when None).
+
+    Returns None when the query should go to BLAST instead: it is longer
+    than `MAX_QUERY_LENGTH`, too short to seed, or no requested dataset is
+    indexed.
+    """
+    if len(query) > MAX_QUERY_LENGTH:
+        return None
+    indexes = get_indexes(index_dir)
+    selected = [indexes[name] for name in (datasets or indexes) if name in indexes]
+    if not selected:
+        return None
+    hits = []
+    for index in selected:
+        found = index.search(query, max_mismatches)
+        if found is None:
+            return None
+        hits.extend(found)
+    return hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build k-mer indexes for the FASTA files in data/.")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--index-dir", default=INDEX_DIR)
+    parser.add_argument("-k", type=int, default=K, help="k-mer length (at most 16)")
+    parser.add_argument("--force", action="store_true", help="rebuild indexes that are up to date")
+    args = parser.parse_args()
+    if not 1 <= args.k <= 16:
+        parser.error("-k must be between 1 and 16")
+    built = build_all(args.data_dir, args.index_dir, args.k, args.force)
+    print(f"Built {len(built)} index(es): {', '.join(built) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
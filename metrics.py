@@ -0,0 +1,276 @@
+"""In-process instrumentation: stage timings, counters and child-process usage.
+
+- `span("blast.parse")` times a stage. Spans nest per thread; every
+  top-level span is kept, with its children, in the last `RECENT_TRACES`
+  traces, and each span's duration feeds a per-stage summary.
+- `inc` and `observe` update counters and summaries.
+- `record_page_run` times each script run of the app per page, separating
+  a page's first (cold) run in the process from later reruns.
+- `record_process` adds a finished child process's CPU time and peak RSS
+  (from `os.wait4`) to per-tool counters and to the current span.
+- Collectors registered with `register_collector` (job queue depth, result
+  cache hit rates) are read when the metrics are rendered.
+
+`render_prometheus` gives everything in the Prometheus text format; it is
+served at `/metrics` by the job server, and by the app itself when
+`MANGODB_METRICS_PORT` is set (`start_server`). The admin page shows the
+same data and can run a single page request under cProfile (`profile`).
+"""
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.environ.get("MANGODB_METRICS_PORT", 0))
+RECENT_TRACES = 50
+PROFILE_LINES = 40
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> value
+_summaries = {}  # (name, labels) -> [count, sum, max]
+_help = {}
+_collectors = []
+_traces = deque(maxlen=RECENT_TRACES)
+_profiles = deque(maxlen=5)
+_pages_run = set()
+_local = threading.local()
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def describe(name, text):
+    """Set the `# HELP` text of metric `name`."""
+    _help[name] = text
+
+
+def inc(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        summary = _summaries.setdefault(key, [0, 0.0, 0.0])
+        summary[0] += 1
+        summary[1] += value
+        summary[2] = max(summary[2], value)
+
+
+def register_collector(collect):
+    """Add `collect()`, returning `[(name, type, {labels}, value), ...]` at render time."""
+    with _lock:
+        _collectors.append(collect)
+
+
+class Span:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.start = time.time()
+        self.duration = None
+        self.children = []
+        self.usage = {}  # child-process CPU seconds and peak RSS bytes
+
+    def as_dict(self):
+        return {"name": self.name, "labels": self.labels, "start": self.start, "duration": self.duration,
+                "usage": self.usage, "children": [child.as_dict() for child in self.children]}
+
+
+class span:
+    """Context manager (and decorator) timing one stage as `mangodb_stage_seconds{stage=name}`."""
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        stack = _stack()
+        self.span = Span(self.name, self.labels)
+        if stack:
+            stack[-1].children.append(self.span)
+        stack.append(self.span)
+        self._started = time.perf_counter()
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.duration = time.perf_counter() - self._started
+        stack = _stack()
+        stack.pop()
+        observe("mangodb_stage_seconds", self.span.duration, stage=self.name)
+        if exc_type is not None:
+            inc("mangodb_stage_errors_total", stage=self.name)
+        if not stack:
+            with _lock:
+                _traces.append(self.span)
+        return False
+
+    def __call__(self, func):
+        def wrapper(*args, **kwargs):
+            with span(self.name, **self.labels):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def record_process(argv, wall, rusage):
+    """Account a finished child process; `rusage` is from `os.wait4` (None if unknown)."""
+    tool = os.path.basename(str(argv[0]))
+    inc("mangodb_child_processes_total", tool=tool)
+    observe("mangodb_child_wall_seconds", wall, tool=tool)
+    if rusage is None:
+        return
+    cpu = rusage.ru_utime + rusage.ru_stime
+    # Kilobytes on Linux. The kernel carries the spawning process's peak
+    # over the exec, so small tools report at least this process's RSS.
+    rss = rusage.ru_maxrss * 1024
+    inc("mangodb_child_cpu_seconds_total", cpu, tool=tool)
+    observe("mangodb_child_max_rss_bytes", rss, tool=tool)
+    stack = _stack()
+    if stack:
+        usage = stack[-1].usage
+        usage["cpu_seconds"] = usage.get("cpu_seconds", 0.0) + cpu
+        usage["max_rss_bytes"] = max(usage.get("max_rss_bytes", 0), rss)
+
+
+def record_page_run(page, seconds):
+    """Time one script run of `page`; its first run in this process counts as cold."""
+    with _lock:
+        start = "warm" if page in _pages_run else "cold"
+        _pages_run.add(page)
+    observe("mangodb_page_run_seconds", seconds, page=page, start=start)
+
+
+def traces():
+    """The most recent top-level spans, newest first, as dicts."""
+    with _lock:
+        return [trace.as_dict() for trace in reversed(_traces)]
+
+
+def snapshot():
+    """`(counters, summaries, collected)` as lists of rows."""
+    with _lock:
+        counters = [(name, dict(labels), value) for (name, labels), value in sorted(_counters.items())]
+        summaries = [(name, dict(labels), *values) for (name, labels), values in sorted(_summaries.items())]
+        collectors = list(_collectors)
+    collected = []
+    for collect in collectors:
+        try:
+            collected.extend(collect())
+        except Exception:
+            continue
+    return counters, summaries, collected
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for k, v in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_prometheus():
+    """All metrics in the Prometheus text exposition format."""
+    counters, summaries, collected = snapshot()
+    lines = []
+    typed = set()
+
+    def header(name, kind):
+        if name not in typed:
+            typed.add(name)
+            if name in _help:
+                lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for name, labels, value in counters:
+        header(name, "counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for name, labels, count, total, largest in summaries:
+        header(name, "summary")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+    for name, labels, count, total, largest in summaries:
+        header(name + "_max", "gauge")
+        lines.append(f"{name}_max{_format_labels(labels)} {largest}")
+    for name, kind, labels, value in collected:
+        header(name, kind)
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def profile(func, *args, label="", **kwargs):
+    """Run `func` under cProfile, keep its top functions for the admin page and return its result."""
+    profiler = cProfile.Profile()
+    started = time.time()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_LINES)
+        with _lock:
+            _profiles.append({"label": label, "started": started, "stats": out.getvalue()})
+
+
+def profiles():
+    """Recent cProfile reports, newest first."""
+    with _lock:
+        return list(reversed(_profiles))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_server(port=METRICS_PORT, host="127.0.0.1"):
+    """Serve `/metrics` from a daemon thread, once per process; no-op when `port` is 0."""
+    global _server
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((host, port), _Handler)
+            except OSError:
+                return None  # another process (e.g. a second app worker) has the port
+            threading.Thread(target=_server.serve_forever, name="mangodb-metrics", daemon=True).start()
+        return _server
+
+
+describe("mangodb_stage_seconds", "Time spent in each instrumented stage.")
+describe("mangodb_stage_errors_total", "Stages that raised an exception.")
+describe("mangodb_child_processes_total", "External tool processes run.")
+describe("mangodb_child_cpu_seconds_total", "User and system CPU time of external tool processes.")
+describe("mangodb_child_max_rss_bytes", "Peak resident set size of external tool processes.")
+describe("mangodb_child_wall_seconds", "Wall time of external tool processes.")
+describe("mangodb_page_run_seconds", "App script runs per page; start=cold for a page's first run in the process.")
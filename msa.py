@@ -1,259 +1,471 @@
 import streamlit as st
-import tempfile
-import os
-from Bio.Align.Applications import ClustalOmegaCommandline
+import io
+import time
+import metrics
 from Bio import AlignIO
-from Bio.Align import AlignInfo
-from Bio.Align import MultipleSeqAlignment
-from itertools import combinations
 import seaborn as sns
 import matplotlib.pyplot as plt
-import pandas as pd
-import numpy as np
 from collections import Counter
+from alignment_stats import compute_alignment_stats, extend_alignment_stats
+from alignment_view import (VIEW_ROWS, VIEW_WIDTHS, column_for_position, iter_report, iter_symbolic, overview,
+                            residue_count, window_html)
+from dotplot import compute_dotplot, draw_dotplot
+from result_cache import make_key
+from figures import render, show_figure
+from aligners import ALIGNERS, MAX_SEQUENCES, MSA_CACHE, MSA_THREADS, available_aligners
+from fasta_ingest import FastaError, ingest, ingest_to_file
+from seq_clusters import DEFAULT_IDENTITY, MIN_IDENTITY
+from phylogeny import (DISTANCE_MODELS, MAX_TREE_SEQUENCES, distance_frame, distance_matrix, draw_tree,
+                       tree_newick)
+from jobs import CANCELLED, CPU_BUDGET, DONE, FAILED, QUEUED
+from job_client import JobNotFound, get_backend
+from job_service import MSA
+
+# Dot plots shown per page when browsing all pairs.
+DOTPLOT_PAGE_SIZE = 4
+
+POLL_INTERVAL = 1.0
+
+AUTOMATIC = "Automatic (by input size)"
+NEW_ALIGNMENT = "New alignment"
+ADD_TO_ALIGNMENT = "Add sequences to an alignment"
+CURRENT_ALIGNMENT = "The alignment shown below"
+UPLOADED_ALIGNMENT = "Upload an alignment"
+
+
+def dotplot_png(alignment_key, i, j, word_size, stringency, seq1, seq2):
+    """PNG of one pair's dot plot, cached per alignment, pair and settings."""
+    key = make_key("dotplot", alignment_key, i, j, word_size, stringency)
+    cached = MSA_CACHE.get(key)
+    if cached is not None:
+        return cached
+    counts, extent, dots = compute_dotplot(seq1, seq2, word_size, stringency)
+    fig, ax = plt.subplots()
+    draw_dotplot(ax, counts, extent, xlabel=f"Seq{i+1}", ylabel=f"Seq{j+1}")
+    result = (render(fig), dots)
+    MSA_CACHE.put(key, result)
+    return result
+
+
+def pair_at(n, index):
+    """The `index`-th pair of `combinations(range(n), 2)`, without listing them."""
+    i = 0
+    while index >= n - 1 - i:
+        index -= n - 1 - i
+        i += 1
+    return i, i + 1 + index
+
+
+@st.fragment
+def dotplot_viewer(alignment_key, sequences):
+    """Pairwise dot plots, drawn only for the pairs on screen.
+
+    Runs as a fragment: changing the pair, page or settings reruns just
+    this section, not the alignment above it.
+    """
+    n = len(sequences)
+    if n < 2:
+        st.info("Dot plots need at least two sequences.")
+        return
+    col1, col2 = st.columns(2)
+    with col1:
+        word_size = st.number_input("Dot plot word size (0 = automatic)", min_value=0, max_value=50, value=0)
+    with col2:
+        stringency = st.number_input("Dot plot stringency (minimum diagonal length, 0 = off)",
+                                     min_value=0, max_value=10000, value=0)
+
+    mode = st.radio("Dot plots", ["Pick a pair", "Browse all pairs"], horizontal=True)
+    if mode == "Pick a pair":
+        col1, col2 = st.columns(2)
+        with col1:
+            i = st.selectbox("First sequence", range(n), format_func=lambda k: f"Seq{k+1}")
+        with col2:
+            j = st.selectbox("Second sequence", range(n), index=1, format_func=lambda k: f"Seq{k+1}")
+        pairs = [(i, j)]
+    else:
+        total = n * (n - 1) // 2
+        pages = (total + DOTPLOT_PAGE_SIZE - 1) // DOTPLOT_PAGE_SIZE
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1)
+        first = (page - 1) * DOTPLOT_PAGE_SIZE
+        pairs = [pair_at(n, k) for k in range(first, min(first + DOTPLOT_PAGE_SIZE, total))]
+
+    for i, j in pairs:
+        st.markdown(f"**Seq{i+1} vs Seq{j+1}**")
+        png, dots = dotplot_png(alignment_key, i, j, int(word_size) or None, int(stringency) or None,
+                                sequences[i], sequences[j])
+        st.image(png)
+        if dots == 0:
+            st.caption("No matching words at this word size and stringency.")
+
+
+def plot_base_frequencies(alignment):
+    base_counts = Counter()
+    for record in alignment:
+        base_counts.update(record.seq)
+
+    bases = list(base_counts.keys())
+    counts = [base_counts[base] for base in bases]
+
+    fig, ax = plt.subplots()
+    sns.barplot(x=bases, y=counts, ax=ax)
+    ax.set_title("Base Frequencies")
+    ax.set_xlabel("Base")
+    ax.set_ylabel("Count")
+    return fig
+
+
+def plot_identity_heatmap(stats):
+    df = stats.identity_frame()
+
+    fig, ax = plt.subplots(figsize=(8, 6))
+    # Cell labels are unreadable (and slow to draw) on large alignments.
+    sns.heatmap(df, annot=stats.num_sequences <= 25, fmt=".1f", cmap="viridis", ax=ax)
+    ax.set_title("Pairwise Identity (%)")
+    return fig
+
+
+def plot_pairwise_identities(stats):
+    fig, ax = plt.subplots()
+    ax.hist(stats.pairwise_identities, bins=10, color='teal', edgecolor='black')
+    ax.set_title("Pairwise Identity Distribution")
+    ax.set_xlabel("Identity (%)")
+    ax.set_ylabel("Frequency")
+    return fig
+
+
+def plot_tree(newick, num_sequences):
+    # Leaf names stop being readable past a few hundred sequences.
+    fig, ax = plt.subplots(figsize=(8, min(max(4, 0.2 * num_sequences), 40)))
+    draw_tree(ax, newick, labels=num_sequences <= 200)
+    ax.set_title("Neighbor-Joining Tree")
+    return fig
+
+
+def tree_for(alignment_key, stats, model):
+    """Newick of the alignment's neighbor-joining tree under `model`, cached per alignment."""
+    key = make_key("tree", alignment_key, model)
+    newick = MSA_CACHE.get(key)
+    if newick is None:
+        with metrics.span("msa.tree", model=model, sequences=stats.num_sequences):
+            newick = tree_newick(stats, model)
+        MSA_CACHE.put(key, newick)
+    return newick
+
+
+@st.fragment
+def tree_viewer(alignment_key, stats):
+    """Neighbor-joining tree of the alignment; changing the model reruns just this section."""
+    if stats.num_sequences < 3:
+        st.info("A tree needs at least three sequences.")
+        return
+    if stats.num_sequences > MAX_TREE_SEQUENCES:
+        st.info(f"Trees are built for up to {MAX_TREE_SEQUENCES} sequences; download the aligned FASTA "
+                "to build one elsewhere.")
+        return
+    model = st.radio("Distance", DISTANCE_MODELS, horizontal=True)
+    newick = tree_for(alignment_key, stats, model)
+    show_figure(make_key(alignment_key, "tree", model), lambda: plot_tree(newick, stats.num_sequences),
+                "Tree", "nj_tree")
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button("⬇️ Download Tree (Newick)", newick, file_name="nj_tree.nwk", mime="text/plain")
+    with col2:
+        st.download_button("⬇️ Download Distance Matrix",
+                           data=lambda: distance_frame(stats, distance_matrix(stats, model)).to_csv(),
+                           file_name="distance_matrix.csv", mime="text/csv", on_click="ignore")
+
+
+def format_alignment_with_symbols(stats, line_width=60) -> str:
+    """The whole symbolic alignment view (see `alignment_view.iter_symbolic`)."""
+    return "".join(iter_symbolic(stats, line_width))
+
+
+@st.fragment
+def alignment_viewer(stats):
+    """The alignment, one window of rows and columns at a time.
+
+    Runs as a fragment: moving the window reruns just this section. Only
+    the window is rendered; the overview track shows the whole alignment.
+    """
+    length = stats.alignment_length
+    if length == 0:
+        st.info("The alignment is empty.")
+        return
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        width = min(st.selectbox("Columns shown", VIEW_WIDTHS, index=1), length)
+    with col2:
+        reference = st.selectbox("Position in", range(-1, stats.num_sequences),
+                                 format_func=lambda row: "Alignment" if row < 0 else stats.ids[row])
+    last = length if reference < 0 else max(1, residue_count(stats, reference))
+    with col3:
+        position = st.number_input(f"Go to position (1-{last})", min_value=1, max_value=last, value=1,
+                                   step=width if reference < 0 else 1, key=f"msa_view_position_{reference}")
+    column = position - 1 if reference < 0 else column_for_position(stats, reference, position)
+    start = max(0, min(column, length - width))
+    first_row = 0
+    if stats.num_sequences > VIEW_ROWS:
+        first_row = st.number_input(f"First sequence (of {stats.num_sequences})", min_value=1,
+                                    max_value=stats.num_sequences, value=1, step=VIEW_ROWS) - 1
+
+    st.area_chart(overview(stats, window=(start, start + width)), height=120)
+    st.caption(f"Columns {start + 1}-{start + width} of {length}; sequences {first_row + 1}-"
+               f"{min(first_row + VIEW_ROWS, stats.num_sequences)} of {stats.num_sequences}. "
+               f"Shading: conservation of each column (≥50%, ≥70%, ≥90%, 100%).")
+    st.markdown(window_html(stats, start, start + width, first_row, first_row + VIEW_ROWS, marked=column),
+                unsafe_allow_html=True)
+
+
+def build_artifacts(key, aligned_fasta, aligner, base=None, clusters=None):
+    """Everything the page shows for one alignment.
+
+    The aligned FASTA, the parsed alignment and its stats, and for an
+    alignment of cluster representatives the cluster membership; stored in
+    `MSA_CACHE` under `key`. The alignment view and the text report are
+    drawn from the stats when shown or downloaded; the figures are rendered
+    on first display and cached by `figures` under the same key. With
+    `base`, the artifacts of the alignment this one added sequences to,
+    only the pairs involving the new sequences are counted.
+    """
+    with metrics.span("msa.parse"):
+        alignment = AlignIO.read(io.StringIO(aligned_fasta), "fasta")
+    # Compute stats once; they feed the panel, heatmap and report
+    with metrics.span("msa.stats", incremental=base is not None):
+        stats = extend_alignment_stats(base["stats"], alignment) if base else compute_alignment_stats(alignment)
+    artifacts = {
+        "key": key,
+        "aligner": aligner.label,
+        "aligned_fasta": aligned_fasta,
+        "alignment": alignment,
+        "stats": stats,
+        "clusters": clusters,
+    }
+    MSA_CACHE.put(key, artifacts)
+    return artifacts
+
+
+def wait_for_msa_job(job_id):
+    """Render the state of a submitted alignment and return its artifacts once done.
+
+    While the job is queued or running this polls by rerunning the script.
+    """
+    backend = get_backend()
+    try:
+        job = backend.status(job_id)
+    except JobNotFound:
+        st.warning("This alignment job has expired. Please run it again.")
+        st.session_state["msa_job"] = None
+        return None
+
+    if job["kind"] != MSA:
+        st.warning(f"Job {job_id} is not an alignment.")
+        st.session_state["msa_job"] = None
+        return None
+    aligner = ALIGNERS[job["params"]["aligner"]]
+    aligned_fasta = backend.result(job_id) if job["status"] == DONE else None
+    if aligned_fasta is None and job["status"] not in (CANCELLED, FAILED):
+        if job["status"] == QUEUED:
+            st.info(f"Alignment queued ({job['position']} job(s) ahead), please wait...")
+        else:
+            st.info(f"Aligning with {aligner.label} on {job['params']['threads']} thread(s), please wait... "
+                    f"({job['elapsed']:.0f} s)")
+        if st.button("Cancel MSA"):
+            backend.cancel(job_id)
+            st.rerun()
+        time.sleep(POLL_INTERVAL)
+        st.rerun()
+
+    st.session_state["msa_job"] = None
+    if job["status"] == CANCELLED:
+        st.warning("Alignment cancelled.")
+        return None
+    if job["status"] == FAILED:
+        st.error(f"An error occurred while running MSA:\n\n{job['error']}")
+        return None
+    st.session_state["msa_cached"] = job["cached"]
+    key = job["params"]["cache_key"]
+    base_key = st.session_state.get("msa_base") if job["params"].get("added") else None
+    try:
+        with metrics.span("msa.load_result"):
+            artifacts = MSA_CACHE.get(key)
+            if artifacts is None:
+                clusters = backend.clusters(job_id) if job["params"].get("cluster_identity") else None
+                artifacts = build_artifacts(key, aligned_fasta, aligner,
+                                            MSA_CACHE.get(base_key) if base_key else None, clusters)
+            return artifacts
+    except Exception as e:
+        st.error(f"An error occurred while running MSA:\n\n{str(e)}")
+        return None
+
+
+def render_clusters(clusters):
+    """Which representative each input sequence was collapsed into."""
+    st.markdown("### 🗂️ Sequence Clusters")
+    st.caption(f"{len(clusters)} sequences were collapsed into {clusters['Cluster'].nunique()} clusters; only "
+               "the representatives were aligned. Identity to the representative is estimated from shared "
+               "k-mers.")
+    st.dataframe(clusters, hide_index=True)
+    st.download_button("⬇️ Download Cluster Membership", data=lambda: clusters.to_csv(index=False),
+                       file_name="clusters.csv", mime="text/csv", on_click="ignore")
+
+
+def render_msa_results(artifacts):
+    alignment_obj = artifacts["alignment"]
+    stats = artifacts["stats"]
+    key = artifacts["key"]
+
+    if artifacts.get("clusters") is not None:
+        render_clusters(artifacts["clusters"])
+
+    # 🧬 The alignment, a window at a time
+    st.markdown("### 🧬 Alignment")
+    alignment_viewer(stats)
+
+    # 🔳 Identity matrix heatmap
+    st.markdown("### 🧊 Pairwise Identity Heatmap")
+    show_figure(make_key(key, "identity_heatmap"), lambda: plot_identity_heatmap(stats),
+                "Identity Heatmap", "identity_heatmap")
+
+    # 🌳 Neighbor-joining tree, from the same pair counts as the heatmap
+    st.markdown("### 🌳 Phylogenetic Tree (Neighbor-Joining)")
+    tree_viewer(key, stats)
+
+    # 📈 Distribution of all pairwise identities
+    st.markdown("### 📈 Pairwise Identity Distribution")
+    show_figure(make_key(key, "pairwise_identities"), lambda: plot_pairwise_identities(stats),
+                "Identity Distribution", "pairwise_identity_distribution")
+
+    # ➖ Dot plot comparisons (for 2 sequences at a time)
+    st.markdown("### 🔲 Dot Plots (Pairwise)")
+    # Dot plots compare the input sequences, so gaps are dropped
+    sequences = [str(record.seq).replace("-", "") for record in alignment_obj]
+    dotplot_viewer(key, sequences)
+
+    # 📉 Base or amino acid frequencies
+    st.markdown("### 🔢 Base / Amino Acid Frequencies")
+    show_figure(make_key(key, "base_frequencies"), lambda: plot_base_frequencies(alignment_obj),
+                "Frequency Plot", "base_frequencies")
+
+    st.markdown("### 📊 Alignment Statistics")
+    st.markdown(f"""
+    - **Alignment Length:** {stats.alignment_length}  
+    - **Average Pairwise Identity:** {stats.average_identity:.2f}%  
+    - **Average Gaps per Pair:** {stats.average_gaps:.2f}  
+    - **Total Sequences:** {len(alignment_obj)}
+    """)
+    # Download: Aligned FASTA
+    st.download_button("⬇️ Download Aligned FASTA", artifacts["aligned_fasta"], file_name="aligned_sequences.fasta")
+    # Download: Stats + Visual Alignment as TXT, generated when clicked
+    st.download_button("⬇️ Download Alignment Report", data=lambda: "".join(iter_report(stats)),
+                       file_name="alignment_report.txt", mime="text/plain", on_click="ignore")
+
 
 def msa_ui():
     #st.image("logo.png", width=150)
     #st.markdown("## My Bioinformatics App")
 
-    def plot_base_frequencies(alignment):
-        base_counts = Counter()
-        for record in alignment:
-            base_counts.update(record.seq)
-
-        bases = list(base_counts.keys())
-        counts = [base_counts[base] for base in bases]
-
-        fig, ax = plt.subplots()
-        sns.barplot(x=bases, y=counts, ax=ax)
-        ax.set_title("Base Frequencies")
-        ax.set_xlabel("Base")
-        ax.set_ylabel("Count")
-        st.pyplot(fig)
-
-    def plot_dotplot(seq1, seq2, window=1):
-        matches = []
-        for i in range(len(seq1) - window + 1):
-            for j in range(len(seq2) - window + 1):
-                if seq1[i:i+window] == seq2[j:j+window]:
-                    matches.append((i, j))
-
-        x, y = zip(*matches) if matches else ([], [])
-        fig, ax = plt.subplots()
-        ax.plot(x, y, 'k.', markersize=2)
-        ax.set_xlabel("Sequence 1")
-        ax.set_ylabel("Sequence 2")
-        ax.set_title("Dot Plot")
-        st.pyplot(fig)
-
-
-    def generate_alignment_report(alignment, formatted_alignment, stats):
-        report = StringIO()
-        report.write("### Alignment Statistics\n")
-        report.write(f"Alignment Length: {stats['alignment_length']}\n")
-        report.write(f"Average Pairwise Identity: {stats['average_identity']:.2f}%\n")
-        report.write(f"Average Gaps per Pair: {stats['average_gaps']}\n")
-        report.write(f"Total Sequences: {len(alignment)}\n\n")
-        report.write("### Visual Alignment\n")
-        report.write(formatted_alignment)
-        return report
-
-    def plot_identity_heatmap(alignment):
-        labels = [record.id for record in alignment]
-        n = len(alignment)
-        matrix = np.zeros((n, n))
-
-        for i, rec1 in enumerate(alignment):
-            for j, rec2 in enumerate(alignment):
-                if i <= j:
-                    matches = sum(a == b and a != '-' for a, b in zip(rec1.seq, rec2.seq))
-                    identity = matches / len(rec1.seq) * 100
-                    matrix[i, j] = identity
-                    matrix[j, i] = identity  # symmetric
-        df = pd.DataFrame(matrix, index=labels, columns=labels)
-
-        fig, ax = plt.subplots(figsize=(8, 6))
-        sns.heatmap(df, annot=True, fmt=".1f", cmap="viridis", ax=ax)
-        ax.set_title("Pairwise Identity (%)")
-        st.pyplot(fig)
-
-
-    def plot_pairwise_identities(stats):
-        fig, ax = plt.subplots()
-        ax.hist(stats["pairwise_identities"], bins=10, color='teal', edgecolor='black')
-        ax.set_title("Pairwise Identity Distribution")
-        ax.set_xlabel("Identity (%)")
-        ax.set_ylabel("Frequency")
-        st.pyplot(fig)
-
     #st.title("🧩 Multiple Sequence Alignment (MSA)")
 
     st.title("Multiple Sequence Alignment (MSA)")
     st.markdown("""Upload multiple FASTA files **or** paste multiple sequences below:
     	    Results and alignment plots can be downloaded.""")
 
-    # Input methods
-    msa_files = st.file_uploader("Upload FASTA files", type=["fasta", "fa"], accept_multiple_files=True)
-    sequence_text = st.text_area("Or paste multiple FASTA sequences here", height=300)
-
-    run_button = st.button("Run MSA")
-
-    def compute_alignment_stats(alignment: MultipleSeqAlignment):
-        stats = {
-            "alignment_length": alignment.get_alignment_length(),
-            "pairwise_identities": [],
-            "pairwise_gaps": [],
-        }
-
-        for rec1, rec2 in combinations(alignment, 2):
-            matches = sum(a == b and a != '-' for a, b in zip(rec1.seq, rec2.seq))
-            gaps = sum(a == '-' or b == '-' for a, b in zip(rec1.seq, rec2.seq))
-            length = len(rec1.seq)
-
-            identity = (matches / length) * 100
-            stats["pairwise_identities"].append(identity)
-            stats["pairwise_gaps"].append(gaps)
-
-        stats["average_identity"] = sum(stats["pairwise_identities"]) / len(stats["pairwise_identities"])
-        stats["average_gaps"] = sum(stats["pairwise_gaps"]) / len(stats["pairwise_gaps"])
-        return stats
-
-    #from Bio.Align import MultipleSeqAlignment
-
-    def format_alignment_with_symbols(alignment: MultipleSeqAlignment, line_width=60) -> str:
-        """
-        Formats DNA alignment with:
-        - '|' for exact match
-        - ':' for similar (purine↔purine or pyrimidine↔pyrimidine)
-        - ' ' for mismatches/gaps
-        """
-
-        purines = {'A', 'G'}
-        pyrimidines = {'C', 'T'}
-
-        output = ""
-        alignment_len = alignment.get_alignment_length()
-
-        for block_start in range(0, alignment_len, line_width):
-            block_end = min(block_start + line_width, alignment_len)
-
-            # Sequence block
-            seq_lines = [
-                f"Seq{i+1:<4} {str(record.seq[block_start:block_end])}"
-                for i, record in enumerate(alignment)
-            ]
-
-            # Match line
-            match_line = []
-            for pos in range(block_start, block_end):
-                column = [record.seq[pos] for record in alignment]
-                if '-' in column:
-                    match_line.append(" ")
-                    continue
-
-                if all(base == column[0] for base in column):
-                    match_line.append("|")
-                elif all(base in purines for base in column) or all(base in pyrimidines for base in column):
-                    match_line.append(":")
-                else:
-                    match_line.append(" ")
-
-            output += "\n".join(seq_lines) + "\n"
-            output += "    " + "    " + "".join(match_line) + "\n\n"  # Add 3+3=6 spaces for alignment
-
-        return output
-
+    mode = st.radio("Mode", [NEW_ALIGNMENT, ADD_TO_ALIGNMENT], horizontal=True)
+    adding = mode == ADD_TO_ALIGNMENT
+    current = st.session_state.get("msa_artifacts")
+    base_choice = base_file = None
+    if adding:
+        # New sequences are aligned into the existing alignment, which is not realigned.
+        bases = ([CURRENT_ALIGNMENT] if current is not None else []) + [UPLOADED_ALIGNMENT]
+        base_choice = st.radio("Existing alignment", bases, horizontal=True)
+        if base_choice == UPLOADED_ALIGNMENT:
+            base_file = st.file_uploader("Upload an aligned FASTA file", type=["fasta", "fa"])
 
+    # Input methods
+    what = "the sequences to add" if adding else "FASTA files"
+    msa_files = st.file_uploader(f"Upload {what}", type=["fasta", "fa"], accept_multiple_files=True)
+    sequence_text = st.text_area(f"Or paste {'the sequences to add' if adding else 'multiple FASTA sequences'} here",
+                                 height=300)
+
+    engines = {aligner.label: aligner for aligner in available_aligners() if aligner.can_add or not adding}
+    col1, col2 = st.columns(2)
+    with col1:
+        engine = st.selectbox("Aligner", [AUTOMATIC] + list(engines))
+    with col2:
+        threads = st.number_input("Threads", min_value=1, max_value=CPU_BUDGET, value=min(MSA_THREADS, CPU_BUDGET))
+    cluster_identity = None
+    if not adding and st.checkbox("Collapse near-identical sequences first (align one per cluster)"):
+        cluster_identity = st.slider("Cluster identity threshold", min_value=MIN_IDENTITY, max_value=1.0,
+                                     value=DEFAULT_IDENTITY, step=0.01)
+
+    run_button = st.button("Add to Alignment" if adding else "Run MSA")
 
     if run_button:
         try:
-            # Step 1: Write sequences to a temporary file
             if sequence_text.strip():
-                input_data = sequence_text.strip()
+                sources = [sequence_text]
             elif msa_files:
-                input_data = ""
-                for file in msa_files:
-                    input_data += file.read().decode() + "\n"
+                sources = msa_files
             else:
                 st.warning("Please upload FASTA files or paste sequences.")
                 st.stop()
 
-            with tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix=".fasta") as input_file:
-                input_file.write(input_data)
-                input_file.flush()
-
-                aligned_file = tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix=".fasta")
-
-                # Step 2: Run Clustal Omega
-                clustal_cmd = ClustalOmegaCommandline(
-                    infile=input_file.name,
-                    outfile=aligned_file.name,
-                    auto=True,
-                    force=True
-                )
-                stdout, stderr = clustal_cmd()
-
-                # Step 3: Display results
-                alignment_obj = AlignIO.read(aligned_file.name, "fasta")
-                #alignment = open(aligned_file.name).read()
-                st.success("Alignment completed successfully.")
-                
-                # Show raw alignment
-                st.code(open(aligned_file.name).read(), language="fasta")
-                
-                # Show the aligned sequences in symbolic form
-                formatted = format_alignment_with_symbols(alignment_obj)
-                st.text_area("🧬 Visual Alignment", formatted, height=500)
-                # Compute and display stats
-                stats = compute_alignment_stats(alignment_obj)
-                
-
-                #st.download_button("⬇️ Download Alignment Report", export_text.getvalue(), file_name="alignment_report.txt")
-
-                # 🔳 Identity matrix heatmap
-                st.markdown("### 🧊 Pairwise Identity Heatmap")
-                plot_identity_heatmap(alignment_obj)
-                
-                
-                # ➖ Dot plot comparisons (for 2 sequences at a time)
-                st.markdown("### 🔲 Dot Plots (Pairwise)")
-                from itertools import combinations
-                for i, j in combinations(range(len(alignment_obj)), 2):
-                    st.markdown(f"**Seq{i+1} vs Seq{j+1}**")
-                    plot_dotplot(str(alignment_obj[i].seq), str(alignment_obj[j].seq))
-                    plot_pairwise_identities(stats)
-                
-                # 📉 Base or amino acid frequencies
-                st.markdown("### 🔢 Base / Amino Acid Frequencies")
-                plot_base_frequencies(alignment_obj)
-                
-                
-                
-                st.markdown("### 📊 Alignment Statistics")
-                st.markdown(f"""
-                - **Alignment Length:** {stats['alignment_length']}  
-                - **Average Pairwise Identity:** {stats['average_identity']:.2f}%  
-                - **Average Gaps per Pair:** {stats['average_gaps']}  
-                - **Total Sequences:** {len(alignment_obj)}
-                """)
-                # Download: Aligned FASTA
-                with open(aligned_file.name, "rb") as f:
-                    st.download_button("⬇️ Download Aligned FASTA", f, file_name="aligned_sequences.fasta")
-                # Download: Stats + Visual Alignment as TXT
-                from io import StringIO
-                export_text = StringIO()
-                export_text.write("### Alignment Statistics\n")
-                export_text.write(f"Alignment Length: {stats['alignment_length']}\n")
-                export_text.write(f"Average Pairwise Identity: {stats['average_identity']:.2f}%\n")
-                export_text.write(f"Average Gaps per Pair: {stats['average_gaps']}\n")
-                export_text.write(f"Total Sequences: {len(alignment_obj)}\n\n")
-                export_text.write("### Visual Alignment\n")
-                export_text.write(formatted)
-                
-                report = generate_alignment_report(alignment_obj, formatted, stats)
-                st.download_button("⬇️ Download Alignment Report",data=export_text.getvalue(), file_name="alignment_report.txt",mime="text/plain")
-
-
+            if adding:
+                if base_choice == UPLOADED_ALIGNMENT and base_file is None:
+                    st.warning("Please upload the alignment to add the sequences to.")
+                    st.stop()
+                # The new sequences are counted first; the job gets the
+                # alignment followed by them in one file.
+                added = ingest(sources, max_records=MAX_SEQUENCES).num_records
+                base = [current["aligned_fasta"]] if base_choice == CURRENT_ALIGNMENT else [base_file]
+                with metrics.span("msa.ingest"):
+                    input_path, summary = ingest_to_file(base + sources, max_records=MAX_SEQUENCES)
+            else:
+                with metrics.span("msa.ingest"):
+                    input_path, summary = ingest_to_file(sources, max_records=MAX_SEQUENCES, min_records=2)
+            backend = get_backend()
+            previous = st.session_state.get("msa_job")
+            if previous is not None:
+                try:
+                    backend.cancel(previous)
+                except JobNotFound:
+                    pass
+            st.session_state["msa_artifacts"] = None
+            st.session_state["msa_job"] = None
+            aligner = engines[engine].name if engine in engines else None
+            # The backend answers repeated alignments from the cache.
+            with metrics.span("msa.submit"):
+                if adding:
+                    st.session_state["msa_base"] = current["key"] if base_choice == CURRENT_ALIGNMENT else None
+                    st.session_state["msa_job"] = backend.submit_msa_add(input_path, summary, added, aligner,
+                                                                         threads)
+                else:
+                    st.session_state["msa_job"] = backend.submit_msa(input_path, summary, aligner, threads,
+                                                                     cluster_identity)
+        except FastaError as e:
+            st.error(f"Invalid FASTA input: {e}")
         except Exception as e:
             st.error(f"An error occurred while running MSA:\n\n{str(e)}")
 
+    # Jobs outlive the browser tab; their results can be reopened by ID.
+    with st.expander("Open an alignment job by ID"):
+        opened = st.text_input("Job ID", key="msa_open_job").strip()
+        if st.button("Open job", key="msa_open_button") and opened:
+            st.session_state["msa_artifacts"] = None
+            st.session_state["msa_job"] = opened
+
+    # The result stays in the session, so later reruns (widgets,
+    # downloads) redraw it without aligning again.
+    job_id = st.session_state.get("msa_job")
+    if job_id is not None:
+        st.caption(f"Job ID: `{job_id}`")
+        st.session_state["msa_artifacts"] = wait_for_msa_job(job_id)
+
+    artifacts = st.session_state.get("msa_artifacts")
+    if artifacts is not None:
+        if st.session_state.get("msa_cached"):
+            st.success(f"Alignment completed successfully with {artifacts['aligner']} (cached result).")
+        else:
+            st.success(f"Alignment completed successfully with {artifacts['aligner']}.")
+        with metrics.span("msa.render"):
+            render_msa_results(artifacts)
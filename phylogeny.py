@@ -0,0 +1,160 @@
+"""Evolutionary distances and neighbor-joining trees from an alignment.
+
+Distances come from the pair counts `AlignmentStats` already holds for the
+identity heatmap (identical residues and columns where both sequences have
+one), so nothing is counted twice: the p-distance is the fraction of
+mismatches over the columns both sequences cover, and the Jukes-Cantor and
+Kimura models correct it for multiple substitutions. Kimura's two-parameter
+model for nucleotides also needs the transitions, counted in one blocked
+pass over the alignment (`alignment_stats.transition_counts`).
+
+`neighbor_joining` keeps the `n x n` distance matrix (and a float32 copy
+to pick the pair to join) and a row-sum vector. Each join writes the new
+node's distances into the first node's slot and moves the last active row
+into the second's, so every step works on a compact matrix, in place.
+"""
+import io
+import os
+
+import numpy as np
+import pandas as pd
+from Bio import AlignIO, Phylo
+
+from alignment_stats import GAP, compute_alignment_stats, transition_counts
+
+P_DISTANCE = "p-distance"
+JUKES_CANTOR = "Jukes-Cantor"
+KIMURA = "Kimura"
+DISTANCE_MODELS = [P_DISTANCE, JUKES_CANTOR, KIMURA]
+
+# Corrected distances of saturated pairs (too divergent for the model, or
+# sharing no aligned column) are capped at this value.
+MAX_DISTANCE = 5.0
+
+# Alignments with more sequences get no tree on the page.
+MAX_TREE_SEQUENCES = int(os.environ.get("MANGODB_TREE_MAX_SEQUENCES", 2000))
+
+_NUCLEOTIDE_CODES = np.frombuffer(b"ACGTUN", dtype=np.uint8)
+
+
+def is_nucleotide(stats):
+    """True when at least 90 % of the alignment's residues are ACGTUN."""
+    residues = np.count_nonzero(stats.matrix != GAP)
+    return residues > 0 and np.isin(stats.matrix, _NUCLEOTIDE_CODES).sum() / residues >= 0.9
+
+
+def distance_matrix(stats, model=P_DISTANCE):
+    """`n x n` distances between the sequences of an `AlignmentStats` under `model`."""
+    if model not in DISTANCE_MODELS:
+        raise ValueError(f"Unknown distance model '{model}'.")
+    length = stats.alignment_length
+    both_residues = (length - stats.gap_matrix).astype(np.float64)
+    matches = np.rint(stats.identity_matrix * length / 100)
+    nucleotide = is_nucleotide(stats)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = np.where(both_residues > 0, 1 - matches / both_residues, 1.0)
+        if model == P_DISTANCE:
+            distances = p
+        elif model == JUKES_CANTOR:
+            b = 0.75 if nucleotide else 0.95
+            distances = -b * np.log(1 - p / b)
+        elif nucleotide:
+            transitions = transition_counts(stats.matrix) / both_residues
+            transversions = p - transitions
+            distances = (-0.5 * np.log(1 - 2 * transitions - transversions)
+                         - 0.25 * np.log(1 - 2 * transversions))
+        else:
+            distances = -np.log(1 - p - 0.2 * p * p)
+    distances = np.where(np.isfinite(distances), distances, MAX_DISTANCE)
+    distances = np.clip(distances, 0, MAX_DISTANCE)
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+def distance_frame(stats, distances):
+    return pd.DataFrame(distances, index=stats.ids, columns=stats.ids)
+
+
+def newick_name(name):
+    """`name` as a Newick label, quoted when it holds Newick punctuation."""
+    if any(c in name for c in "()[]:;,' \t"):
+        return "'" + name.replace("'", "''") + "'"
+    return name
+
+
+def _branch(node, length):
+    return f"{node}:{length if length > 0 else 0.0:.6g}"
+
+
+def neighbor_joining(distances, names):
+    """Neighbor-joining tree of `distances` (`n x n`) as a Newick string.
+
+    Negative branch lengths are set to 0. The tree is unrooted: the last
+    three nodes meet at the top-level node.
+    """
+    n = len(names)
+    nodes = [newick_name(name) for name in names]
+    if n < 3:
+        if n == 2:
+            half = float(distances[0][1]) / 2
+            return f"({_branch(nodes[0], half)},{_branch(nodes[1], half)});"
+        return f"({nodes[0]});" if n else ";"
+    d = np.array(distances, dtype=np.float64)
+    # The pair to join is chosen on a float32 copy, which halves the memory
+    # traffic of the full-matrix pass; branch lengths come from `d`.
+    d32 = d.astype(np.float32)
+    q = np.empty_like(d32)
+    sums = d.sum(axis=1)
+    m = n
+    while m > 3:
+        work = q[:m, :m]
+        np.multiply(d32[:m, :m], m - 2, out=work)
+        work -= sums[:m].astype(np.float32)
+        np.fill_diagonal(work, np.inf)
+        i = int(np.argmin(work.min(axis=1) - sums[:m]))
+        j = int(np.argmin(work[i]))
+        i, j = min(i, j), max(i, j)
+        dij = d[i, j]
+        length_i = 0.5 * dij + (sums[i] - sums[j]) / (2 * (m - 2))
+        length_j = dij - length_i
+        joined = 0.5 * (d[i, :m] + d[j, :m] - dij)
+        joined[i] = 0
+        sums[:m] += joined - d[i, :m] - d[j, :m]
+        d[i, :m] = d[:m, i] = joined
+        d32[i, :m] = d32[:m, i] = joined
+        nodes[i] = f"({_branch(nodes[i], length_i)},{_branch(nodes[j], length_j)})"
+        last = m - 1
+        if j != last:
+            for matrix in (d, d32):
+                matrix[j, :m] = matrix[last, :m]
+                matrix[:m, j] = matrix[:m, last]
+                matrix[j, j] = 0
+            sums[j] = sums[last]
+            nodes[j] = nodes[last]
+        nodes.pop()
+        m -= 1
+        sums[i] = d[i, :m].sum()
+    a = 0.5 * (d[0, 1] + d[0, 2] - d[1, 2])
+    b = d[0, 1] - a
+    c = d[0, 2] - a
+    return f"({_branch(nodes[0], a)},{_branch(nodes[1], b)},{_branch(nodes[2], c)});"
+
+
+def tree_newick(stats, model=P_DISTANCE):
+    """Neighbor-joining tree of an `AlignmentStats` under distance `model`, as Newick."""
+    return neighbor_joining(distance_matrix(stats, model), stats.ids)
+
+
+def newick_from_fasta(aligned_fasta, model=P_DISTANCE):
+    """`tree_newick` of an aligned FASTA string."""
+    return tree_newick(compute_alignment_stats(AlignIO.read(io.StringIO(aligned_fasta), "fasta")), model)
+
+
+def draw_tree(ax, newick, labels=True):
+    """Draw a Newick tree on `ax`, with leaf names unless `labels` is False."""
+    tree = Phylo.read(io.StringIO(newick), "newick")
+    Phylo.draw(tree, axes=ax, do_show=False,
+               label_func=(lambda clade: clade.name if clade.is_terminal() else None) if labels else (lambda _: None))
+    ax.set_ylabel("")
+    ax.set_yticks([])
+    ax.set_xlabel("Branch length")
@@ -0,0 +1,137 @@
+"""Two-level (memory + disk) LRU cache for expensive results.
+
+Values are pickled to `<cache dir>/<namespace>/<key>.pkl` and kept in memory
+as live objects. Both levels evict least-recently-used entries once their
+byte budget is exceeded. Keys are content hashes built with `make_key`, so
+anything that changes the result (input, options, database files) must be
+part of the key; stale entries are never read again and age out on their own.
+Hit and miss counts and memory use are exported through `metrics`.
+"""
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+
+import metrics
+
+CACHE_DIR = os.environ.get("MANGODB_CACHE_DIR", ".cache")
+MEMORY_BYTES = int(os.environ.get("MANGODB_CACHE_MEMORY_MB", 256)) * 1024 * 1024
+DISK_BYTES = int(os.environ.get("MANGODB_CACHE_DISK_MB", 2048)) * 1024 * 1024
+
+
+def make_key(*parts):
+    """Stable SHA-256 hex digest of JSON-serialisable `parts`."""
+    payload = json.dumps(parts, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, namespace, memory_bytes=MEMORY_BYTES, disk_bytes=DISK_BYTES, cache_dir=CACHE_DIR):
+        self.namespace = namespace
+        self.directory = os.path.join(cache_dir, namespace)
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()  # key -> (value, size)
+        self._memory_used = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        metrics.register_collector(self._metrics)
+
+    def _metrics(self):
+        labels = {"cache": self.namespace}
+        return [("mangodb_cache_hits_total", "counter", labels, self.hits),
+                ("mangodb_cache_misses_total", "counter", labels, self.misses),
+                ("mangodb_cache_memory_bytes", "gauge", labels, self._memory_used),
+                ("mangodb_cache_memory_entries", "gauge", labels, len(self._memory))]
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pkl")
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            value = pickle.loads(data)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            with self._lock:
+                self.misses += 1
+            return default
+        try:
+            os.utime(path)  # mtime doubles as the disk LRU clock
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+            self._remember(key, value, len(data))
+        return value
+
+    def put(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._remember(key, value, len(data))
+        if len(data) > self.disk_bytes:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+        self._evict_disk()
+
+    def __contains__(self, key):
+        return key in self._memory or os.path.exists(self._path(key))
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_used = 0
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                os.remove(os.path.join(self.directory, name))
+
+    def _remember(self, key, value, size):
+        if size > self.memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_used -= old[1]
+        self._memory[key] = (value, size)
+        self._memory_used += size
+        while self._memory_used > self.memory_bytes:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_used -= evicted
+
+    def _evict_disk(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".pkl"):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
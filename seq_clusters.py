@@ -0,0 +1,178 @@
+"""Greedy redundancy clustering of sequences by shared k-mers (CD-HIT style).
+
+Sequences are visited longest first. Each is compared with the
+representatives found so far through a word table: the representatives'
+k-mers in sorted arrays with a parallel array of cluster numbers.
+`np.searchsorted` finds the table entries of the sequence's distinct k-mers
+and one `np.bincount` over their cluster numbers counts the words it shares
+with every representative at once. The fraction `c` of its k-mers found in
+a representative estimates their identity over the shorter sequence as `c ** (1 / k)`, since a word
+survives only if all `k` of its residues are identical. The sequence joins
+the representative it shares most words with when that estimate reaches
+the threshold, and otherwise becomes a representative itself.
+
+Word sizes follow CD-HIT's recommendations for the threshold: long words
+for near-identical clustering, shorter ones as the threshold drops.
+Sequences too short for one word are kept as their own clusters.
+"""
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from db_catalog import NUCL
+from kmer_index import read_fasta
+
+DEFAULT_IDENTITY = 0.9
+MIN_IDENTITY = 0.5
+
+# (lowest identity, word size), highest threshold first.
+NUCLEOTIDE_WORD_SIZES = [(0.95, 10), (0.9, 8), (0.88, 7), (0.85, 6), (0.8, 5), (0.0, 4)]
+PROTEIN_WORD_SIZES = [(0.7, 5), (0.6, 4), (0.5, 3), (0.0, 2)]
+
+_NUCLEOTIDE_CODES = np.full(256, 255, dtype=np.uint8)
+for _code, _bases in enumerate([b"Aa", b"Cc", b"Gg", b"TtUu"]):
+    _NUCLEOTIDE_CODES[list(_bases)] = _code
+_PROTEIN_CODES = np.full(256, 255, dtype=np.uint8)
+for _code, _residue in enumerate(b"ACDEFGHIKLMNPQRSTVWY"):
+    _PROTEIN_CODES[[_residue, _residue + 32]] = _code
+
+
+def word_size(identity, sequence_type):
+    """The k-mer size for clustering at `identity` (0-1)."""
+    table = NUCLEOTIDE_WORD_SIZES if sequence_type == NUCL else PROTEIN_WORD_SIZES
+    return next(size for lowest, size in table if identity >= lowest)
+
+
+def kmer_codes(seq, k, sequence_type):
+    """The distinct k-mers of `seq` (bytes) as sorted integers; words with ambiguous residues are skipped."""
+    table, base = (_NUCLEOTIDE_CODES, 4) if sequence_type == NUCL else (_PROTEIN_CODES, 20)
+    codes = table[np.frombuffer(seq, dtype=np.uint8)]
+    n = len(codes) - k + 1
+    if n < 1:
+        return np.empty(0, dtype=np.int64)
+    words = np.zeros(n, dtype=np.int64)
+    for j in range(k):
+        words *= base
+        words += codes[j:j + n]
+    ambiguous = np.concatenate([[0], np.cumsum(codes == 255)])
+    words = np.sort(words[ambiguous[k:] == ambiguous[:n]])
+    return words[np.concatenate([[True], words[1:] != words[:-1]])] if len(words) else words
+
+
+class _WordTable:
+    """The representatives' k-mers as sorted arrays, with their cluster numbers.
+
+    Each level holds its distinct words, sorted, and for each the slice of a
+    parallel cluster-number array listing the representatives containing it.
+    A new representative's words start a level of their own; levels are
+    merged while the newest is at least as large as the one before, so only
+    logarithmically many are searched and every entry is re-sorted a
+    logarithmic number of times.
+    """
+
+    def __init__(self):
+        self.levels = []  # [(words, clusters)], sorted by word, largest first
+        self.index = []  # per level: (distinct words, start of each in `clusters`, with the end appended)
+
+    def add(self, words, cluster):
+        level = (words, np.full(len(words), cluster, dtype=np.int64))
+        while self.levels and len(self.levels[-1][0]) <= len(level[0]):
+            older = self.levels.pop()
+            self.index.pop()
+            merged = np.concatenate([older[0], level[0]])
+            order = np.argsort(merged, kind="stable")
+            level = (merged[order], np.concatenate([older[1], level[1]])[order])
+        distinct, starts = np.unique(level[0], return_index=True)
+        self.levels.append(level)
+        self.index.append((distinct, np.append(starts, len(level[0]))))
+
+    def shared(self, words, num_clusters):
+        """Number of `words` (distinct) each cluster's representative contains."""
+        shared = np.zeros(num_clusters, dtype=np.int64)
+        for (_, clusters), (distinct, bounds) in zip(self.levels, self.index):
+            pos = np.searchsorted(distinct, words)
+            pos = pos[distinct[np.minimum(pos, len(distinct) - 1)] == words]
+            if len(pos) == 0:
+                continue
+            start = bounds[pos]
+            counts = bounds[pos + 1] - start
+            # Positions in `clusters` of every matching word's entries.
+            entries = np.repeat(start - (np.cumsum(counts) - counts), counts) + np.arange(int(counts.sum()))
+            shared += np.bincount(clusters[entries], minlength=num_clusters)
+        return shared
+
+
+class Clusters(NamedTuple):
+    ids: list
+    lengths: np.ndarray
+    representative: np.ndarray  # index of each sequence's representative
+    identity: np.ndarray  # estimated identity to it; 1 for representatives
+    threshold: float
+    word_size: int
+
+    @property
+    def representatives(self):
+        """Indices of the representatives, in input order."""
+        return np.flatnonzero(self.representative == np.arange(len(self.ids)))
+
+    @property
+    def num_clusters(self):
+        return len(self.representatives)
+
+    def frame(self):
+        """One row per sequence: its cluster, representative, length and estimated identity."""
+        reps = self.representatives
+        cluster = np.empty(len(self.ids), dtype=np.int64)
+        cluster[reps] = np.arange(1, len(reps) + 1)
+        return pd.DataFrame({
+            "Sequence": self.ids,
+            "Cluster": cluster[self.representative],
+            "Representative": [self.ids[i] for i in self.representative],
+            "Length": self.lengths,
+            "Identity %": np.round(self.identity * 100, 1),
+        })
+
+
+def cluster_sequences(records, identity=DEFAULT_IDENTITY, sequence_type=NUCL, k=None):
+    """Cluster `(ID, bytes sequence)` records at `identity` (0-1); returns `Clusters`."""
+    ids = [name for name, _ in records]
+    seqs = [seq for _, seq in records]
+    k = k or word_size(identity, sequence_type)
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    representative = np.arange(len(seqs))
+    estimates = np.ones(len(seqs))
+    table = _WordTable()
+    reps = []
+    for i in np.argsort(-lengths, kind="stable"):
+        words = kmer_codes(seqs[i], k, sequence_type)
+        if len(words) == 0:
+            continue
+        if reps:
+            shared = table.shared(words, len(reps))
+            best = int(np.argmax(shared))
+            estimate = (shared[best] / len(words)) ** (1 / k)
+            if estimate >= identity:
+                representative[i] = reps[best]
+                estimates[i] = estimate
+                continue
+        table.add(words, len(reps))
+        reps.append(i)
+    return Clusters(ids, lengths, representative, estimates, identity, k)
+
+
+def cluster_fasta(path, identity=DEFAULT_IDENTITY, sequence_type=NUCL):
+    """`cluster_sequences` of the records of a FASTA file."""
+    return cluster_sequences(list(read_fasta(path)), identity, sequence_type)
+
+
+def write_representatives(path, clusters, out_path):
+    """Copy the records of the FASTA file `path` that are representatives in `clusters` to `out_path`."""
+    keep = set(clusters.representatives.tolist())
+    index = -1
+    with open(path) as f, open(out_path, "w") as out:
+        for line in f:
+            if line.startswith(">"):
+                index += 1
+            if index in keep:
+                out.write(line)
@@ -0,0 +1,270 @@
+"""Retrieval of BLAST hit subject sequences, whole or as aligned regions.
+
+FASTA files in `data/` get a samtools-style `.fai` index (record name,
+length, byte offset of the sequence, bases and bytes per line) in
+`index/fai/`, built on first use and rebuilt when the file changes. Records
+are then read through `mmap`: a region's byte range follows from the line
+layout, so only the pages holding it are touched. Records whose lines are
+not all the same width are indexed with their byte span instead and read
+whole.
+
+Subjects not found in a FASTA of the database's name are fetched from the
+BLAST database with a single `blastdbcmd -entry_batch` call per request,
+however many hits there are.
+
+Prebuild the indexes with `python seq_retrieval.py`.
+"""
+import argparse
+import mmap
+import os
+import subprocess
+import tempfile
+import threading
+
+import numpy as np
+
+from db_catalog import NUCL
+from kmer_index import DATA_DIR
+
+INDEX_DIR = os.path.join(os.environ.get("MANGODB_INDEX_DIR", "index"), "fai")
+FASTA_LINE_WIDTH = 60
+
+_FASTA_EXTENSIONS = (".fasta", ".fa", ".fna", ".faa")
+_COMPLEMENT = bytes.maketrans(b"ACGTURYKMSWBDHVNacgturykmswbdhvn", b"TGCAAYRMKSWVHDBNtgcaayrmkswvhdbn")
+
+
+def reverse_complement(seq):
+    return seq.translate(_COMPLEMENT)[::-1]
+
+
+def build_fai(fasta_path, fai_path):
+    """Write the `.fai` index of `fasta_path`; returns the number of records.
+
+    Irregular records get `-1` bases per line and their sequence's byte
+    span as line width.
+    """
+    entries = []
+    current = None
+
+    def close(record, end):
+        name, length, offset, bases, width, last_bases, regular = record
+        if not regular:
+            bases, width = -1, end - offset
+        entries.append(f"{name}\t{length}\t{offset}\t{bases}\t{width}\n")
+
+    with open(fasta_path, "rb") as f:
+        position = 0
+        for line in f:
+            if line.startswith(b">"):
+                if current is not None:
+                    close(current, position)
+                words = line[1:].split()
+                name = words[0].decode("ascii", "replace") if words else ""
+                current = [name, 0, position + len(line), 0, 0, None, True]
+            elif current is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if bases:
+                    # Every line but the last must have the first line's width.
+                    if current[3] == 0:
+                        current[3], current[4] = bases, len(line)
+                    elif current[5] is not None and current[5] != current[3]:
+                        current[6] = False
+                    elif bases > current[3]:
+                        current[6] = False
+                    current[5] = bases
+                    current[1] += bases
+                elif current[3] == 0:
+                    current[6] = False
+                else:
+                    current[5] = 0  # a blank line is only allowed after the last one
+            position += len(line)
+        if current is not None:
+            close(current, position)
+    if not entries:
+        return 0
+    os.makedirs(os.path.dirname(fai_path) or ".", exist_ok=True)
+    tmp_path = fai_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.writelines(entries)
+    os.replace(tmp_path, fai_path)
+    return len(entries)
+
+
+class FastaIndex:
+    """Random access to the records of an indexed FASTA file."""
+
+    def __init__(self, fasta_path, fai_path):
+        self.path = fasta_path
+        self.records = {}
+        with open(fai_path) as f:
+            for line in f:
+                name, length, offset, bases, width = line.rstrip("\n").split("\t")
+                self.records[name] = (int(length), int(offset), int(bases), int(width))
+        with open(fasta_path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, name):
+        return name in self.records
+
+    def length(self, name):
+        return self.records[name][0]
+
+    def fetch(self, name, start=1, end=None):
+        """Residues `start`..`end` (1-based, inclusive) of record `name`."""
+        length, offset, bases, width = self.records[name]
+        end = length if end is None else min(end, length)
+        start = max(start, 1)
+        if end < start:
+            return b""
+        if bases < 0:
+            raw = self._map[offset:offset + width].replace(b"\n", b"").replace(b"\r", b"")
+            return raw[start - 1:end]
+        first = offset + (start - 1) // bases * width + (start - 1) % bases
+        last = offset + (end - 1) // bases * width + (end - 1) % bases
+        return self._map[first:last + 1].replace(b"\n", b"").replace(b"\r", b"")
+
+
+def _fai_path(fasta_path, index_dir):
+    return os.path.join(index_dir, os.path.basename(fasta_path) + ".fai")
+
+
+def _is_current(fai_path, fasta_path):
+    try:
+        return os.stat(fai_path).st_mtime_ns >= os.stat(fasta_path).st_mtime_ns
+    except OSError:
+        return False
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_fasta_index(fasta_path, index_dir=INDEX_DIR):
+    """`FastaIndex` of `fasta_path`, building its `.fai` if needed; None for empty files."""
+    fai_path = _fai_path(fasta_path, index_dir)
+    with _indexes_lock:
+        if not _is_current(fai_path, fasta_path):
+            _indexes.pop(fasta_path, None)
+            if not build_fai(fasta_path, fai_path):
+                return None
+        if fasta_path not in _indexes:
+            _indexes[fasta_path] = FastaIndex(fasta_path, fai_path)
+        return _indexes[fasta_path]
+
+
+def find_fasta(name, data_dir=DATA_DIR):
+    """Path of the FASTA file in `data_dir` named like database `name`, or None."""
+    for ext in _FASTA_EXTENSIONS:
+        path = os.path.join(data_dir, name + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def fetch_from_db(db_path, dbtype, ids):
+    """`{ID: bytes sequence}` of `ids` from a BLAST database, in one `blastdbcmd` call."""
+    ids = sorted(set(ids))
+    if not ids:
+        return {}
+    fd, batch_path = tempfile.mkstemp(suffix=".txt")
+    with os.fdopen(fd, "w") as f:
+        f.writelines(f"{seq_id}\n" for seq_id in ids)
+    try:
+        result = subprocess.run(["blastdbcmd", "-db", db_path, "-dbtype", dbtype, "-entry_batch", batch_path,
+                                 "-outfmt", "%a %s"], capture_output=True)
+    finally:
+        os.remove(batch_path)
+    if result.returncode != 0 and not result.stdout:
+        raise RuntimeError(result.stderr.decode(errors="replace").strip()
+                           or f"blastdbcmd exited with {result.returncode}")
+    found = {}
+    for line in result.stdout.splitlines():
+        seq_id, _, seq = line.partition(b" ")
+        found[seq_id.decode("ascii", "replace")] = seq
+    # blastdbcmd may report versioned accessions for unversioned IDs.
+    unversioned = {key.rsplit(".", 1)[0]: seq for key, seq in found.items()}
+    for seq_id in ids:
+        if seq_id not in found and seq_id in unversioned:
+            found[seq_id] = unversioned[seq_id]
+    return found
+
+
+class SequenceSource:
+    """Subject sequences of one database: its FASTA in `data/` first, else `blastdbcmd`."""
+
+    def __init__(self, db_path, dbtype, data_dir=DATA_DIR, index_dir=INDEX_DIR):
+        self.db_path = db_path
+        self.dbtype = dbtype
+        fasta_path = find_fasta(os.path.basename(db_path), data_dir)
+        self.index = get_fasta_index(fasta_path, index_dir) if fasta_path else None
+
+    def fetch(self, regions):
+        """Sequences of `(ID, start, end)` regions (1-based, inclusive; None for whole).
+
+        Returns one bytes sequence per region, or None for IDs not found.
+        """
+        missing = [seq_id for seq_id, _, _ in regions if self.index is None or seq_id not in self.index]
+        from_db = fetch_from_db(self.db_path, self.dbtype, missing) if missing else {}
+        sequences = []
+        for seq_id, start, end in regions:
+            if self.index is not None and seq_id in self.index:
+                sequences.append(self.index.fetch(seq_id, start or 1, end))
+            elif seq_id in from_db:
+                seq = from_db[seq_id]
+                sequences.append(seq[(start or 1) - 1:end] if start or end else seq)
+            else:
+                sequences.append(None)
+        return sequences
+
+
+def _wrap(seq, width=FASTA_LINE_WIDTH):
+    return b"\n".join(seq[i:i + width] for i in range(0, len(seq), width)) + b"\n"
+
+
+def hit_sequences_fasta(hits, db_path, dbtype, aligned=True, data_dir=DATA_DIR, index_dir=INDEX_DIR):
+    """FASTA of the subjects of `hits`, as bytes.
+
+    With `aligned` every hit gives the subject region it aligned to, reverse
+    complemented for minus-strand nucleotide hits and named
+    `SUBJECT:START-END QUERY`; otherwise each distinct subject is written
+    once, whole.
+    """
+    source = SequenceSource(db_path, dbtype, data_dir, index_dir)
+    if aligned:
+        subjects = hits["Subject ID"].astype(str).to_numpy()
+        queries = hits["Query ID"].astype(str).to_numpy()
+        s_start = hits["Subject Start"].to_numpy()
+        s_end = hits["Subject End"].to_numpy()
+        lo, hi = np.minimum(s_start, s_end), np.maximum(s_start, s_end)
+        regions = [(subject, int(a), int(b)) for subject, a, b in zip(subjects, lo, hi)]
+        headers = [f">{subject}:{a}-{b} {query}" for subject, a, b, query in zip(subjects, s_start, s_end, queries)]
+        minus = (s_start > s_end) & (dbtype == NUCL)
+    else:
+        subjects = list(dict.fromkeys(hits["Subject ID"].astype(str)))
+        regions = [(subject, None, None) for subject in subjects]
+        headers = [f">{subject}" for subject in subjects]
+        minus = np.zeros(len(subjects), dtype=bool)
+    out = []
+    for header, seq, reverse in zip(headers, source.fetch(regions), minus):
+        if seq is None:
+            continue
+        out.append(header.encode() + b"\n")
+        out.append(_wrap(reverse_complement(seq) if reverse else seq))
+    return b"".join(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build .fai indexes for the FASTA files in data/.")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--index-dir", default=INDEX_DIR)
+    args = parser.parse_args()
+    built = []
+    for filename in sorted(os.listdir(args.data_dir)):
+        if os.path.splitext(filename)[1].lower() in _FASTA_EXTENSIONS:
+            if get_fasta_index(os.path.join(args.data_dir, filename), args.index_dir) is not None:
+                built.append(filename)
+    print(f"Indexed {len(built)} file(s): {', '.join(built) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""Per-dataset sequence statistics, precomputed for annotating BLAST hits.
+
+Every FASTA in `data/` and every database in `db/` gets a sidecar directory
+holding:
+
+- `names.json`: record IDs, in file order;
+- `lengths.npy` (uint32) and `gc.npy` (float32 GC %, NaN for proteins):
+  per-record length and GC content;
+- `sorted_lengths.npy` / `sorted_gc.npy`: the same values sorted, i.e. the
+  dataset's length and GC distributions, for percentiles;
+- `composition.npy`: residue counts of the whole dataset, A to Z plus other;
+- `meta.json`: sequence type, totals and the source file's size/mtime.
+
+A database and a FASTA file of the same name (`db/X`, `data/X.fasta`) share
+one sidecar, read from the FASTA; databases without one are read through
+`blastdbcmd`. The pages look hit subjects up by ID in the loaded sidecar, so
+annotating hits with subject length, coverage and percentiles needs no
+`blastdbcmd` call or FASTA scan at search time.
+
+Build the sidecars with `python seq_stats.py` (see `--help`).
+"""
+import argparse
+import json
+import os
+import subprocess
+import threading
+
+import numpy as np
+import pandas as pd
+
+from db_catalog import DB_DIR, NUCL, PROT, get_catalog
+from kmer_index import DATA_DIR, is_nucleotide_fasta, read_fasta
+
+INDEX_DIR = os.path.join(os.environ.get("MANGODB_INDEX_DIR", "index"), "stats")
+
+SUBJECT_LENGTH = "Subject Length"
+SUBJECT_COVERAGE = "Subject Coverage"
+SUBJECT_GC = "Subject GC %"
+LENGTH_PERCENTILE = "Length Percentile"
+GC_PERCENTILE = "GC Percentile"
+# Column types of the annotations; unknown subjects get length 0 and NaNs.
+ANNOTATION_DTYPES = {SUBJECT_LENGTH: "int32", SUBJECT_COVERAGE: "float32", SUBJECT_GC: "float32",
+                     LENGTH_PERCENTILE: "float32", GC_PERCENTILE: "float32"}
+
+_FASTA_EXTENSIONS = (".fasta", ".fa", ".fna", ".faa")
+
+
+def _source_stamp(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def _db_stamp_path(info):
+    """The file whose size/mtime change when database `info` is rebuilt."""
+    index_ext, alias_ext = (".nin", ".nal") if info.dbtype == NUCL else (".pin", ".pal")
+    for path in (info.path + index_ext, info.path + alias_ext, info.path + ".00" + index_ext):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _blastdbcmd_records(info):
+    """Yield `(ID, bytes sequence)` for every record of database `info`."""
+    argv = ["blastdbcmd", "-db", info.path, "-dbtype", info.dbtype, "-entry", "all", "-outfmt", "%a %s"]
+    process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        for line in process.stdout:
+            name, _, seq = line.rstrip(b"\n").partition(b" ")
+            yield name.decode("ascii", "replace"), seq
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read().decode(errors="replace")
+        process.stderr.close()
+        if process.wait() != 0:
+            raise RuntimeError(stderr.strip() or f"blastdbcmd exited with {process.returncode}")
+
+
+def build_stats(records, dbtype, out_dir, source):
+    """Write the sidecar of `(ID, bytes sequence)` records into `out_dir`.
+
+    Returns the number of records; nothing is written when there are none.
+    """
+    names = []
+    lengths = []
+    gc = []
+    counts = np.zeros(256, dtype=np.int64)
+    for name, seq in records:
+        names.append(name)
+        lengths.append(len(seq))
+        residues = np.frombuffer(seq, dtype=np.uint8)
+        counts += np.bincount(residues, minlength=256)
+        if dbtype == NUCL:
+            upper = seq.upper()
+            gc.append((upper.count(b"G") + upper.count(b"C")) / len(seq) * 100 if seq else 0.0)
+    if not names:
+        return 0
+    lengths = np.array(lengths, dtype=np.uint32)
+    gc = np.array(gc, dtype=np.float32) if dbtype == NUCL else np.full(len(names), np.nan, dtype=np.float32)
+
+    letters = counts[ord("A"):ord("Z") + 1] + counts[ord("a"):ord("z") + 1]
+    composition = np.append(letters, counts.sum() - letters.sum())
+
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, "lengths.npy"), lengths)
+    np.save(os.path.join(out_dir, "gc.npy"), gc)
+    np.save(os.path.join(out_dir, "sorted_lengths.npy"), np.sort(lengths))
+    np.save(os.path.join(out_dir, "sorted_gc.npy"), np.sort(gc))
+    np.save(os.path.join(out_dir, "composition.npy"), composition)
+    with open(os.path.join(out_dir, "names.json"), "w") as f:
+        json.dump(names, f)
+    # meta.json is written last: its presence marks a complete sidecar.
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump({"dbtype": dbtype, "num_sequences": len(names), "total_length": int(lengths.sum()),
+                   "source": source, **_source_stamp(source)}, f)
+    return len(names)
+
+
+def _fasta_sources(data_dir):
+    """`{name: path}` of the FASTA files in `data_dir`."""
+    if not os.path.isdir(data_dir):
+        return {}
+    return {os.path.splitext(filename)[0]: os.path.join(data_dir, filename)
+            for filename in sorted(os.listdir(data_dir))
+            if os.path.splitext(filename)[1].lower() in _FASTA_EXTENSIONS}
+
+
+def build_all(data_dir=DATA_DIR, db_dir=DB_DIR, index_dir=INDEX_DIR, force=False):
+    """Build the sidecar of every FASTA and database that changed since its last build."""
+    built = []
+    fastas = _fasta_sources(data_dir)
+    for name, path in fastas.items():
+        out_dir = os.path.join(index_dir, name)
+        if not force and _is_current(out_dir, path):
+            continue
+        dbtype = NUCL if is_nucleotide_fasta(path) else PROT
+        if build_stats(read_fasta(path), dbtype, out_dir, path):
+            built.append(name)
+    databases = get_catalog(db_dir).databases() if os.path.isdir(db_dir) else []
+    for info in databases:
+        out_dir = os.path.join(index_dir, info.name)
+        if info.name in fastas and os.path.exists(os.path.join(out_dir, "meta.json")):
+            continue  # read from the FASTA above
+        stamp_path = _db_stamp_path(info)
+        if stamp_path is None or (not force and _is_current(out_dir, stamp_path)):
+            continue
+        if build_stats(_blastdbcmd_records(info), info.dbtype, out_dir, stamp_path):
+            built.append(info.name)
+    return built
+
+
+def _is_current(out_dir, source):
+    try:
+        with open(os.path.join(out_dir, "meta.json")) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return meta.get("source") == source and all(meta.get(key) == value
+                                                for key, value in _source_stamp(source).items())
+
+
+class DatasetStats:
+    def __init__(self, directory):
+        self.name = os.path.basename(os.path.normpath(directory))
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(directory, "names.json")) as f:
+            self.rows = {name: row for row, name in enumerate(json.load(f))}
+        self.lengths = np.load(os.path.join(directory, "lengths.npy"), mmap_mode="r")
+        self.gc = np.load(os.path.join(directory, "gc.npy"), mmap_mode="r")
+        self.sorted_lengths = np.load(os.path.join(directory, "sorted_lengths.npy"), mmap_mode="r")
+        self.sorted_gc = np.load(os.path.join(directory, "sorted_gc.npy"), mmap_mode="r")
+        self.composition = np.load(os.path.join(directory, "composition.npy"))
+
+    @property
+    def dbtype(self):
+        return self.meta["dbtype"]
+
+    def lookup(self, ids):
+        """Row of each ID in `ids`, -1 when unknown."""
+        return np.fromiter((self.rows.get(name, -1) for name in ids), dtype=np.int64, count=len(ids))
+
+    def length_percentile(self, lengths):
+        """% of the dataset's records no longer than each of `lengths`."""
+        return np.searchsorted(self.sorted_lengths, lengths, side="right") / len(self.sorted_lengths) * 100
+
+    def gc_percentile(self, gc):
+        """% of the dataset's records with at most each of `gc` GC %."""
+        return np.searchsorted(self.sorted_gc, gc, side="right") / len(self.sorted_gc) * 100
+
+    def annotate(self, hits):
+        """`hits` with the subject's length, coverage, GC % and percentiles added."""
+        subjects = hits["Subject ID"]
+        if not isinstance(subjects.dtype, pd.CategoricalDtype):
+            subjects = subjects.astype("category")
+        # Look up each distinct subject once, then spread by category code
+        # (code -1, a missing ID, picks the trailing -1).
+        category_rows = np.append(self.lookup(list(subjects.cat.categories)), -1)
+        rows = category_rows[subjects.cat.codes.to_numpy()]
+        known = rows >= 0
+        safe_rows = np.where(known, rows, 0)
+
+        lengths = np.where(known, self.lengths[safe_rows], 0).astype(np.int32)
+        span = np.abs(hits["Subject End"].to_numpy().astype(np.int64) - hits["Subject Start"].to_numpy()) + 1
+        with np.errstate(divide="ignore", invalid="ignore"):
+            coverage = np.where(known, span / np.maximum(lengths, 1) * 100, np.nan)
+        hits = hits.copy()
+        hits[SUBJECT_LENGTH] = lengths
+        hits[SUBJECT_COVERAGE] = coverage.astype(np.float32)
+        hits[LENGTH_PERCENTILE] = np.where(known, self.length_percentile(lengths), np.nan).astype(np.float32)
+        if self.dbtype == NUCL:
+            gc = np.where(known, self.gc[safe_rows], np.nan).astype(np.float32)
+            hits[SUBJECT_GC] = gc
+            hits[GC_PERCENTILE] = np.where(known, self.gc_percentile(gc), np.nan).astype(np.float32)
+        return hits
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def get_stats(name, index_dir=INDEX_DIR):
+    """The `DatasetStats` of dataset or database `name`, or None when not built."""
+    directory = os.path.join(index_dir, name)
+    try:
+        mtime = os.stat(os.path.join(directory, "meta.json")).st_mtime_ns
+    except OSError:
+        return None
+    with _stats_lock:
+        cached = _stats.get(directory)
+        if cached is None or cached[0] != mtime:
+            cached = _stats[directory] = (mtime, DatasetStats(directory))
+        return cached[1]
+
+
+def annotate_hits(hits, name, index_dir=INDEX_DIR):
+    """`hits` annotated from the statistics of `name`; unchanged when there are none."""
+    stats = get_stats(name, index_dir)
+    if stats is None or hits.empty:
+        return hits
+    return stats.annotate(hits)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precompute sequence statistics for the FASTA files in data/ and the databases in db/.")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--db-dir", default=DB_DIR)
+    parser.add_argument("--index-dir", default=INDEX_DIR)
+    parser.add_argument("--force", action="store_true", help="rebuild sidecars that are up to date")
+    args = parser.parse_args()
+    built = build_all(args.data_dir, args.db_dir, args.index_dir, args.force)
+    print(f"Built {len(built)} sidecar(s): {', '.join(built) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
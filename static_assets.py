@@ -0,0 +1,45 @@
+"""Header logos and gallery photos, decoded and resized once per process.
+
+`st.image` given a file path reads (and for large images decodes and
+resizes) the file on every script run. `image_bytes` instead shrinks the
+image to the width it is shown at, times `PIXEL_DENSITY` for high-density
+screens, and keeps the encoded bytes for the life of the process. A file
+that changes on disk is read again.
+"""
+import io
+import os
+import threading
+
+from PIL import Image
+
+PIXEL_DENSITY = 2
+JPEG_QUALITY = 85
+
+_cache = {}  # (path, width, mtime) -> bytes
+_lock = threading.Lock()
+
+
+def _resize(path, width):
+    with Image.open(path) as image:
+        image_format = image.format
+        target = width * PIXEL_DENSITY
+        if image.width > target:
+            image = image.resize((target, max(1, round(image.height * target / image.width))), Image.LANCZOS)
+        out = io.BytesIO()
+        if image_format == "JPEG":
+            image.convert("RGB").save(out, "JPEG", quality=JPEG_QUALITY, optimize=True)
+        else:
+            image.save(out, "PNG", optimize=True)
+    return out.getvalue()
+
+
+def image_bytes(path, width):
+    """The image at `path`, encoded for display at `width` pixels."""
+    key = (path, width, os.path.getmtime(path))
+    with _lock:
+        data = _cache.get(key)
+    if data is None:
+        data = _resize(path, width)
+        with _lock:
+            _cache[key] = data
+    return data
@@ -0,0 +1,21 @@
+import pandas as pd
+
+from blast_search import COLNAMES, typed_hits
+from comparative import COMPARISON_COLUMNS, CULTIVAR, compare_hits, matrix
+
+
+def _hits(rows):
+    return typed_hits(pd.DataFrame(rows, columns=COLNAMES))
+
+
+def test_cultivar_without_hits():
+    hits = _hits([["gene1", "chr1", 98.5, 100, 1, 0, 1, 100, 501, 600, 1e-50, 180.0],
+                  ["gene1", "chr2", 90.0, 50, 5, 0, 1, 50, 1, 50, 1e-10, 60.0]])
+    comparison = compare_hits({"Alphonso": hits, "Chaunsa": _hits([])}, {"gene1": 200, "gene2": 100})
+    assert list(comparison.columns) == COMPARISON_COLUMNS
+    assert comparison[CULTIVAR].astype(str).tolist() == ["Alphonso"]
+    assert comparison["Subject ID"].astype(str).tolist() == ["chr1"]
+    assert comparison["Query Coverage"].tolist() == [50.0]
+    table = matrix(comparison, "Bit Score", ["gene1", "gene2"], ["Alphonso", "Chaunsa"])
+    assert table.loc["gene1", "Alphonso"] == 180.0
+    assert table.isna().sum().sum() == 3